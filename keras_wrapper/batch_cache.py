@@ -0,0 +1,132 @@
+import os
+import threading
+
+import numpy as np
+
+
+def _flattenBatch(batch, arrays):
+    """
+        Appends the arrays of 'batch' (a NumPy array or a list/tuple of them, possibly nested) to 'arrays' and
+        returns its structure, with each array replaced by its position in 'arrays'. Returns None if the batch
+        contains anything else.
+    """
+    if(isinstance(batch, np.ndarray)):
+        arrays.append(batch)
+        return len(arrays)-1
+    if(isinstance(batch, (list, tuple))):
+        structure = []
+        for b in batch:
+            s = _flattenBatch(b, arrays)
+            if(s is None):
+                return None
+            structure.append(s)
+        return structure if isinstance(batch, list) else tuple(structure)
+    return None
+
+
+def _unflattenBatch(structure, arrays):
+    if(isinstance(structure, list)):
+        return [_unflattenBatch(s, arrays) for s in structure]
+    if(isinstance(structure, tuple)):
+        return tuple([_unflattenBatch(s, arrays) for s in structure])
+    return arrays[structure]
+
+
+def _sameSettings(first, second):
+    """
+        Compares two (nested) lists of settings. The NumPy arrays (e.g. training means) are compared by identity.
+    """
+    if(isinstance(first, np.ndarray) or isinstance(second, np.ndarray)):
+        return first is second
+    if(isinstance(first, (list, tuple)) and isinstance(second, (list, tuple))):
+        return len(first) == len(second) and all([_sameSettings(f, s) for f, s in zip(first, second)])
+    return first == second
+
+
+class BatchCache(object):
+    """
+        Keeps the preprocessed batches of a set split read without data augmentation (e.g. for validation or test),
+        so that later evaluation rounds do not read and preprocess them again. Each batch is a list of NumPy arrays
+        (or of nested lists/tuples of them). The batches are kept in RAM while their total size is below max_bytes,
+        the next ones are stored as .npy files in spill_path and memory-mapped (or not cached if it is None).
+        All the batches are discarded when the settings they were built with change (see validate()).
+    """
+
+    def __init__(self, max_bytes=2**30, spill_path=None):
+        """
+            :param max_bytes: maximum size (in bytes) of the batches kept in RAM
+            :param spill_path: folder where the batches that do not fit in RAM are stored
+        """
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self.n_bytes = 0
+        self.__batches = dict()
+        self.__settings = None
+        self.__spilled_files = []
+        self.__lock = threading.Lock()
+
+    def validate(self, settings):
+        """
+            Discards all the batches if 'settings' (a list with everything the batches depend on, such as the
+            normalization and the training means) are not the ones of the cached batches.
+        """
+        with self.__lock:
+            if(self.__settings is None or not _sameSettings(settings, self.__settings)):
+                self.__clear()
+                self.__settings = settings
+
+    def get(self, key):
+        """
+            Returns the batch 'key' or None if it is not cached.
+        """
+        with self.__lock:
+            entry = self.__batches.get(key)
+        if(entry is None):
+            return None
+        return _unflattenBatch(entry[0], entry[1])
+
+    def put(self, key, batch):
+        """
+            Caches 'batch' with the identifier 'key'. Returns False if it was not cached (not enough space or
+            not made only of arrays).
+        """
+        arrays = []
+        structure = _flattenBatch(batch, arrays)
+        if(structure is None):
+            return False
+        n_bytes = sum([a.nbytes for a in arrays])
+
+        with self.__lock:
+            if(key in self.__batches):
+                return True
+            if(self.n_bytes + n_bytes <= self.max_bytes):
+                self.n_bytes += n_bytes
+            elif(self.spill_path is not None):
+                if(not os.path.isdir(self.spill_path)):
+                    os.makedirs(self.spill_path)
+                spilled = []
+                for a in arrays:
+                    file_path = self.spill_path+'/batch_'+str(len(self.__spilled_files))+'.npy'
+                    np.save(file_path, a)
+                    self.__spilled_files.append(file_path)
+                    spilled.append(np.load(file_path, mmap_mode='r'))
+                arrays = spilled
+            else:
+                return False
+            self.__batches[key] = (structure, arrays)
+        return True
+
+    def clear(self):
+        """
+            Discards all the batches (removing the spilled files).
+        """
+        with self.__lock:
+            self.__clear()
+
+    def __clear(self):
+        self.__batches = dict()
+        self.n_bytes = 0
+        for file_path in self.__spilled_files:
+            if(os.path.isfile(file_path)):
+                os.remove(file_path)
+        self.__spilled_files = []
@@ -38,6 +38,23 @@ class StoreModelWeightsOnEpochEnd(KerasCallback):
             self.store_function(self.model_to_save, epoch+self.reload_epoch)
 ###
 
+###
+# Data loading callbacks
+###
+class ReleaseBatchOnBatchEnd(KerasCallback):
+    def __init__(self, batch_generator):
+        """
+        In:
+            batch_generator - Data_Batch_Generator (with prefetch_buffers > 0) providing the training batches,
+                              whose buffers are recycled once the model has been trained on each batch
+        """
+        super(KerasCallback, self).__init__()
+        self.batch_generator = batch_generator
+
+    def on_batch_end(self, batch, logs={}):
+        self.batch_generator.releaseBatch()
+###
+
 ###
 # Printing callbacks
 ###
@@ -1,5 +1,6 @@
 from keras_wrapper.thread_loader import ThreadDataLoader, retrieveXY
-from keras_wrapper.dataset import Dataset, Data_Batch_Generator, Homogeneous_Data_Batch_Generator
+from keras_wrapper.dataset import Dataset, Data_Batch_Generator, Homogeneous_Data_Batch_Generator, Bucketed_Data_Batch_Generator
+from keras_wrapper.process_loader import ProcessDataLoader
 from keras_wrapper.ecoc_classifier import ECOC_Classifier
 from keras_wrapper.callbacks_keras_wrapper import *
 
@@ -189,13 +190,15 @@ class CNN_Model(object):
         self.acc_output = acc_output
 
 
-    def setOptimizer(self, lr=None, momentum=None, loss=None, metrics=None):
+    def setOptimizer(self, lr=None, momentum=None, loss=None, metrics=None, dataset=None):
         """
             Sets a new optimizer for the CNN model.
 
             :param lr: learning rate of the network
             :param momentum: momentum of the network (if None, then momentum = 1-lr)
             :param loss: loss function applied for optimization
+            :param dataset: if provided, the loss 'categorical_crossentropy' of the outputs mapped to dataset outputs
+                            with sparse targets (see Dataset.setOutput()) is replaced by 'sparse_categorical_crossentropy'
         """
         # Pick default parameters
         if(lr is None):
@@ -210,6 +213,9 @@ class CNN_Model(object):
             loss = self.loss
         else:
             self.loss = loss
+        if(dataset is not None):
+            loss = self.__sparseLoss(loss, dataset)
+            self.loss = loss
         if(metrics is None):
             metrics = []
 
@@ -237,6 +243,38 @@ class CNN_Model(object):
             logging.info("Optimizer updated, learning rate set to "+ str(lr))
 
 
+    def __sparseLoss(self, loss, dataset):
+        """
+            Returns 'loss' replacing 'categorical_crossentropy' by 'sparse_categorical_crossentropy' for the
+            model outputs mapped to dataset outputs with sparse targets (the mapping holds the positions of the
+            outputs in dataset.ids_outputs, while dataset.sparse_targets is indexed by their ids).
+        """
+        if(not hasattr(self, 'outputsMapping')):
+            raise Exception('The outputs mapping must be set with setOutputsMapping() before choosing the loss from a dataset.')
+        sparse_outputs = [out_model for out_model, out_ds in self.outputsMapping.iteritems()
+                          if dataset.sparse_targets.get(dataset.ids_outputs[out_ds], False)]
+        if(not sparse_outputs):
+            return loss
+        
+        if(isinstance(self.model, Sequential)):
+            if(loss == 'categorical_crossentropy'):
+                return 'sparse_categorical_crossentropy'
+            return loss
+        
+        if(not isinstance(loss, dict)):
+            if(isinstance(self.model, Graph)):
+                out_names = self.model.output_order
+            else:
+                out_names = self.model.output_names
+            loss = dict([(out, loss) for out in out_names])
+        else:
+            loss = dict(loss)
+        for out in sparse_outputs:
+            if(loss.get(out) == 'categorical_crossentropy'):
+                loss[out] = 'sparse_categorical_crossentropy'
+        return loss
+
+
     def setName(self, model_name, plots_path=None, models_path=None, clear_dirs=True):
         """
             Changes the name (identifier) of the CNN_Model instance.
@@ -453,9 +491,22 @@ class CNN_Model(object):
             ####    Data processing parameters
 
             :param n_parallel_loaders: number of parallel data loaders allowed to work at the same time
+            :param loader_backend: 'threads' (batches built by the data loaders) or 'processes' (batches built by a pool of processes)
+            :param n_workers: number of processes used when loader_backend == 'processes' (None for one per CPU core)
+            :param prefetch_buffers: if > 0 (only for loader_backend == 'threads' without homogeneous_batches), number of
+                                     training batches built ahead into recycled arrays, which are reused once the model
+                                     has been trained on them
             :param normalize_images: boolean indicating if we want to 0-1 normalize the image pixel values
             :param mean_substraction: boolean indicating if we want to substract the training mean
             :param data_augmentation: boolean indicating if we want to perform data augmentation (always False on validation)
+            :param homogeneous_batches: boolean indicating if the training batches are formed by samples with the same text length
+            :param bucket_boundaries: if not None and homogeneous_batches == True, the batches are formed by samples with similar
+                                      lengths (see Bucketed_Data_Batch_Generator): list with the maximum length of each bucket or 'auto'
+            :param padding_tolerance: maximum proportion of padding in each bucket when bucket_boundaries == 'auto'
+            :param rank: index (from 0 to world_size-1) of this training process
+            :param world_size: number of training processes. Each one is trained on a disjoint shard of every epoch
+                               with the same number of batches (the validation is not sharded, so all the processes
+                               take the same decisions from it)
 
             ####    Other parameters
 
@@ -465,8 +516,10 @@ class CNN_Model(object):
         # Check input parameters and recover default values if needed
 
         default_params = {'n_epochs': 1, 'batch_size': 50, 'lr_decay': 1, 'lr_gamma':0.1, 'maxlen':100,
-                          'homogeneous_batches': False, 'epochs_for_save': 1, 'num_iterations_val': None,
+                          'homogeneous_batches': False, 'bucket_boundaries': None, 'padding_tolerance': 0.2, 'epochs_for_save': 1, 'num_iterations_val': None,
                           'n_parallel_loaders': 8, 'normalize_images': False, 'mean_substraction': True,
+                          'loader_backend': 'threads', 'n_workers': None, 'prefetch_buffers': 0,
+                          'rank': 0, 'world_size': 1,
                           'data_augmentation': True,'verbose': 1, 'eval_on_sets': ['val'],
                           'reload_epoch': 0, 'extra_callbacks': [], 'epoch_offset': 0};
 
@@ -515,7 +568,7 @@ class CNN_Model(object):
         logging.info("Training parameters: "+ str(params))
 
         # initialize state
-        state['samples_per_epoch'] = ds.len_train
+        state['samples_per_epoch'] = int(math.ceil(float(ds.len_train)/params['world_size']))
         state['n_iterations_per_epoch'] = int(math.ceil(float(state['samples_per_epoch'])/params['batch_size']))
 
         # Prepare callbacks
@@ -530,18 +583,45 @@ class CNN_Model(object):
         callbacks += params['extra_callbacks']
 
         # Prepare data generators
-        if params['homogeneous_batches']:
+        if(params['homogeneous_batches'] and params['prefetch_buffers'] > 0):
+            raise NotImplementedError('The batches can only be built into recycled buffers (prefetch_buffers > 0) without homogeneous_batches.')
+        # A single pool of processes is shared by the training and validation generators. It is started
+        # before the training threads, which could hold locks (e.g. of the dataset) when forking.
+        process_loader = None
+        if(params['loader_backend'] == 'processes' and
+           (not params['homogeneous_batches'] or 'val' in params['eval_on_sets'])):
+            process_loader = ProcessDataLoader(ds, params['n_workers'])
+        if params['homogeneous_batches'] and params['bucket_boundaries'] is not None:
+            train_gen = Bucketed_Data_Batch_Generator('train', self, ds, state['n_iterations_per_epoch'],
+                                             batch_size=params['batch_size'], maxlen=params['maxlen'],
+                                             normalize_images=params['normalize_images'],
+                                             data_augmentation=params['data_augmentation'],
+                                             mean_substraction=params['mean_substraction'],
+                                             bucket_boundaries=params['bucket_boundaries'],
+                                             padding_tolerance=params['padding_tolerance'],
+                                             rank=params['rank'], world_size=params['world_size']).generator()
+        elif params['homogeneous_batches']:
             train_gen = Homogeneous_Data_Batch_Generator('train', self, ds, state['n_iterations_per_epoch'],
                                              batch_size=params['batch_size'], maxlen=params['maxlen'],
                                              normalize_images=params['normalize_images'],
                                              data_augmentation=params['data_augmentation'],
-                                             mean_substraction=params['mean_substraction']).generator()
+                                             mean_substraction=params['mean_substraction'],
+                                             rank=params['rank'], world_size=params['world_size']).generator()
         else:
-            train_gen = Data_Batch_Generator('train', self, ds, state['n_iterations_per_epoch'],
+            train_data_gen = Data_Batch_Generator('train', self, ds, state['n_iterations_per_epoch'],
                                              batch_size=params['batch_size'],
                                              normalize_images=params['normalize_images'],
                                              data_augmentation=params['data_augmentation'],
-                                             mean_substraction=params['mean_substraction']).generator()
+                                             mean_substraction=params['mean_substraction'],
+                                             loader_backend=params['loader_backend'],
+                                             n_workers=params['n_workers'],
+                                             prefetch_buffers=params['prefetch_buffers'],
+                                             rank=params['rank'], world_size=params['world_size'],
+                                             loader=process_loader)
+            train_gen = train_data_gen.generator()
+            if(params['prefetch_buffers'] > 0):
+                # the buffers of each batch are recycled once the model has been trained on it
+                callbacks.append(ReleaseBatchOnBatchEnd(train_data_gen))
         # Are we going to validate on 'val' data?
         if('val' in params['eval_on_sets']):
 
@@ -555,21 +635,28 @@ class CNN_Model(object):
                                          batch_size=params['batch_size'],
                                          normalize_images=params['normalize_images'],
                                          data_augmentation=False,
-                                         mean_substraction=params['mean_substraction']).generator()
+                                         mean_substraction=params['mean_substraction'],
+                                         loader_backend=params['loader_backend'],
+                                         n_workers=params['n_workers'],
+                                         loader=process_loader).generator()
         else:
             val_gen = None
             n_valid_samples = None
 
         # Train model
-        self.model.fit_generator(train_gen,
-                                 validation_data=val_gen,
-                                 nb_val_samples=n_valid_samples,
-                                 samples_per_epoch=state['samples_per_epoch'],
-                                 nb_epoch=params['n_epochs'],
-                                 max_q_size=params['n_parallel_loaders'],
-                                 verbose=params['verbose'],
-                                 callbacks=callbacks,
-                                 epoch_offset=params['epoch_offset'])
+        try:
+            self.model.fit_generator(train_gen,
+                                     validation_data=val_gen,
+                                     nb_val_samples=n_valid_samples,
+                                     samples_per_epoch=state['samples_per_epoch'],
+                                     nb_epoch=params['n_epochs'],
+                                     max_q_size=params['n_parallel_loaders'],
+                                     verbose=params['verbose'],
+                                     callbacks=callbacks,
+                                     epoch_offset=params['epoch_offset'])
+        finally:
+            if(process_loader is not None):
+                process_loader.close()
 
 
     def __train_deprecated(self, ds, params, state=dict(), out_name=None):
@@ -813,7 +900,7 @@ class CNN_Model(object):
 
         # Check input parameters and recover default values if needed
         default_params = {'batch_size': 50, 'n_parallel_loaders': 8, 'normalize_images': False,
-                          'mean_substraction': True};
+                          'mean_substraction': True, 'loader_backend': 'threads', 'n_workers': None};
         params = self.checkParameters(parameters, default_params)
         self.testing_parameters.append(copy.copy(params))
 
@@ -829,7 +916,9 @@ class CNN_Model(object):
                                          batch_size=params['batch_size'],
                                          normalize_images=params['normalize_images'],
                                          data_augmentation=False,
-                                         mean_substraction=params['mean_substraction']).generator()
+                                         mean_substraction=params['mean_substraction'],
+                                         loader_backend=params['loader_backend'],
+                                         n_workers=params['n_workers']).generator()
 
         out = self.model.evaluate_generator(data_gen,
                                       val_samples=n_samples,
@@ -1091,7 +1180,7 @@ class CNN_Model(object):
 
             # Calculate how many interations are we going to perform
             if params['n_samples'] < 1:
-                n_samples = eval("ds.len_"+s)
+                n_samples = ds.splits[s].len
                 num_iterations = int(math.ceil(float(n_samples)/params['batch_size']))
 
                 # Prepare data generator: We won't use an Homogeneous_Data_Batch_Generator here
@@ -1170,6 +1259,8 @@ class CNN_Model(object):
 
             :param batch_size: size of the batch
             :param n_parallel_loaders: number of parallel data batch loaders
+            :param loader_backend: 'threads' (batches built by the data loaders) or 'processes' (batches built by a pool of processes)
+            :param n_workers: number of processes used when loader_backend == 'processes' (None for one per CPU core)
             :param normalize_images: apply data normalization on images/features or not (only if using images/features as input)
             :param mean_substraction: apply mean data normalization on images or not (only if using images as input)
             :param predict_on_sets: list of set splits for which we want to extract the predictions ['train', 'val', 'test']
@@ -1180,6 +1271,7 @@ class CNN_Model(object):
         # Check input parameters and recover default values if needed
         default_params = {'batch_size': 50, 'n_parallel_loaders': 8,
                           'normalize_images': False, 'mean_substraction': True, 'n_samples':None,
+                          'loader_backend': 'threads', 'n_workers': None,
                           'predict_on_sets': ['val']}
         params = self.checkParameters(parameters, default_params)
 
@@ -1191,7 +1283,7 @@ class CNN_Model(object):
 
             # Calculate how many interations are we going to perform
             if default_params['n_samples'] is None:
-                n_samples = eval("ds.len_"+s)
+                n_samples = ds.splits[s].len
             else:
                 n_samples = default_params['n_samples']
 
@@ -1202,7 +1294,9 @@ class CNN_Model(object):
                                      normalize_images=params['normalize_images'],
                                      data_augmentation=False,
                                      mean_substraction=params['mean_substraction'],
-                                     predict=True).generator()
+                                     predict=True,
+                                     loader_backend=params['loader_backend'],
+                                     n_workers=params['n_workers']).generator()
 
             # Predict on model
             out = self.model.predict_generator(data_gen,
@@ -1248,13 +1342,18 @@ class CNN_Model(object):
         return predictions
 
 
-    def prepareData(self, X_batch, Y_batch=None):
+    def prepareData(self, X_batch, Y_batch=None, buffers=None):
+        """
+            Formats the batch [X_batch, Y_batch] returned by the Dataset as the model inputs and outputs.
+            
+            :param buffers: BatchBuffers of the batch (see PrefetchDataLoader), whose dictionaries are reused
+        """
         if(isinstance(self.model, Sequential)):
             data = self._prepareSequentialData(X_batch, Y_batch)
         elif(isinstance(self.model, Model)):
-            data = self._prepareModelData(X_batch, Y_batch)
+            data = self._prepareModelData(X_batch, Y_batch, buffers=buffers)
         elif(isinstance(self.model, Graph)):
-            [data, Y_batch] = self._prepareGraphData(X_batch, Y_batch)
+            [data, Y_batch] = self._prepareGraphData(X_batch, Y_batch, buffers=buffers)
         else:
             raise NotImplementedError
         return data
@@ -1294,10 +1393,15 @@ class CNN_Model(object):
         return [X, Y] if Y_sample_weights is None else [X, Y, Y_sample_weights]
 
 
-    def _prepareModelData(self, X, Y=None):
-        X_new = dict()
-        Y_new = dict()
-        Y_sample_weights = dict()
+    def _prepareModelData(self, X, Y=None, buffers=None):
+        if(buffers is None):
+            X_new = dict()
+            Y_new = dict()
+            Y_sample_weights = dict()
+        else:
+            X_new = buffers.dict('X')
+            Y_new = buffers.dict('Y')
+            Y_sample_weights = buffers.dict('sample_weights')
 
         # Format input data
         for in_model, in_ds in self.inputsMapping.iteritems():
@@ -1315,10 +1419,14 @@ class CNN_Model(object):
         return [X_new, Y_new] if Y_sample_weights == dict() else [X_new, Y_new, Y_sample_weights]
 
 
-    def _prepareGraphData(self, X, Y=None):
+    def _prepareGraphData(self, X, Y=None, buffers=None):
 
-        data = dict()
-        data_sample_weight = dict()
+        if(buffers is None):
+            data = dict()
+            data_sample_weight = dict()
+        else:
+            data = buffers.dict('data')
+            data_sample_weight = buffers.dict('sample_weights')
         any_sample_weight = False
         last_out = self.acc_output
 
@@ -0,0 +1,298 @@
+import mmap
+import operator
+import os
+
+import numpy as np
+
+
+class PackedStrings(object):
+    """
+        Read-only list of strings stored in two NumPy arrays: the bytes of all the strings concatenated
+        ('data', uint8) and the position where each string starts ('offsets', int64, with an extra final position).
+        Both arrays can be memory-mapped, so the strings are only materialized when they are accessed.
+    """
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @staticmethod
+    def fromList(strings):
+        """
+            Packs a list of strings.
+        """
+        offsets = np.zeros(len(strings)+1, dtype=np.int64)
+        np.cumsum([len(s) for s in strings], out=offsets[1:])
+        data = np.fromstring(''.join(strings), dtype=np.uint8)
+        return PackedStrings(offsets, data)
+
+    @staticmethod
+    def load(file_prefix, mmap_mode='r'):
+        """
+            Loads the strings stored by save(file_prefix).
+        """
+        return PackedStrings(np.load(file_prefix+'_offsets.npy', mmap_mode=mmap_mode),
+                             np.load(file_prefix+'_bytes.npy', mmap_mode=mmap_mode))
+
+    def save(self, file_prefix):
+        np.save(file_prefix+'_offsets.npy', self.offsets)
+        np.save(file_prefix+'_bytes.npy', self.data)
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self, i):
+        if(isinstance(i, slice)):
+            start, stop, step = i.indices(len(self))
+            if(step != 1):
+                return [self[j] for j in xrange(start, stop, step)]
+            if(start >= stop):
+                return []
+            # Read all the consecutive strings at once
+            offsets = self.offsets[start:stop+1] - self.offsets[start]
+            chunk = self.data[self.offsets[start]:self.offsets[stop]].tostring()
+            return [chunk[offsets[j]:offsets[j+1]] for j in xrange(stop-start)]
+        i = int(i)
+        if(i < 0):
+            i += len(self)
+        if(i < 0 or i >= len(self)):
+            raise IndexError('PackedStrings index out of range')
+        return self.data[self.offsets[i]:self.offsets[i+1]].tostring()
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def take(self, indices):
+        """
+            Returns a new PackedStrings with the strings in positions 'indices'.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices+1] - starts
+        offsets = np.zeros(len(indices)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Position in self.data of each byte of the selected strings
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1], dtype=np.int64)
+        return PackedStrings(offsets, self.data[positions])
+
+
+class LineFile(object):
+    """
+        Read-only list of the lines (without the line break) of a text file, which are read from disk when accessed.
+        The position of each line in the file is stored in 'starts' and 'ends' (int64 arrays, which can be
+        memory-mapped), so the samples can be any selection of the lines of the file.
+        The file is memory-mapped, so random accesses only read the pages needed.
+    """
+
+    def __init__(self, path, starts, ends):
+        self.path = path
+        self.starts = starts
+        self.ends = ends
+        self.__data = None
+
+    @staticmethod
+    def open(path, index_path=None, chunk_size=64*1024*1024):
+        """
+            Indexes the lines of the file 'path'. If 'index_path' is given, the index is stored in it (or
+            reused if it is newer than the file) and memory-mapped.
+        """
+        if(index_path is not None and os.path.isfile(index_path) and
+           os.path.getmtime(index_path) >= os.path.getmtime(path)):
+            index = np.load(index_path, mmap_mode='r')
+            return LineFile(path, index[0], index[1])
+        
+        # Find the line breaks reading the file by chunks
+        breaks = []
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            position = 0
+            while position < size:
+                chunk = np.fromstring(f.read(chunk_size), dtype=np.uint8)
+                breaks.append(np.flatnonzero(chunk == ord('\n')) + position)
+                position += len(chunk)
+        ends = np.concatenate(breaks) if breaks else np.zeros(0, dtype=np.int64)
+        if(size > 0 and (len(ends) == 0 or ends[-1] != size-1)): # last line without line break
+            ends = np.append(ends, size)
+        starts = np.zeros(len(ends), dtype=np.int64)
+        starts[1:] = ends[:-1] + 1
+        
+        if(index_path is not None):
+            np.save(index_path, np.array([starts, ends], dtype=np.int64))
+            index = np.load(index_path, mmap_mode='r')
+            return LineFile(path, index[0], index[1])
+        return LineFile(path, starts, ends.astype(np.int64))
+
+    def __getData(self):
+        if(self.__data is None):
+            with open(self.path, 'rb') as f:
+                self.__data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.__data
+
+    def __getstate__(self):
+        obj_dict = self.__dict__.copy()
+        obj_dict['_LineFile__data'] = None
+        return obj_dict
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if(isinstance(i, slice)):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        i = int(i)
+        if(i < 0):
+            i += len(self)
+        if(i < 0 or i >= len(self)):
+            raise IndexError('LineFile index out of range')
+        return self.__getData()[self.starts[i]:self.ends[i]]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def take(self, indices):
+        """
+            Returns a new LineFile with the lines in positions 'indices'.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        return LineFile(self.path, self.starts[indices], self.ends[indices])
+
+
+class RepeatedColumn(object):
+    """
+        Read-only list of samples where each sample of a base column can appear several times (e.g. the inputs
+        loaded with repeat_set > 1): the sample in position i is column[sources[i]], so the repeated samples
+        are not duplicated. 'sources' is an int64 array (which can be memory-mapped).
+    """
+
+    def __init__(self, column, sources):
+        self.column = column
+        self.sources = sources
+
+    @staticmethod
+    def repeat(column, repeats):
+        """
+            Returns the samples of 'column' repeated like numpy.repeat(column, repeats).
+        """
+        return RepeatedColumn(column, np.repeat(np.arange(len(column), dtype=np.int64), repeats))
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __getitem__(self, i):
+        if(isinstance(i, slice)):
+            samples = takeSamples(self.column, self.sources[i])
+            return samples if isinstance(samples, (np.ndarray, list)) else list(samples)
+        return self.column[self.sources[i]]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def take(self, indices):
+        """
+            Returns a new RepeatedColumn with the samples in positions 'indices'.
+        """
+        return RepeatedColumn(self.column, self.sources[np.asarray(indices, dtype=np.int64)])
+
+
+def toColumn(values, storage='list'):
+    """
+        Converts a list of samples into the column storage 'storage':
+        
+            'list': Python list.
+            'packed': PackedStrings for strings and numpy.ndarray for numbers.
+            'array': numpy.ndarray (with fixed-width byte strings for strings).
+            'stream': LineFile (the samples are read from the list file when accessed).
+            
+        The 'packed' and 'array' storages avoid keeping millions of Python objects per column
+        (and their copy-on-write duplication in forked processes).
+        A RepeatedColumn keeps its repetitions, with its base column converted into 'storage'.
+    """
+    if(isinstance(values, RepeatedColumn)):
+        return RepeatedColumn(toColumn(values.column, storage), values.sources)
+    if(storage == 'stream' or isinstance(values, LineFile)):
+        if(not isinstance(values, LineFile)):
+            raise Exception('Only the samples loaded from a list file can be stored with the "stream" storage.')
+        return values
+    if(storage == 'list' or len(values) == 0):
+        return values if isinstance(values, list) else list(values)
+    elif(storage == 'packed'):
+        packed = packColumn(values)
+        if(packed is None):
+            raise Exception('The samples can not be stored with the "packed" storage.')
+        return packed[1]
+    elif(storage == 'array'):
+        if(isinstance(values, PackedStrings)):
+            values = list(values)
+        column = np.asarray(values)
+        if(column.dtype == object or column.dtype.kind == 'U'):
+            raise Exception('The samples can not be stored with the "array" storage.')
+        return column
+    else:
+        raise NotImplementedError('The column storage "'+ storage +'" is not implemented. Valid storages are "list", "packed", "array" and "stream".')
+
+
+def takeSamples(column, indices):
+    """
+        Returns the samples of 'column' in positions 'indices' keeping its storage type.
+    """
+    if(isinstance(column, np.ndarray)):
+        return np.take(column, indices, axis=0)
+    elif(isinstance(column, (PackedStrings, LineFile, RepeatedColumn))):
+        return column.take(indices)
+    indices = np.asarray(indices).tolist()
+    if(len(indices) < 2): # itemgetter returns a single sample instead of a tuple
+        return [column[i] for i in indices]
+    return list(operator.itemgetter(*indices)(column))
+
+
+def packColumn(values):
+    """
+        Converts a column of samples into its columnar representation.
+        Returns [kind, column] with kind 'strings' (PackedStrings) or 'array' (numpy.ndarray),
+        or None if the column can not be stored as an array. The kind of a RepeatedColumn is the one of its base
+        column prefixed by 'repeated_'.
+    """
+    if(isinstance(values, RepeatedColumn)):
+        packed = packColumn(values.column)
+        if(packed is None):
+            return None
+        return ['repeated_'+packed[0], RepeatedColumn(packed[1], values.sources)]
+    if(isinstance(values, PackedStrings)):
+        return ['strings', values]
+    if(isinstance(values, np.ndarray)):
+        return ['array', values] if values.dtype != object else None
+    if(not isinstance(values, list) or len(values) == 0):
+        return None
+    if(all(isinstance(v, str) for v in values)):
+        return ['strings', PackedStrings.fromList(values)]
+    if(any(isinstance(v, basestring) for v in values)):
+        return None
+    try:
+        array = np.asarray(values)
+    except ValueError:
+        return None
+    if(array.dtype == object):
+        return None
+    return ['array', array]
+
+
+def saveColumn(kind, column, file_prefix):
+    if(kind.startswith('repeated_')):
+        saveColumn(kind[len('repeated_'):], column.column, file_prefix)
+        np.save(file_prefix+'_sources.npy', column.sources)
+    elif(kind == 'strings'):
+        column.save(file_prefix)
+    else:
+        np.save(file_prefix+'.npy', column)
+
+
+def loadColumn(kind, file_prefix, mmap_mode='r'):
+    if(kind.startswith('repeated_')):
+        return RepeatedColumn(loadColumn(kind[len('repeated_'):], file_prefix, mmap_mode),
+                              np.load(file_prefix+'_sources.npy', mmap_mode=mmap_mode))
+    if(kind == 'strings'):
+        return PackedStrings.load(file_prefix, mmap_mode)
+    return np.load(file_prefix+'.npy', mmap_mode=mmap_mode)
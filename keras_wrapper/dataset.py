@@ -1,6 +1,10 @@
 # coding=utf-8
 
 from keras.utils import np_utils, generic_utils
+from keras_wrapper.process_loader import ProcessDataLoader, tokenizeSentences, sumImages
+from keras_wrapper.data_columns import LineFile, RepeatedColumn, toColumn, takeSamples, packColumn, saveColumn, loadColumn
+from keras_wrapper.prefetch_loader import PrefetchDataLoader, batchArray
+from keras_wrapper.batch_cache import BatchCache
 import sys
 import random
 import math
@@ -8,16 +12,23 @@ import os
 import copy
 import ntpath
 import fnmatch
+import mmap
+from cStringIO import StringIO
 from multiprocessing import Pool
 import time
+import hashlib
+import itertools
+import multiprocessing
 import threading
 import logging
 import re
-from collections import Counter
+import string
+from collections import Counter, OrderedDict
 from operator import add
 
 import cPickle as pk
 from scipy import misc
+from PIL import Image
 import numpy as np
 
 
@@ -32,32 +43,137 @@ def create_dir_if_not_exists(directory):
         os.makedirs(directory)
 
 
-def saveDataset(dataset, store_path):
+def saveDataset(dataset, store_path, format='pickle'):
     """
         Saves a backup of the current Dataset object.
+        
+        :param format: 'pickle' stores the whole instance in the file 'Dataset_<name>.pkl'.
+                       'columnar' stores it in the folder 'Dataset_<name>', with a small pickled header for the
+                       configuration and a NumPy array for each data column (see loadDataset()).
     """
     create_dir_if_not_exists(store_path)
-    store_path = store_path + '/Dataset_'+ dataset.name +'.pkl'
+    if(format == 'columnar'):
+        store_path = store_path + '/Dataset_'+ dataset.name
+    elif(format == 'pickle'):
+        store_path = store_path + '/Dataset_'+ dataset.name +'.pkl'
+    else:
+        raise NotImplementedError('The Dataset format "'+ format +'" is not implemented. Valid formats are "pickle" and "columnar".')
     if(not dataset.silence):
         logging.info("<<< Saving Dataset instance to "+ store_path +" ... >>>")
     
-    pk.dump(dataset, open(store_path, 'wb'))
+    if(format == 'columnar'):
+        create_dir_if_not_exists(store_path)
+        obj_dict = dataset.__getstate__()
+        # Copy the dictionaries holding the data columns, which are replaced by None in the header
+        for key_path in _dataColumnsPaths(obj_dict):
+            for level in range(1, len(key_path)):
+                _setByPath(obj_dict, key_path[:level], dict(_getByPath(obj_dict, key_path[:level])))
+        columns = []
+        for key_path in _dataColumnsPaths(obj_dict):
+            packed = packColumn(_getByPath(obj_dict, key_path))
+            if(packed is not None):
+                saveColumn(packed[0], packed[1], store_path+'/column_'+str(len(columns)))
+                columns.append([key_path, packed[0]])
+                _setByPath(obj_dict, key_path, None)
+        header = {'format_version': 1, 'attributes': obj_dict, 'columns': columns}
+        pk.dump(header, open(store_path+'/header.pkl', 'wb'), protocol=pk.HIGHEST_PROTOCOL)
+    else:
+        pk.dump(dataset, open(store_path, 'wb'))
     
     if(not dataset.silence):
         logging.info("<<< Dataset instance saved >>>")
 
 
-def loadDataset(dataset_path):
+def loadDataset(dataset_path, mmap_mode='r'):
     """
         Loads a previously saved Dataset object.
+        
+        :param dataset_path: path to a .pkl file or to a folder stored with saveDataset(format='columnar').
+        :param mmap_mode: (only for the 'columnar' format) memory-mapping mode used for loading the data columns,
+                          if None they are read into memory.
     """
     logging.info("<<< Loading Dataset instance from "+ dataset_path +" ... >>>")
     
-    dataset = pk.load(open(dataset_path, 'rb'))
+    if(os.path.isdir(dataset_path)):
+        header = pk.load(open(dataset_path+'/header.pkl', 'rb'))
+        obj_dict = header['attributes']
+        for i, (key_path, kind) in enumerate(header['columns']):
+            _setByPath(obj_dict, key_path, loadColumn(kind, dataset_path+'/column_'+str(i), mmap_mode))
+        dataset = Dataset.__new__(Dataset)
+        dataset.__setstate__(obj_dict)
+    else:
+        dataset = pk.load(open(dataset_path, 'rb'))
     
     logging.info("<<< Dataset instance loaded >>>")
     return dataset
 
+
+def _permutation(n_samples, seed=None, chunk_size=None):
+    """
+        Returns a random permutation of n_samples positions. If chunk_size is given, the chunks of chunk_size
+        consecutive positions are shuffled and then the positions inside each chunk, so consecutive positions
+        of the permutation are close in the stored order.
+    """
+    random_state = np.random if seed is None else np.random.RandomState(seed)
+    if(chunk_size is None or chunk_size >= n_samples):
+        return random_state.permutation(n_samples)
+    chunks = random_state.permutation(int(math.ceil(float(n_samples)/chunk_size)))
+    return np.lexsort((random_state.random_sample(n_samples), chunks[np.arange(n_samples) // chunk_size]))
+
+
+def _shard(order, rank, world_size):
+    """
+        Returns the positions of 'order' assigned to 'rank' out of 'world_size' processes: a contiguous block of
+        the order (the sizes of the blocks differ at most by one), completed with its first position up to
+        ceil(len(order)/world_size) positions so that all the ranks get the same number of samples.
+    """
+    n_samples = len(order)
+    if(n_samples == 0):
+        return order
+    per_rank = int(math.ceil(float(n_samples)/world_size))
+    block = order[rank*n_samples // world_size:(rank+1)*n_samples // world_size]
+    if(len(block) == 0): # less samples than processes
+        block = order[rank % n_samples:rank % n_samples + 1]
+    return block[np.arange(per_rank) % len(block)]
+
+
+def _checkRank(rank, world_size):
+    if(world_size < 1 or rank < 0 or rank >= world_size):
+        raise Exception('"rank" must be between 0 and world_size-1 (got rank='+str(rank)+', world_size='+str(world_size)+').')
+
+
+def _dataColumnsPaths(obj_dict):
+    """
+        Returns the key paths (in the attributes dict of a Dataset) of all the data columns stored with one
+        sample per position.
+    """
+    paths = []
+    for set_name in ['train', 'val', 'test']:
+        for prefix in ['X_', 'Y_']:
+            for id in obj_dict[prefix+set_name].keys():
+                paths.append((prefix+set_name, id))
+    for attr in ['paths_frames', 'counts_frames', 'first_frames']:
+        for id in obj_dict[attr].keys():
+            for set_name in obj_dict[attr][id].keys():
+                paths.append((attr, id, set_name))
+    for id in obj_dict.get('text_encoded', {}).keys():
+        for set_name in obj_dict['text_encoded'][id].keys():
+            for key in ['tokens', 'starts', 'lengths', 'split_lengths']:
+                paths.append(('text_encoded', id, set_name, key))
+    return paths
+
+
+def _getByPath(obj_dict, key_path):
+    for key in key_path:
+        obj_dict = obj_dict[key]
+    return obj_dict
+
+
+def _setByPath(obj_dict, key_path, value):
+    for key in key_path[:-1]:
+        obj_dict = obj_dict[key]
+    obj_dict[key_path[-1]] = value
+
 # ------------------------------------------------------- #
 #       DATA BATCH GENERATOR CLASS
 # ------------------------------------------------------- #
@@ -69,7 +185,42 @@ class Data_Batch_Generator(object):
                  data_augmentation=True, 
                  mean_substraction=True,
                  predict=False,
-                 random_samples=-1):
+                 random_samples=-1,
+                 loader_backend='threads',
+                 n_workers=None,
+                 shuffle_seed=None,
+                 prefetch_buffers=0,
+                 rank=0,
+                 world_size=1,
+                 loader=None):
+        """
+            :param loader_backend: 'threads' builds each batch in the thread consuming the generator,
+                                   'processes' builds whole batches in a pool of 'n_workers' processes
+            :param n_workers: number of worker processes (only used if loader_backend == 'processes').
+                              If None, one worker per CPU core is started.
+            :param loader: ProcessDataLoader of this dataset shared with other generators (only used if
+                           loader_backend == 'processes'), which is not closed by this generator. If None, the
+                           processes are started by generator(), so it must be called before starting any other
+                           thread (the forked processes would inherit the locks held by them).
+            :param shuffle_seed: if not None, the training samples of the epoch e are shuffled with the seed shuffle_seed+e
+            :param prefetch_buffers: if > 0 (only for loader_backend == 'threads'), the batches are built ahead in a
+                                     background thread into 'prefetch_buffers' sets of recycled arrays
+                                     (see PrefetchDataLoader). The consumer must call releaseBatch() once it is
+                                     done with each batch (e.g. after train_on_batch), its arrays are overwritten later.
+            :param rank: index (from 0 to world_size-1) of the process using this generator
+            :param world_size: number of processes sharing each epoch. Each one gets a disjoint shard of the samples
+                               of the epoch, with the same number of batches (the shards with one sample less are
+                               completed with their first sample). All of them must use the same shuffle_seed (0 if None).
+                               When predict == True the shards are not completed, so the predictions of all the
+                               ranks (in rank order) are the ones of the whole split.
+        """
+        if(loader_backend not in ['threads', 'processes']):
+            raise NotImplementedError('The loader backend "'+ loader_backend +'" is not implemented. Valid backends are "threads" and "processes".')
+        if(prefetch_buffers > 0 and loader_backend != 'threads'):
+            raise NotImplementedError('The batches can only be built into recycled buffers with the "threads" loader backend.')
+        _checkRank(rank, world_size)
+        if(world_size > 1 and shuffle_seed is None):
+            shuffle_seed = 0 # all the ranks must shuffle the samples in the same way
         
         self.set_split = set_split
         self.dataset = dataset
@@ -81,9 +232,140 @@ class Data_Batch_Generator(object):
                        'mean_substraction': mean_substraction,
                        'normalize_images': normalize_images,
                        'num_iterations': num_iterations,
-                       'random_samples': random_samples}
+                       'random_samples': random_samples,
+                       'loader_backend': loader_backend,
+                       'n_workers': n_workers,
+                       'shuffle_seed': shuffle_seed,
+                       'prefetch_buffers': prefetch_buffers,
+                       'rank': rank,
+                       'world_size': world_size}
+        self.__loader = None
+        self.__process_loader = loader
     
     def generator(self):
+        if(self.params['loader_backend'] == 'processes'):
+            # the processes are forked here, from the thread creating the generator and not the one consuming it
+            if(self.__process_loader is None):
+                return self.__processesGenerator(ProcessDataLoader(self.dataset, self.params['n_workers']), True)
+            return self.__processesGenerator(self.__process_loader, False)
+        batches = self.__shardedGenerator if self.params['world_size'] > 1 else self.__threadsGenerator
+        if(self.params['prefetch_buffers'] > 0):
+            return self.__prefetchGenerator(batches)
+        return batches()
+    
+    def releaseBatch(self):
+        """
+            Hands back the buffers of the oldest batch yielded by the generator and not released yet,
+            which will be reused for building a new batch (only if prefetch_buffers > 0).
+        """
+        self.__loader.release()
+    
+    def __batchTasks(self, data_augmentation):
+        """
+            Yields the arguments of every batch built by the 'processes' backend, following the
+            same batch order as the 'threads' backend (only the batches of the shard of this rank if world_size > 1).
+            The training samples are shuffled here and their indices are positions in the stored order, so the
+            order set by shuffleTraining() (which may differ between processes) is not applied to them.
+        """
+        n_samples_split = self.dataset.splits[self.set_split].len
+        epoch = 0
+        while 1:
+            if self.params['random_samples'] > 0:
+                indices = np.random.randint(0, n_samples_split, self.params['random_samples'])
+                yield (self.set_split, indices, 0, 0, self.params['normalize_images'],
+                       self.params['mean_substraction'], data_augmentation, False)
+                continue
+            
+            # The workers hold a copy of the dataset, so the training samples are shuffled here
+            if(self.set_split == 'train' and not self.predict):
+                if(self.params['shuffle_seed'] is None):
+                    order = _permutation(n_samples_split, chunk_size=self.dataset.shuffle_chunk_size)
+                else:
+                    order = _permutation(n_samples_split, self.params['shuffle_seed']+epoch, self.dataset.shuffle_chunk_size)
+                epoch += 1
+            else:
+                order = np.arange(n_samples_split)
+            
+            # Shard of the epoch processed by this rank (starting at position 'first' of the order)
+            first = 0
+            if(self.params['world_size'] > 1):
+                rank = self.params['rank']
+                world_size = self.params['world_size']
+                if(self.predict):
+                    first = rank*n_samples_split // world_size
+                    order = order[first:(rank+1)*n_samples_split // world_size]
+                else:
+                    order = _shard(order, rank, world_size)
+                if(len(order) == 0):
+                    raise Exception('The set split "'+ self.set_split +'" has less samples than processes.')
+            n_samples_epoch = len(order)
+            
+            for it in range(self.params['num_iterations']):
+                init_sample = it*self.params['batch_size']
+                final_sample = min((it+1)*self.params['batch_size'], n_samples_epoch)
+                yield (self.set_split, order[init_sample:final_sample], first+init_sample, first+final_sample,
+                       self.params['normalize_images'], self.params['mean_substraction'], data_augmentation,
+                       self.predict)
+                if final_sample == n_samples_epoch:
+                    break
+    
+    def __processesGenerator(self, loader, close_loader):
+        
+        if(self.set_split == 'train' and not self.predict):
+            data_augmentation = self.params['data_augmentation']
+        else:
+            data_augmentation = False
+        
+        try:
+            for batch in loader.imap(self.__batchTasks(data_augmentation)):
+                if(self.predict and self.params['random_samples'] == -1):
+                    yield self.net.prepareData(batch, None)[0]
+                else:
+                    X_batch, Y_batch = batch
+                    yield self.net.prepareData(X_batch, Y_batch)
+        finally:
+            if(close_loader):
+                loader.close()
+    
+    def __prefetchGenerator(self, batches):
+        
+        self.__loader = PrefetchDataLoader(batches, self.params['prefetch_buffers'])
+        try:
+            for data in self.__loader:
+                yield data
+        finally:
+            self.__loader.close()
+    
+    def __shardedGenerator(self, acquire=None):
+        """
+            'threads' backend when world_size > 1: builds the batches of the shard of this rank (see __batchTasks()).
+            
+            :param acquire: if not None, function returning the BatchBuffers where each batch is built
+        """
+        
+        if(self.set_split == 'train' and not self.predict):
+            data_augmentation = self.params['data_augmentation']
+        else:
+            data_augmentation = False
+        
+        for task in self.__batchTasks(data_augmentation):
+            [set_split, indices, init, final, normalization, mean_substraction, data_augmentation, predict] = task
+            buffers = None if acquire is None else acquire()
+            if(predict):
+                X_batch = self.dataset.getX(set_split, init, final, normalization=normalization,
+                                            meanSubstraction=mean_substraction, dataAugmentation=False, buffers=buffers)
+                yield self.net.prepareData(X_batch, None, buffers=buffers)[0]
+            else:
+                X_batch, Y_batch = self.dataset.getXY_FromIndices(set_split, indices, normalization=normalization,
+                                                                  meanSubstraction=mean_substraction,
+                                                                  dataAugmentation=data_augmentation, buffers=buffers,
+                                                                  stored_order=True)
+                yield self.net.prepareData(X_batch, Y_batch, buffers=buffers)
+    
+    def __threadsGenerator(self, acquire=None):
+        """
+            :param acquire: if not None, function returning the BatchBuffers where each batch is built
+        """
             
         if(self.set_split == 'train' and not self.predict):
             data_augmentation = self.params['data_augmentation']
@@ -91,12 +373,17 @@ class Data_Batch_Generator(object):
             data_augmentation = False
 
         it = 0
+        epoch = 0
         while 1:
 
             if(self.set_split == 'train' and it%self.params['num_iterations']==0 and not self.predict and self.params['random_samples'] == -1):
                 silence = self.dataset.silence
                 self.dataset.silence = True
-                self.dataset.shuffleTraining()
+                if(self.params['shuffle_seed'] is None):
+                    self.dataset.shuffleTraining()
+                else:
+                    self.dataset.shuffleTraining(seed=self.params['shuffle_seed']+epoch)
+                epoch += 1
                 self.dataset.silence = silence
             if(it%self.params['num_iterations']==0 and self.params['random_samples'] == -1):
                 self.dataset.resetCounters(set_name=self.set_split)
@@ -106,12 +393,14 @@ class Data_Batch_Generator(object):
             init_sample = (it-1)*self.params['batch_size']
             final_sample = it*self.params['batch_size']
             batch_size = self.params['batch_size']
-            n_samples_split = eval("self.dataset.len_"+self.set_split)
+            n_samples_split = self.dataset.splits[self.set_split].len
             if final_sample >= n_samples_split:
                 final_sample = n_samples_split
                 batch_size = final_sample-init_sample
                 it = 0
             
+            buffers = None if acquire is None else acquire()
+            
             # Recovers a batch of data
             if self.params['random_samples'] > 0:
                 # At sampling from train/val, we always have Y
@@ -120,26 +409,38 @@ class Data_Batch_Generator(object):
                 X_batch, Y_batch = self.dataset.getXY_FromIndices(self.set_split, indices,
                                              normalization=self.params['normalize_images'],
                                              meanSubstraction=self.params['mean_substraction'],
-                                             dataAugmentation=data_augmentation)
-                data = self.net.prepareData(X_batch, Y_batch)
+                                             dataAugmentation=data_augmentation, buffers=buffers)
+                data = self.net.prepareData(X_batch, Y_batch, buffers=buffers)
 
 
+            elif(buffers is None and not data_augmentation):
+                # deterministic batches, read from the batch cache of the split if enabled (see Dataset.setBatchCache())
+                if(self.predict):
+                    X_batch = self.dataset.getX_Cached(self.set_split, init_sample, final_sample,
+                                                       normalization=self.params['normalize_images'],
+                                                       meanSubstraction=self.params['mean_substraction'])
+                    data = self.net.prepareData(X_batch, None)[0]
+                else:
+                    X_batch, Y_batch = self.dataset.getXY_Cached(self.set_split, batch_size,
+                                                                 normalization=self.params['normalize_images'],
+                                                                 meanSubstraction=self.params['mean_substraction'])
+                    data = self.net.prepareData(X_batch, Y_batch)
             else:
                 if(self.predict):
                     X_batch = self.dataset.getX(self.set_split, init_sample, final_sample,
                                                  normalization=self.params['normalize_images'],
                                                  meanSubstraction=self.params['mean_substraction'],
-                                                 dataAugmentation=False)
-                    data = self.net.prepareData(X_batch, None)[0]
+                                                 dataAugmentation=False, buffers=buffers)
+                    data = self.net.prepareData(X_batch, None, buffers=buffers)[0]
                 else:
                     X_batch, Y_batch = self.dataset.getXY(self.set_split, batch_size,
                                                  normalization=self.params['normalize_images'],
                                                  meanSubstraction=self.params['mean_substraction'],
-                                                 dataAugmentation=data_augmentation)
+                                                 dataAugmentation=data_augmentation, buffers=buffers)
                     #print 'source words:', [map(lambda x: self.dataset.vocabulary['source_text']['idx2words'][x], seq) for seq in [np.nonzero(sample)[1] for sample in X_batch[0]]]
                     #print 'target words:', [map(lambda x: self.dataset.vocabulary['target_text']['idx2words'][x], seq) for seq in [np.nonzero(sample)[1] for sample in Y_batch[0]]]
                     #print 'Mask:', Y_batch[0][1]
-                    data = self.net.prepareData(X_batch, Y_batch)
+                    data = self.net.prepareData(X_batch, Y_batch, buffers=buffers)
             yield(data)
 
 
@@ -154,8 +455,21 @@ class Homogeneous_Data_Batch_Generator(object):
                  normalize_images=False,
                  data_augmentation=True,
                  mean_substraction=True,
-                 predict=False
+                 predict=False,
+                 shuffle_seed=None,
+                 rank=0,
+                 world_size=1
                  ):
+        """
+            :param shuffle_seed: if not None, seed of the random order of the lengths and samples
+            :param rank: index (from 0 to world_size-1) of the process using this generator
+            :param world_size: number of processes sharing the batches. All of them build the same batches of each pass
+                               over the lengths (with the same shuffle_seed, 0 if None) and each one gets one of every
+                               world_size batches (see epochBatches()).
+        """
+        _checkRank(rank, world_size)
+        if(world_size > 1 and shuffle_seed is None):
+            shuffle_seed = 0 # all the ranks must shuffle the samples in the same way
         self.set_split = set_split
         self.dataset = dataset
         self.net = net
@@ -167,65 +481,79 @@ class Homogeneous_Data_Batch_Generator(object):
                        'mean_substraction': mean_substraction,
                        'normalize_images': normalize_images,
                        'num_iterations': num_iterations,
-                       'batch_size': batch_size}
+                       'batch_size': batch_size,
+                       'shuffle_seed': shuffle_seed,
+                       'rank': rank,
+                       'world_size': world_size}
+        self.random_state = np.random if shuffle_seed is None else np.random.RandomState(shuffle_seed)
         self.prepare()
         self.reset()
 
 
 
     def prepare(self):
-        self.lengths = []
+        #TODO: Deal with multiple outputs!
+        id_out = self.dataset.ids_outputs[0] # TODO: first output selection, this 0 is harcoded!
+        if(self.dataset.types_outputs[0] != 'text'):
+            raise Exception('Homogeneous batches can only be built when the first output is of type "text".')
         
-        it = 0
-        finished_iterations = False
-        while not finished_iterations:
-            it += 1
-            
-            # Checks if we are finishing processing the data split
-            init_sample = (it-1)*self.params['batch_size']
-            final_sample = it*self.params['batch_size']
-            batch_size = self.params['batch_size']
-            n_samples_split = eval("self.dataset.len_"+self.set_split)
-            if final_sample >= n_samples_split:
-                final_sample = n_samples_split
-                batch_size = final_sample-init_sample
-                finished_iterations = True
-            
-            #TODO: Deal with multiple outputs!
-            Y_batch = self.dataset.getY(self.set_split, init_sample, final_sample,
-                                    normalization=self.params['normalize_images'],
-                                    meanSubstraction=self.params['mean_substraction'])[0] # TODO: first output selection, this 0 is harcoded!
-            Y_batch = Y_batch[1] # just use mask
-
-            batch_lengths = [int(np.sum(cc)) for cc in Y_batch]
-            self.lengths += batch_lengths
+        # lengths of the samples in the stored order of the split (the batches are read with stored_order=True)
+        self.lengths = self.dataset.getTextLengths(id_out, self.set_split)
             
         # find the unique lengths
-        self.len_unique = np.unique(self.lengths)
+        len_unique, inverse = np.unique(self.lengths, return_inverse=True)
+        # indices of each length (in increasing order)
+        len_indices = np.split(np.argsort(inverse, kind='mergesort'), np.cumsum(np.bincount(inverse))[:-1])
 
         # remove any overly long captions
         if self.maxlen:
-            self.len_unique = [ll for ll in self.len_unique if ll <= self.maxlen]
+            self.len_unique = [ll for ll in len_unique if ll <= self.maxlen]
+        else:
+            self.len_unique = list(len_unique)
 
         # indices of unique lengths
         self.len_indices = dict()
         self.len_counts = dict()
-        for ll in self.len_unique:
-            self.len_indices[ll] = np.where(self.lengths == ll)[0]
-            self.len_counts[ll] = len(self.len_indices[ll])
+        for ll, indices in zip(len_unique, len_indices):
+            if ll in self.len_unique:
+                self.len_indices[ll] = indices
+                self.len_counts[ll] = len(indices)
 
         # current counter
         self.len_curr_counts = copy.copy(self.len_counts)
 
     def reset(self):
         self.len_curr_counts = copy.copy(self.len_counts)
-        self.len_unique = np.random.permutation(self.len_unique)
+        self.len_unique = self.random_state.permutation(self.len_unique)
         self.len_indices_pos = dict()
         for ll in self.len_unique:
             self.len_indices_pos[ll] = 0
-            self.len_indices[ll] = np.random.permutation(self.len_indices[ll])
+            self.len_indices[ll] = self.random_state.permutation(self.len_indices[ll])
         self.len_idx = -1
 
+    def epochBatches(self):
+        """
+            Returns the indices of the samples of each batch of a pass over all the (shuffled) lengths, taking one
+            batch of each length in turn. When world_size > 1, the list of batches is completed with its first
+            batches up to a multiple of world_size and only the batches of this rank are returned, so that all
+            the ranks get the same number of batches.
+        """
+        self.reset()
+        batches = []
+        while any([self.len_curr_counts[ll] > 0 for ll in self.len_unique]):
+            for ll in self.len_unique:
+                if(self.len_curr_counts[ll] > 0):
+                    curr_batch_size = np.minimum(self.batch_size, self.len_curr_counts[ll])
+                    curr_pos = self.len_indices_pos[ll]
+                    batches.append(self.len_indices[ll][curr_pos:curr_pos+curr_batch_size])
+                    self.len_indices_pos[ll] += curr_batch_size
+                    self.len_curr_counts[ll] -= curr_batch_size
+        if(len(batches) == 0):
+            raise Exception('The set split "'+ self.set_split +'" has no samples with length <= maxlen.')
+        n_batches_rank = int(math.ceil(float(len(batches))/self.params['world_size']))
+        return [batches[(self.params['rank'] + self.params['world_size']*b) % len(batches)]
+                for b in range(n_batches_rank)]
+
     def generator(self):
 
         if(self.set_split == 'train' and not self.predict):
@@ -233,6 +561,15 @@ class Homogeneous_Data_Batch_Generator(object):
         else:
             data_augmentation = False
 
+        if(self.params['world_size'] > 1 and not self.predict):
+            while 1:
+                for curr_indices in self.epochBatches():
+                    X_batch, Y_batch = self.dataset.getXY_FromIndices(self.set_split, curr_indices,
+                                                 normalization=self.params['normalize_images'],
+                                                 meanSubstraction=self.params['mean_substraction'],
+                                                 dataAugmentation=data_augmentation, stored_order=True)
+                    yield(self.net.prepareData(X_batch, Y_batch))
+
         it = 0
         while 1:
             it += 1
@@ -262,11 +599,257 @@ class Homogeneous_Data_Batch_Generator(object):
                 X_batch, Y_batch = self.dataset.getXY_FromIndices(self.set_split, curr_indices,
                                              normalization=self.params['normalize_images'],
                                              meanSubstraction=self.params['mean_substraction'],
-                                             dataAugmentation=data_augmentation)
+                                             dataAugmentation=data_augmentation, stored_order=True)
                 data = self.net.prepareData(X_batch, Y_batch)
 
             yield(data)
 
+class Bucketed_Data_Batch_Generator(object):
+    '''
+    Retrieves batches of samples with similar lengths. The samples are grouped in buckets of lengths and every
+    batch is filled with batch_size samples of the same bucket (the remaining samples of each bucket are joined
+    with the ones of the adjacent buckets).
+    '''
+
+    def __init__(self, set_split, net, dataset, num_iterations,
+                 batch_size=50, maxlen=100,
+                 normalize_images=False,
+                 data_augmentation=True,
+                 mean_substraction=True,
+                 bucket_boundaries='auto',
+                 padding_tolerance=0.2,
+                 text_ids=None,
+                 shuffle_seed=None,
+                 rank=0,
+                 world_size=1
+                 ):
+        """
+            :param bucket_boundaries: list with the maximum length of each bucket (the longer samples form an additional
+                                      bucket) or 'auto' for computing them from the histogram of lengths
+            :param padding_tolerance: (only if bucket_boundaries == 'auto') maximum proportion of padding allowed in a
+                                      bucket, which is only exceeded when it has less than batch_size samples
+            :param text_ids: identifiers of the 'text' inputs and outputs whose length is considered (all of them if None).
+                             The samples are bucketed by their maximum length among them.
+            :param shuffle_seed: if not None, seed of the random order of the samples and batches
+            :param rank: index (from 0 to world_size-1) of the process using this generator
+            :param world_size: number of processes sharing each epoch. All of them build the same batches (with the
+                               same shuffle_seed, 0 if None) and each one gets one of every world_size batches
+                               (the batches of the last ranks are completed with the first ones, so all the ranks
+                               get the same number of batches).
+        """
+        _checkRank(rank, world_size)
+        if(world_size > 1 and shuffle_seed is None):
+            shuffle_seed = 0 # all the ranks must shuffle the samples in the same way
+        self.set_split = set_split
+        self.dataset = dataset
+        self.net = net
+        self.maxlen = maxlen
+        self.batch_size = batch_size
+        # Several parameters
+        self.params = {'data_augmentation': data_augmentation,
+                       'mean_substraction': mean_substraction,
+                       'normalize_images': normalize_images,
+                       'num_iterations': num_iterations,
+                       'batch_size': batch_size,
+                       'bucket_boundaries': bucket_boundaries,
+                       'padding_tolerance': padding_tolerance,
+                       'shuffle_seed': shuffle_seed,
+                       'rank': rank,
+                       'world_size': world_size}
+        self.random_state = np.random if shuffle_seed is None else np.random.RandomState(shuffle_seed)
+        if(text_ids is None):
+            text_ids = [id for id, type in zip(dataset.ids_inputs + dataset.ids_outputs,
+                                               dataset.types_inputs + dataset.types_outputs)
+                        if type == 'text' and dataset.max_text_len[id].get(set_split, 0) > 0]
+        if(not text_ids):
+            raise Exception('Bucketed batches need at least one input or output of type "text" processed as a sequence of words.')
+        self.text_ids = text_ids
+        self.prepare()
+
+    def prepare(self):
+        # lengths of each text of the samples in the stored order of the split (the batches are read with stored_order=True)
+        self.lengths = np.stack([self.dataset.getTextLengths(id, self.set_split) for id in self.text_ids], axis=1)
+        sample_lengths = self.lengths.max(axis=1)
+
+        # remove any overly long captions
+        samples = np.arange(len(sample_lengths))
+        if self.maxlen:
+            samples = samples[sample_lengths <= self.maxlen]
+
+        if self.params['bucket_boundaries'] == 'auto':
+            self.boundaries = self.__histogramBoundaries(sample_lengths[samples])
+        else:
+            self.boundaries = sorted(self.params['bucket_boundaries'])
+
+        # indices of each bucket
+        buckets = np.searchsorted(self.boundaries, sample_lengths[samples])
+        self.bucket_indices = [samples[buckets == b] for b in range(len(self.boundaries)+1)]
+        self.bucket_indices = [indices for indices in self.bucket_indices if len(indices) > 0]
+
+    def __histogramBoundaries(self, sample_lengths):
+        """
+            Joins consecutive lengths in the same bucket while its padding (w.r.t. its longest length) is within
+            the tolerance, or while it has less than batch_size samples.
+        """
+        len_unique, counts = np.unique(sample_lengths, return_counts=True)
+        boundaries = []
+        n_samples = 0
+        n_words = 0
+        for ll, count in zip(len_unique, counts):
+            padding = 1.0 - float(n_words + ll*count) / (ll*(n_samples + count))
+            if n_samples >= self.batch_size and padding > self.params['padding_tolerance']:
+                boundaries.append(last)
+                n_samples = 0
+                n_words = 0
+            n_samples += count
+            n_words += ll*count
+            last = ll
+        return boundaries
+
+    def epochBatches(self):
+        """
+            Returns the (shuffled) indices of the samples of each batch of an epoch
+            (only the batches of this rank if world_size > 1).
+        """
+        batches = []
+        remaining = []
+        for indices in self.bucket_indices:
+            indices = self.random_state.permutation(indices)
+            n_full = len(indices) - len(indices) % self.batch_size
+            batches += [indices[init:init+self.batch_size] for init in range(0, n_full, self.batch_size)]
+            remaining.append(indices[n_full:])
+        # the buckets are sorted by length, so the remaining samples are joined with the ones of adjacent buckets
+        remaining = np.concatenate(remaining) if remaining else np.zeros(0, dtype=np.int64)
+        batches += [remaining[init:init+self.batch_size] for init in range(0, len(remaining), self.batch_size)]
+        batches = [batches[b] for b in self.random_state.permutation(len(batches))]
+        if(self.params['world_size'] > 1):
+            n_batches_rank = int(math.ceil(float(len(batches))/self.params['world_size']))
+            batches = [batches[(self.params['rank'] + self.params['world_size']*b) % len(batches)]
+                       for b in range(n_batches_rank)]
+
+        if(not self.dataset.silence):
+            # padding positions added in each text w.r.t. the longest one in the batch
+            padding = 0
+            positions = 0
+            for indices in batches:
+                lengths = self.lengths[indices]
+                positions += lengths.max(axis=0).sum() * len(indices)
+                padding += lengths.max(axis=0).sum() * len(indices) - lengths.sum()
+            logging.info('Bucketed '+ str(sum([len(indices) for indices in batches])) +' samples in '+ str(len(batches)) +
+                         ' batches ('+ str(len(self.bucket_indices)) +' buckets) with a padding ratio of %.2f%%.' % (100.0*padding/max(positions, 1)))
+        return batches
+
+    def generator(self):
+
+        if(self.set_split == 'train'):
+            data_augmentation = self.params['data_augmentation']
+        else:
+            data_augmentation = False
+
+        while 1:
+            for indices in self.epochBatches():
+                X_batch, Y_batch = self.dataset.getXY_FromIndices(self.set_split, indices,
+                                             normalization=self.params['normalize_images'],
+                                             meanSubstraction=self.params['mean_substraction'],
+                                             dataAugmentation=data_augmentation, stored_order=True)
+                data = self.net.prepareData(X_batch, Y_batch)
+                yield(data)
+
+# ------------------------------------------------------- #
+#       TOKENIZATION
+#           Precompiled tables and regular expressions used by the tokenization functions of Dataset
+# ------------------------------------------------------- #
+
+_BASIC_PUNCT = re.compile(r'([.;/\[\]"{}()=+\\_\-><@`,?!])')
+# The symbols are removed in the same order as the original sequence of str.replace calls (ASCII symbols,
+# '¿', '¡' and then the line breaks and tabs), so that the bytes of invalid UTF-8 strings are removed
+# in the same way when they become adjacent (e.g. '\xc2>\xbf' loses the '>' and then the '¿' it forms)
+_AGGRESSIVE_PUNCT = re.compile(r'[.;/\[\]"{}()=+\\_\-><@`,?!]')
+_AGGRESSIVE_BREAKS = re.compile('[\n\t\r]')
+_SPACES = re.compile(' +')
+_ICANN_PUNCT = re.compile('[.,"\n\t]+')
+_MONTREAL_APOSTROPHES = re.compile("'+")
+_SOFT_NEWLINES = re.compile('[\n\t]+')
+_SOFT_PUNCT = re.compile(r'([.,!?{}()\[\]"\'])\1*')
+
+_QUESTIONS_CONTRACTIONS = {"aint": "ain't", "arent": "aren't", "cant": "can't", "couldve": "could've", "couldnt": "couldn't",
+        "couldn'tve": "couldn’t’ve", "couldnt’ve": "couldn’t’ve", "didnt": "didn’t", "doesnt": "doesn’t",
+        "dont": "don’t", "hadnt": "hadn’t", "hadnt’ve": "hadn’t’ve", "hadn'tve": "hadn’t’ve",
+        "hasnt": "hasn’t", "havent": "haven’t", "hed": "he’d", "hed’ve": "he’d’ve", "he’dve": "he’d’ve",
+        "hes": "he’s", "howd": "how’d", "howll": "how’ll", "hows": "how’s", "Id’ve": "I’d’ve",
+        "I’dve": "I’d’ve", "Im": "I’m", "Ive": "I’ve", "isnt": "isn’t", "itd": "it’d", "itd’ve": "it’d’ve",
+        "it’dve": "it’d’ve", "itll": "it’ll", "let’s": "let’s", "maam": "ma’am", "mightnt": "mightn’t",
+        "mightnt’ve": "mightn’t’ve", "mightn’tve": "mightn’t’ve", "mightve": "might’ve", "mustnt": "mustn’t",
+        "mustve": "must’ve", "neednt": "needn’t", "notve": "not’ve", "oclock": "o’clock", "oughtnt": "oughtn’t",
+        "ow’s’at": "’ow’s’at", "’ows’at": "’ow’s’at", "’ow’sat": "’ow’s’at", "shant": "shan’t",
+        "shed’ve": "she’d’ve", "she’dve": "she’d’ve", "she’s": "she’s", "shouldve": "should’ve",
+        "shouldnt": "shouldn’t", "shouldnt’ve": "shouldn’t’ve", "shouldn’tve": "shouldn’t’ve",
+        "somebody’d": "somebodyd", "somebodyd’ve": "somebody’d’ve", "somebody’dve": "somebody’d’ve",
+        "somebodyll": "somebody’ll", "somebodys": "somebody’s", "someoned": "someone’d",
+        "someoned’ve": "someone’d’ve", "someone’dve": "someone’d’ve", "someonell": "someone’ll",
+        "someones": "someone’s", "somethingd": "something’d", "somethingd’ve": "something’d’ve",
+        "something’dve": "something’d’ve", "somethingll": "something’ll", "thats": "that’s",
+        "thered": "there’d", "thered’ve": "there’d’ve", "there’dve": "there’d’ve", "therere": "there’re",
+        "theres": "there’s", "theyd": "they’d", "theyd’ve": "they’d’ve", "they’dve": "they’d’ve",
+        "theyll": "they’ll", "theyre": "they’re", "theyve": "they’ve", "twas": "’twas", "wasnt": "wasn’t",
+        "wed’ve": "we’d’ve", "we’dve": "we’d’ve", "weve": "we've", "werent": "weren’t", "whatll": "what’ll",
+        "whatre": "what’re", "whats": "what’s", "whatve": "what’ve", "whens": "when’s", "whered":
+            "where’d", "wheres": "where's", "whereve": "where’ve", "whod": "who’d", "whod’ve": "who’d’ve",
+        "who’dve": "who’d’ve", "wholl": "who’ll", "whos": "who’s", "whove": "who've", "whyll": "why’ll",
+        "whyre": "why’re", "whys": "why’s", "wont": "won’t", "wouldve": "would’ve", "wouldnt": "wouldn’t",
+        "wouldnt’ve": "wouldn’t’ve", "wouldn’tve": "wouldn’t’ve", "yall": "y’all", "yall’ll": "y’all’ll",
+        "y’allll": "y’all’ll", "yall’d’ve": "y’all’d’ve", "y’alld’ve": "y’all’d’ve", "y’all’dve": "y’all’d’ve",
+        "youd": "you’d", "youd’ve": "you’d’ve", "you’dve": "you’d’ve", "youll": "you’ll",
+        "youre": "you’re", "youve": "you’ve"}
+_QUESTIONS_PUNCT = [';', r"/", '[', ']', '"', '{', '}', '(', ')', '=', '+', '\\', '_', '-', '>', '<', '@', '`', ',', '?', '!']
+_QUESTIONS_PUNCT_CHARS = ''.join(_QUESTIONS_PUNCT)
+_QUESTIONS_PUNCT_TO_SPACE = string.maketrans(_QUESTIONS_PUNCT_CHARS, ' '*len(_QUESTIONS_PUNCT_CHARS))
+_QUESTIONS_COMMA_STRIP = re.compile("(\d)(\,)(\d)")
+_QUESTIONS_PERIOD_STRIP = re.compile("(?!<=\d)(\.)(?!\d)")
+_QUESTIONS_MANUAL_MAP = {'none': '0', 'zero': '0', 'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5',
+                         'six': '6', 'seven': '7', 'eight': '8', 'nine': '9', 'ten': '10'}
+_QUESTIONS_ARTICLES = set(['a', 'an', 'the'])
+
+
+# ------------------------------------------------------- #
+#       SPLIT REGISTRY
+#           Samples and reading state of each set split of a Dataset
+# ------------------------------------------------------- #
+
+# Attributes of DataSplit, also accessible as the Dataset attributes <prefix><set_name> (e.g. X_train or len_val)
+_SPLIT_ATTRIBUTES = [('X_', 'X'), ('Y_', 'Y'), ('len_', 'len'), ('last_', 'last'), ('loaded_', 'loaded'), ('order_', 'order')]
+
+
+class DataSplit(object):
+    """
+        Samples of a set split ('train', 'val' or 'test') of a Dataset and the state used for reading them.
+    """
+    
+    def __init__(self):
+        # Dictionaries of samples of each input and output id
+        self.X = dict()
+        self.Y = dict()
+        # Number of samples
+        self.len = 0
+        # Position of the next sample read by getXY()
+        self.last = 0
+        # Indicators for knowing if the data [X, Y] has been loaded
+        self.loaded = [False, False]
+        # Order in which the samples are read (None for the stored order), see shuffleTraining()
+        self.order = None
+
+
+def _splitProperty(set_name, attribute):
+    """
+        Returns a property giving access to the attribute 'attribute' of the split 'set_name' of a Dataset.
+    """
+    def getter(dataset):
+        return getattr(dataset.splits[set_name], attribute)
+    def setter(dataset, value):
+        setattr(dataset.splits[set_name], attribute, value)
+    return property(getter, setter)
+
+
 # ------------------------------------------------------- #
 #       MAIN CLASS
 # ------------------------------------------------------- #
@@ -293,21 +876,11 @@ class Dataset(object):
         # Lock for threads synchronization
         self.__lock_read = threading.Lock()
         
-        # Indicators for knowing if the data [X, Y] has been loaded for each data split
-        self.loaded_train = [False, False]
-        self.loaded_val = [False, False]
-        self.loaded_test = [False, False]
-        self.len_train = 0
-        self.len_val = 0
-        self.len_test = 0
-        
-        # Initialize dictionaries of samples
-        self.X_train = dict()
-        self.X_val = dict()
-        self.X_test = dict()
-        self.Y_train = dict()
-        self.Y_val = dict()
-        self.Y_test = dict()
+        # Samples and reading state of each data split (also accessible as self.X_train, self.len_val, etc.)
+        self.splits = {'train': DataSplit(), 'val': DataSplit(), 'test': DataSplit()}
+        self.shuffle_chunk_size = None
+        # Caches of the preprocessed batches of each split (see setBatchCache(), not stored when pickling)
+        self.__batch_caches = dict()
         #################################################
         
         
@@ -321,6 +894,7 @@ class Dataset(object):
         self.ids_outputs = []
         self.types_outputs = [] # see accepted types in self.__accepted_types_outputs
         self.sample_weights = dict() # Choose whether we should compute output masks or not
+        self.sparse_targets = dict() # Choose whether 'text' outputs are returned as word indices instead of one-hot vectors
 
         # List of implemented input and output data types
         self.__accepted_types_inputs = ['image', 'video', 'image-features', 'video-features', 'text', 'id', 'ghost']
@@ -344,6 +918,10 @@ class Dataset(object):
         self.fill_text = dict()      # text padding mode
         self.pad_on_batch = dict()   # text padding mode: If pad_on_batch, the sample will have the maximum length
                                      # of the current batch. Else, it will have a fixed length (max_text_len)
+        self.text_encoded = dict()   # samples encoded with their vocabulary (see encodeText())
+        self.tokenization_workers = None # processes used for tokenizing text files (None for one per CPU core)
+        self.tokenization_cache = False  # store the tokenized text files in the cache folder (see tokenizeFile())
+        self.tokenization_cache_path = None # folder of the tokenized text files (self.path+'/tokenized' if None)
 
         #################################################
         
@@ -351,11 +929,15 @@ class Dataset(object):
         ############################ Parameters used for inputs of type 'video' or 'video-features'
         self.counts_frames = dict()
         self.paths_frames = dict()
+        self.first_frames = dict() # position in paths_frames of the first frame of each video (see getFirstFrames())
         self.max_video_len = dict() 
         #################################################
         
         ############################ Parameters used for inputs of type 'image-features' or 'video-features'
         self.features_lengths = dict()
+        # Features packed in a single file (see consolidateFeatures())
+        self.consolidated_features = dict()
+        self.__features_files = dict() # opened memory-mapped feature files (not stored when pickling)
         #################################################
         
         ############################ Parameters used for inputs of type 'image'
@@ -365,6 +947,22 @@ class Dataset(object):
         self.img_size_crop = dict()
         # Training mean image
         self.train_mean = dict()
+        # Standard deviation of each channel of the training images (see calculateTrainMean())
+        self.train_std = dict()
+        # Persistent caches of resized images (see buildImageCache())
+        self.image_cache = dict()
+        # Whether the JPEG images are decoded at a reduced resolution (see setDraftDecoding())
+        self.draft_decoding = dict()
+        # Number of decoded images kept in memory for later batches (see setDecodeCache())
+        self.decode_cache_size = dict()
+        self.__decoded_images = dict()    # recently decoded images (not stored when pickling)
+        self.__lock_decoded = threading.Lock()
+        self.__image_cache_files = dict() # opened memory-mapped cache files (not stored when pickling)
+        # Shard files with the encoded images of each split (see packImages())
+        self.image_records = dict()
+        self.__record_files = dict()      # opened memory-mapped shard files (not stored when pickling)
+        self.__prepared_mean = dict()     # training means ready to be substracted (not stored when pickling)
+        self.__folder_listings = dict()   # files of the folders of extension-less image paths (not stored when pickling)
         #################################################
         
         ############################ Parameters used for outputs of type 'categorical'
@@ -376,23 +974,22 @@ class Dataset(object):
         self.resetCounters()
         
     
-    def shuffleTraining(self):
+    def shuffleTraining(self, seed=None, chunk_size=None):
         """
             Applies a random shuffling to the training samples.
+            Only a permutation of the samples is stored (no data is moved), all the getters read the samples through it.
+            
+            :param seed: seed used for generating the permutation (None for a random one)
+            :param chunk_size: if not None, chunks of chunk_size consecutive samples are shuffled and then the samples
+                               inside each chunk, which keeps the reads of streamed splits local (self.shuffle_chunk_size by default)
         """
         if(not self.silence):
             logging.info("Shuffling training samples.")
         
         # Shuffle
-        num = self.len_train
-        shuffled_order = random.sample([i for i in range(num)], num)
-        
-        # Process each input sample
-        for id in self.X_train.keys():
-            self.X_train[id] = [self.X_train[id][s] for s in shuffled_order]
-        # Process each output sample
-        for id in self.Y_train.keys():
-            self.Y_train[id] = [self.Y_train[id][s] for s in shuffled_order]
+        if(chunk_size is None):
+            chunk_size = self.shuffle_chunk_size
+        self.order_train = _permutation(self.len_train, seed, chunk_size)
             
         if(not self.silence):
             logging.info("Shuffling training done.")
@@ -411,8 +1008,8 @@ class Dataset(object):
         logging.info('Keeping top '+str(n_top)+' outputs from the '+set_name+' set and removing the rest.')
         
         # Sort outputs by number of occurrences
-        samples = None
-        exec('samples = self.Y_'+set_name)
+        split = self.splits[set_name]
+        samples = split.Y
         count = Counter(samples[id_out])
         most_frequent = sorted(count.items(), key=lambda x:x[1], reverse=True)[:n_top]
         most_frequent = [m[0] for m in most_frequent]
@@ -425,22 +1022,62 @@ class Dataset(object):
                 
         # Remove non-top samples    
         # Inputs
-        ids = None
-        exec('ids = self.X_'+set_name+'.keys()')
-        for id in ids:
-            exec('self.X_'+set_name+'[id] = [self.X_'+set_name+'[id][k] for k in kept]')
+        for id in split.X.keys():
+            split.X[id] = takeSamples(split.X[id], kept)
         # Outputs
-        exec('ids = self.Y_'+set_name+'.keys()')
-        for id in ids:
-            exec('self.Y_'+set_name+'[id] = [self.Y_'+set_name+'[id][k] for k in kept]')
+        for id in split.Y.keys():
+            split.Y[id] = takeSamples(split.Y[id], kept)
+        # First frames of the videos stored in the inputs of type 'video'
+        for id, type in zip(self.ids_inputs, self.types_inputs):
+            if(type == 'video' and set_name in self.first_frames.get(id, {})):
+                self.first_frames[id][set_name] = np.take(self.first_frames[id][set_name], kept)
+        # Encoded texts (the words of the removed samples are left unreferenced)
+        for id in self.text_encoded.keys():
+            encoded = self.text_encoded[id].get(set_name)
+            if(encoded is not None):
+                for key in ['starts', 'lengths', 'split_lengths']:
+                    encoded[key] = np.take(encoded[key], kept)
         new_len = len(samples[id_out])
-        exec('self.len_'+set_name+' = new_len')
+        split.len = new_len
+        split.order = None
         
         self.__checkLengthSet(set_name)
         
         logging.info(str(new_len)+' samples remaining after removal.')
     
     
+    def memmapColumns(self, store_path=None, mmap_mode='r'):
+        """
+            Stores every data column that can be represented with NumPy arrays (see saveDataset(format='columnar'))
+            in the folder 'store_path' and replaces it by its memory-mapped version. The samples are then backed
+            by the files, so their memory pages are shared by all the processes forked from this one.
+            
+            :param store_path: folder where the columns are stored (self.path+'/columns_'+self.name by default)
+            :param mmap_mode: memory-mapping mode used for opening the stored columns
+        """
+        if(store_path is None):
+            store_path = self.path+'/columns_'+self.name
+        create_dir_if_not_exists(store_path)
+        
+        n_mapped = 0
+        # the dictionaries of the state are the ones of this instance, so the columns are replaced in place
+        obj_dict = self.__getstate__()
+        for key_path in _dataColumnsPaths(obj_dict):
+            column = _getByPath(obj_dict, key_path)
+            base = column.column if isinstance(column, RepeatedColumn) else column
+            if(isinstance(base, np.memmap) or isinstance(getattr(base, 'offsets', None), np.memmap)):
+                continue # already memory-mapped
+            packed = packColumn(column)
+            if(packed is not None):
+                file_prefix = store_path+'/'+'__'.join([str(key) for key in key_path])
+                saveColumn(packed[0], packed[1], file_prefix)
+                _setByPath(obj_dict, key_path, loadColumn(packed[0], file_prefix, mmap_mode))
+                n_mapped += 1
+        
+        if(not self.silence):
+            logging.info('Memory-mapped '+str(n_mapped)+' data columns stored in '+store_path)
+    
+    
     # ------------------------------------------------------- #
     #       GENERAL SETTERS
     #           classes list, train, val and test set, etc.
@@ -451,18 +1088,39 @@ class Dataset(object):
             Resets some basic counter indices for the next samples to read.
         """
         if(set_name == "all"):
-            self.last_train = 0
-            self.last_val = 0
-            self.last_test = 0
+            for split in self.splits.values():
+                split.last = 0
         else:
             self.__checkSetName(set_name)
-            exec('self.last_'+set_name+'=0')
+            self.splits[set_name].last = 0
             
     def setSilence(self, silence):
         """
             Changes the silence mode of the 'Dataset' instance.
         """
         self.silence = silence
+    
+    
+    def setBatchCache(self, set_name, max_bytes=2**30, spill_path=None):
+        """
+            Keeps the preprocessed batches of the split 'set_name' read without data augmentation (by getXY_Cached()
+            and getX_Cached(), used for evaluating on it), so they are only read and preprocessed in the first
+            evaluation round. They are discarded when the normalization, the training means, the image sizes or
+            the reading order change. The cache is not stored when pickling the Dataset.
+            
+            :param max_bytes: maximum size (in bytes) of the batches kept in RAM. If 0 and spill_path is None, the
+                              cache of the split is removed.
+            :param spill_path: folder where the batches that do not fit in RAM are stored and memory-mapped
+                               (not cached if None)
+        """
+        self.__checkSetName(set_name)
+        cache = self.__batch_caches.pop(set_name, None)
+        if(cache is not None):
+            cache.clear()
+        if(max_bytes > 0 or spill_path is not None):
+            if(spill_path is not None):
+                spill_path = spill_path+'/batch_cache_'+self.name+'_'+set_name
+            self.__batch_caches[set_name] = BatchCache(max_bytes, spill_path)
         
         
     def setListGeneral(self, path_list, split=[0.8, 0.1, 0.1], shuffle=True, type='image', id='image'):
@@ -540,7 +1198,8 @@ class Dataset(object):
                  max_text_len=35, tokenization='tokenize_basic',offset=0, fill='end', min_occ=0, pad_on_batch=True,  # 'text'
                  build_vocabulary=False, max_words=0,
                  feat_len = 1024,                                                                 # 'image-features' / 'video-features'
-                 max_video_len=26                                                                 # 'video'
+                 max_video_len=26,                                                                # 'video'
+                 storage='list', image_cache=False, draft_decoding=False, decode_cache=0, pack_images=False
                  ):
         """
             Loads a list of samples which can contain all samples from the 'train', 'val', or
@@ -553,13 +1212,22 @@ class Dataset(object):
             :param type: identifier of the type of input we are loading (accepted types can be seen in self.__accepted_types_inputs)
             :param id: identifier of the input data loaded
             :param repeat_set: repeats the inputs given (useful when we have more outputs than inputs). Int or array of ints.
+                               The inputs of type 'image' and 'image-features' are not duplicated, each repetition
+                               refers to the same sample (see RepeatedColumn).
             :param required: flag for optional inputs
+            :param storage: how the samples are stored: 'list' (Python list), 'packed' (strings packed in NumPy arrays),
+                            'array' (NumPy array, fixed-width for strings) or 'stream' (read from the list file when needed,
+                            only for types 'image', 'image-features', 'text' and 'id'). See also memmapColumns().
 
             
             # 'image'-related parameters
             
             :param img_size: size of the input images (any input image will be resized to this)
             :param img_size_crop: size of the cropped zone (when dataAugmentation=False the central crop will be used)
+            :param image_cache: if True, the resized images will be stored in an on-disk cache the first time they are loaded (see buildImageCache())
+            :param draft_decoding: if True, the JPEG images are decoded directly at a reduced resolution (see setDraftDecoding())
+            :param decode_cache: number of decoded images kept in memory for reusing them in later batches (see setDecodeCache())
+            :param pack_images: if True, the encoded images are packed into large shard files which they are read from (see packImages())
             
             
             # 'text'-related parameters
@@ -584,7 +1252,7 @@ class Dataset(object):
         self.__checkSetName(set_name)
         
         # Insert type and id of input data
-        keys_X_set = eval('self.X_'+set_name+'.keys()')
+        keys_X_set = self.splits[set_name].X.keys()
         if(id not in self.ids_inputs):
             self.ids_inputs.append(id)
             self.types_inputs.append(type)
@@ -597,38 +1265,60 @@ class Dataset(object):
             raise NotImplementedError('The input type "'+type+'" is not implemented. The list of valid types are the following: '+str(self.__accepted_types_inputs))
         
         # Proprocess the input data depending on its type
+        stream = storage == 'stream'
         if(type == 'image'):
-            data = self.preprocessImages(path_list, id, set_name, img_size, img_size_crop)
+            data = self.preprocessImages(path_list, id, set_name, img_size, img_size_crop, stream=stream)
         elif(type == 'video'):
             data = self.preprocessVideos(path_list, id, set_name, max_video_len, img_size, img_size_crop)
         elif(type == 'text'):
             if self.max_text_len.get(id) is None:
                 self.max_text_len[id] = dict()
             data = self.preprocessText(path_list, id, set_name, tokenization, build_vocabulary, max_text_len,
-                                       max_words, offset, fill, min_occ, pad_on_batch)
+                                       max_words, offset, fill, min_occ, pad_on_batch, stream=stream)
         elif(type == 'image-features'):
-            data = self.preprocessFeatures(path_list, id, set_name, feat_len)
+            data = self.preprocessFeatures(path_list, id, set_name, feat_len, stream=stream)
         elif(type == 'video-features'):
             data = self.preprocessVideoFeatures(path_list, id, set_name, max_video_len, img_size, img_size_crop, feat_len)
         elif(type == 'id'):
-            data = self.preprocessIDs(path_list, id, set_name)
+            data = self.preprocessIDs(path_list, id, set_name, stream=stream)
         elif(type == 'ghost'):
             data = []
         if(isinstance(repeat_set, list) or isinstance(repeat_set, (np.ndarray, np.generic)) or repeat_set > 1):
-            data = list(np.repeat(data,repeat_set))
-        
-        self.__setInput(data, set_name, type, id)
+            if(isinstance(data, LineFile)):
+                data = data.take(np.repeat(np.arange(len(data)), repeat_set))
+            elif(type in ['image', 'image-features']):
+                data = RepeatedColumn.repeat(data, repeat_set)
+            else:
+                data = list(np.repeat(data,repeat_set))
+            if(type == 'video'):
+                self.first_frames[id][set_name] = np.repeat(self.first_frames[id][set_name], repeat_set)
+        
+        self.__setInput(toColumn(data, storage), set_name, type, id)
+        
+        if(type == 'text' and not stream): # streamed texts are encoded when read
+            self.encodeText(id, set_name)
+        elif(type == 'image'):
+            if(draft_decoding):
+                self.setDraftDecoding(id)
+            if(decode_cache > 0):
+                self.setDecodeCache(id, decode_cache)
+            if(image_cache):
+                self.buildImageCache(id, set_name, fill=False)
+            if(pack_images):
+                self.packImages(id, set_name)
         
     
     def __setInput(self, set, set_name, type, id):
-        exec('self.X_'+set_name+'[id] = set')
-        exec('self.loaded_'+set_name+'[0] = True')
+        split = self.splits[set_name]
+        split.X[id] = set
+        split.loaded[0] = True
         if id not in self.optional_inputs:
-            exec('self.len_'+set_name+' = len(set)')
+            split.len = len(set)
+            split.order = None
             self.__checkLengthSet(set_name)
         
         if(not self.silence):
-            logging.info('Loaded "' + set_name + '" set inputs of type "'+type+'" with id "'+id+'" and length '+ str(eval('self.len_'+set_name)) + '.')
+            logging.info('Loaded "' + set_name + '" set inputs of type "'+type+'" with id "'+id+'" and length '+ str(self.splits[set_name].len) + '.')
         
     
     
@@ -641,7 +1331,7 @@ class Dataset(object):
     
     def setOutput(self, path_list, set_name, type='categorical', id='label', repeat_set=1,
                   tokenization='tokenize_basic', max_text_len=0, offset=0, fill='end', min_occ=0, pad_on_batch=True, # 'text'
-                  build_vocabulary=False, max_words=0, sample_weights=False):
+                  build_vocabulary=False, max_words=0, sample_weights=False, sparse_targets=False, storage='list'):
         """
             Loads a set of output data, usually (type=='categorical') referencing values in self.classes (starting from 0)
             
@@ -652,6 +1342,9 @@ class Dataset(object):
             :param type: identifier of the type of input we are loading (accepted types can be seen in self.__accepted_types_outputs).
             :param id: identifier of the input data loaded.
             :param repeat_set: repeats the outputs given (useful when we have more inputs than outputs). Int or array of ints.
+            :param storage: how the samples are stored: 'list' (Python list), 'packed' (strings packed in NumPy arrays),
+                            'array' (NumPy array, fixed-width for strings) or 'stream' (read from the list file when needed,
+                            only for types 'text' and 'id'). See also memmapColumns().
             
             # 'text'-related parameters
             
@@ -662,12 +1355,16 @@ class Dataset(object):
             :param offset: number of timesteps that the text is shifted to the right (for *_cond models)
             :param fill: select whether padding before or after the sequence
             :param min_occ: minimum number of occurrences allowed for the words in the vocabulary. (default = 0)
+            :param sample_weights: whether the mask of the text is returned along with the targets (used as sample weights).
+            :param sparse_targets: if True, the targets are the indices of the words (int32, with an additional axis of length 1)
+                                   instead of their one-hot vectors. They must be used with the loss 'sparse_categorical_crossentropy'
+                                   (see the parameter 'dataset' of CNN_Model.setOptimizer()).
 
         """
         self.__checkSetName(set_name)
 
         # Insert type and id of output data
-        keys_Y_set = eval('self.Y_'+set_name+'.keys()')
+        keys_Y_set = self.splits[set_name].Y.keys()
         if(id not in self.ids_outputs):
             self.ids_outputs.append(id)
             self.types_outputs.append(type)
@@ -684,30 +1381,58 @@ class Dataset(object):
             if self.max_text_len.get(id) is None:
                 self.max_text_len[id] = dict()
             data = self.preprocessText(path_list, id, set_name, tokenization, build_vocabulary, max_text_len,
-                                       max_words, offset, fill, min_occ, pad_on_batch)
+                                       max_words, offset, fill, min_occ, pad_on_batch, stream=storage == 'stream')
         elif(type == 'binary'):
             data = self.preprocessBinary(path_list)
         elif(type == 'id'):
-            data = self.preprocessIDs(path_list, id)
+            data = self.preprocessIDs(path_list, id, set_name, stream=storage == 'stream')
             
         if(isinstance(repeat_set, list) or isinstance(repeat_set, (np.ndarray, np.generic)) or repeat_set > 1):  
-            data = list(np.repeat(data,repeat_set))
+            if(isinstance(data, LineFile)):
+                data = data.take(np.repeat(np.arange(len(data)), repeat_set))
+            else:
+                data = list(np.repeat(data,repeat_set))
         if self.sample_weights.get(id) is None:
             self.sample_weights[id] = dict()
         self.sample_weights[id][set_name] = sample_weights
-        self.__setOutput(data, set_name, type, id)
+        self.sparse_targets[id] = sparse_targets
+        self.__setOutput(toColumn(data, storage), set_name, type, id)
+        
+        if(type == 'text' and storage != 'stream'): # streamed texts are encoded when read
+            self.encodeText(id, set_name)
 
     
     def __setOutput(self, labels, set_name, type, id):
-        exec('self.Y_'+set_name+'[id] = labels')
-        exec('self.loaded_'+set_name+'[1] = True')
-        exec('self.len_'+set_name+' = len(labels)')
+        split = self.splits[set_name]
+        split.Y[id] = labels
+        split.loaded[1] = True
+        split.len = len(labels)
+        split.order = None
         self.__checkLengthSet(set_name)
         
         if(not self.silence):
-            logging.info('Loaded "' + set_name + '" set outputs of type "'+type+'" with id "'+id+'" and length '+ str(eval('self.len_'+set_name)) + '.')
+            logging.info('Loaded "' + set_name + '" set outputs of type "'+type+'" with id "'+id+'" and length '+ str(self.splits[set_name].len) + '.')
            
         
+    def streamLines(self, path, id, set_name):
+        """
+            Returns the lines of the file 'path' as a LineFile, which reads them from disk when they are accessed.
+            The index of the lines is stored in the folder self.path+'/streams' and reused while the file is not modified.
+        """
+        lines = LineFile.open(path, index_path=self.__streamPath(path, id, set_name)+'_index.npy')
+        if(not self.silence):
+            logging.info('Streaming '+ str(len(lines)) +' "'+ set_name +'" samples with id "'+ id +'" from '+ path)
+        return lines
+    
+    
+    def __streamPath(self, path, id, set_name):
+        """
+            Prefix of the files created for streaming the list file 'path'.
+        """
+        create_dir_if_not_exists(self.path+'/streams')
+        return self.path+'/streams/'+self.name+'_'+id+'_'+set_name+'_'+hashlib.md5(os.path.abspath(path)).hexdigest()[:10]
+    
+    
     # ------------------------------------------------------- #
     #       TYPE 'categorical' SPECIFIC FUNCTIONS
     # ------------------------------------------------------- #
@@ -767,10 +1492,12 @@ class Dataset(object):
     #       TYPE 'features' SPECIFIC FUNCTIONS
     # ------------------------------------------------------- #
     
-    def preprocessFeatures(self, path_list, id, set_name, feat_len):
+    def preprocessFeatures(self, path_list, id, set_name, feat_len, stream=False):
         
         # file with a list, each line being a path to a .npy file with a feature vector
-        if(isinstance(path_list, str) and os.path.isfile(path_list)): 
+        if(isinstance(path_list, str) and os.path.isfile(path_list) and stream):
+            data = self.streamLines(path_list, id, set_name)
+        elif(isinstance(path_list, str) and os.path.isfile(path_list)): 
             data = []
             with open(path_list, 'r') as list_:
                 for line in list_:
@@ -786,47 +1513,130 @@ class Dataset(object):
         return data
     
     
-    def loadFeatures(self, X, feat_len, normalization_type='L2', normalization=False, loaded=False, external=False, data_augmentation=True):
-        
+    def loadFeatures(self, X, feat_len, normalization_type='L2', normalization=False, loaded=False, external=False, data_augmentation=True,
+                     id=None, set_name=None, buffers=None):
+        """
+            Loads the feature vectors stored in the .npy files 'X'. If the input 'id' of the set 'set_name' has been
+            consolidated (see consolidateFeatures()) they are read from the consolidated file.
+            If 'buffers' (a BatchBuffers, see PrefetchDataLoader) is given, they are returned in one of its arrays.
+        """
         if(normalization and normalization_type not in self.__available_norm_feat):
             raise NotImplementedError('The chosen normalization type '+ normalization_type +' is not implemented for the type "image-features" and "video-features".')
         
-        n_batch = len(X)
-        features = np.zeros((n_batch, feat_len))
+        features = self.__readFeatures(X, feat_len, id, set_name, external, buffers)
+        
+        if(data_augmentation):
+            noise_mean = 0.0
+            noise_dev = 0.01
+            features += np.random.normal(noise_mean, noise_dev, features.shape)
+
+        if(normalization):
+            if normalization_type == 'L2':
+                features /= np.linalg.norm(features, ord=2, axis=1, keepdims=True)
+            
+        return features
+    
+    
+    def consolidateFeatures(self, id, set_name, dtype='float32', store_path=None, external=False):
+        """
+            Packs all the feature vectors used by the input 'id' (of type 'image-features' or 'video-features')
+            in the 'set_name' split into a single memory-mapped array, with a row for each different .npy file.
+            Once consolidated, loadFeatures() and loadVideoFeatures() gather the rows of each batch from it
+            instead of opening a file per sample (or frame).
+            
+            :param id: identifier of the input of type 'image-features' or 'video-features'
+            :param set_name: 'train', 'val' or 'test' set
+            :param dtype: type of the stored features ('float32' or 'float16')
+            :param store_path: folder where the consolidated features are stored (self.path+'/features' by default)
+            :param external: if True the paths of the feature files are absolute (see loadFeatures())
+        """
+        self.__checkSetName(set_name)
+        if(id not in self.ids_inputs or self.types_inputs[self.ids_inputs.index(id)] not in ['image-features', 'video-features']):
+            raise Exception('The features can only be consolidated for inputs of type "image-features" or "video-features".')
+        if(dtype not in ['float32', 'float16']):
+            raise NotImplementedError('The features can only be consolidated with dtype "float32" or "float16".')
+        
+        if(self.types_inputs[self.ids_inputs.index(id)] == 'image-features'):
+            samples = self.splits[set_name].X[id]
+        else:
+            samples = self.paths_frames[id][set_name]
+        # Each different path is only stored once
+        paths = []
+        index = dict()
+        for feat in samples:
+            if feat not in index:
+                index[feat] = len(paths)
+                paths.append(feat)
+        
+        if(store_path is None):
+            store_path = self.path+'/features'
+        create_dir_if_not_exists(store_path)
+        file_prefix = store_path+'/'+self.name+'_'+id+'_'+set_name+'_'+dtype
+        shape = (len(paths), self.features_lengths[id])
+        
+        # Reuse the stored features if they were consolidated for the same list of files
+        reuse = False
+        if(os.path.isfile(file_prefix+'_paths.pkl') and os.path.isfile(file_prefix+'.npy')):
+            reuse = pk.load(open(file_prefix+'_paths.pkl', 'rb')) == paths and \
+                    np.load(file_prefix+'.npy', mmap_mode='r').shape == shape
+        if(not reuse):
+            data = np.lib.format.open_memmap(file_prefix+'.npy', mode='w+', dtype=dtype, shape=shape)
+            for i, feat in enumerate(paths):
+                if(not external):
+                    feat = self.path +'/'+ feat
+                data[i] = np.load(feat).reshape(-1)
+                if(not self.silence and (i+1) % 10000 == 0):
+                    logging.info("\tConsolidated "+str(i+1)+'/'+str(len(paths))+' feature vectors...')
+            data.flush()
+            del data
+            pk.dump(paths, open(file_prefix+'_paths.pkl', 'wb'), protocol=pk.HIGHEST_PROTOCOL)
+        
+        if(id not in self.consolidated_features):
+            self.consolidated_features[id] = dict()
+        self.consolidated_features[id][set_name] = {'file_prefix': file_prefix, 'index': index}
+        self.__features_files.pop((id, set_name), None)
+        
+        if(not self.silence):
+            if(reuse):
+                logging.info('Reusing consolidated features for "'+set_name+'" set inputs with id "'+id+'" stored in '+file_prefix+'.npy')
+            else:
+                logging.info('Consolidated '+str(len(paths))+' feature vectors for "'+set_name+'" set inputs with id "'+id+'" in '+file_prefix+'.npy')
+    
+    
+    def __readFeatures(self, X, feat_len, id, set_name, external, buffers=None):
+        """
+            Returns a float32 array with the feature vectors stored in the files 'X', read from the consolidated
+            features of (id, set_name) if available or from each .npy file otherwise.
+        """
+        if(id in self.consolidated_features and set_name in self.consolidated_features[id]):
+            if((id, set_name) not in self.__features_files):
+                self.__features_files[(id, set_name)] = np.load(self.consolidated_features[id][set_name]['file_prefix']+'.npy',
+                                                                mmap_mode='r')
+            index = self.consolidated_features[id][set_name]['index']
+            rows = np.array([index[feat] for feat in X], dtype=np.int64)
+            stored = self.__features_files[(id, set_name)]
+            features = batchArray(buffers, ('features', id), (len(rows),)+stored.shape[1:], np.float32)
+            if(stored.dtype == np.float32):
+                np.take(stored, rows, axis=0, out=features)
+            else:
+                features[...] = stored[rows]
+            return features
         
+        features = batchArray(buffers, ('features', id), (len(X), feat_len), np.float32, 0)
         for i, feat in enumerate(X):
             if(not external):
                 feat = self.path +'/'+ feat
-
-            feat = np.load(feat)
-
-            if(data_augmentation):
-                noise_mean = 0.0
-                noise_dev = 0.01
-                noise = np.random.normal(noise_mean, noise_dev, feat.shape)
-                feat += noise
-
-            if(normalization):
-                if normalization_type == 'L2':
-                    feat = feat / np.linalg.norm(feat,ord=2)
-                    
-            features[i] = feat
-            
-        return np.array(features)
+            features[i] = np.load(feat).reshape(-1)
+        return features
     
     # ------------------------------------------------------- #
     #       TYPE 'text' SPECIFIC FUNCTIONS
     # ------------------------------------------------------- #
     
     def preprocessText(self, annotations_list, id, set_name, tokenization, build_vocabulary, max_text_len,
-                       max_words, offset, fill, min_occ, pad_on_batch):
+                       max_words, offset, fill, min_occ, pad_on_batch, stream=False):
         
-        sentences = []
-        if(isinstance(annotations_list, str) and os.path.isfile(annotations_list)):
-            with open(annotations_list, 'r') as list_:
-                for line in list_:
-                    sentences.append(line.rstrip('\n'))
-        else:
+        if(not isinstance(annotations_list, str) or not os.path.isfile(annotations_list)):
             raise Exception('Wrong type for "annotations_list". It must be a path to a text file with the sentences or a list of sentences. '
                             'It currently is: %s'%(str(annotations_list)))
             
@@ -837,14 +1647,21 @@ class Dataset(object):
             raise Exception('Tokenization procedure "'+ tokenization +'" is not implemented.')
             
         # Tokenize sentences
+        counter = None
         if(max_text_len != 0): # will only tokenize if we are not using the whole sentence as a class
-            for i in range(len(sentences)):
-                sentences[i] = tokfun(sentences[i])
+            [sentences, counter] = self.tokenizeFile(annotations_list, tokenization, id, set_name, stream=stream)
+        elif(stream):
+            sentences = self.streamLines(annotations_list, id, set_name)
+        else:
+            sentences = []
+            with open(annotations_list, 'r') as list_:
+                for line in list_:
+                    sentences.append(line.rstrip('\n'))
     
         # Build vocabulary
         error_vocab = False
         if build_vocabulary == True:
-            self.build_vocabulary(sentences, id, tokfun, max_text_len != 0, min_occ=min_occ, n_words=max_words)
+            self.build_vocabulary(sentences, id, tokfun, max_text_len != 0, min_occ=min_occ, n_words=max_words, counter=counter)
         elif isinstance(build_vocabulary, str):
             if build_vocabulary in self.vocabulary:
                 self.vocabulary[id] = self.vocabulary[build_vocabulary]
@@ -866,26 +1683,31 @@ class Dataset(object):
         return sentences
     
     
-    def build_vocabulary(self, captions, id, tokfun, do_split, min_occ=0, n_words=0):
+    def build_vocabulary(self, captions, id, tokfun, do_split, min_occ=0, n_words=0, counter=None):
         """
             Vocabulary builder for data of type 'text'
+            
+            :param counter: Counter with the words of the captions if they are already counted (see tokenizeFile())
         """
         if(not self.silence):
             logging.info("Creating vocabulary for data with id '"+id+"'.")
         
         counters = []
         sentence_counts = []
-        counter = Counter()
-        sentence_count = 0
-        for line in captions:
-            if(do_split):
-                #tokenized = tokfun(line)º
-                #words = tokenized.strip().split(' ')
-                words = line.strip().split(' ')
-                counter.update(words)
-            else:
-                counter.update([line])
-            sentence_count += 1
+        if(counter is not None and do_split):
+            sentence_count = len(captions)
+        else:
+            counter = Counter()
+            sentence_count = 0
+            for line in captions:
+                if(do_split):
+                    #tokenized = tokfun(line)º
+                    #words = tokenized.strip().split(' ')
+                    words = line.strip().split(' ')
+                    counter.update(words)
+                else:
+                    counter.update([line])
+                sentence_count += 1
             
         if(not do_split and not self.silence):
             logging.info('Using whole sentence as a single word.')
@@ -942,7 +1764,7 @@ class Dataset(object):
             self.vocabulary_len[id] = len(vocab_count) + len(self.extra_words)
         
         else:
-            old_keys = self.vocabulary[id]['words2idx'].keys()
+            old_keys = self.vocabulary[id]['words2idx']
             new_keys = dictionary.keys()
             added = 0
             for key in new_keys:
@@ -961,6 +1783,127 @@ class Dataset(object):
         
 
 
+    def tokenizeFile(self, path, tokenization, id, set_name, stream=False, chunk_size=10000):
+        """
+            Tokenizes the sentences of the file 'path' (one per line) with the method 'tokenization'. The sentences
+            are tokenized by chunks in self.tokenization_workers processes and, if self.tokenization_cache is True,
+            the result is stored in self.tokenization_cache_path (self.path+'/tokenized' if None) identified by the
+            content of the file and the tokenization, so it is only computed once. The streamed sentences are always
+            read from this folder.
+            Returns [sentences, counter], with the tokenized sentences (a LineFile if stream == True) and a Counter
+            of their words (filled in order of first appearance, as if it was counted sentence by sentence).
+        """
+        cache_prefix = None
+        if(self.tokenization_cache or stream):
+            cache_prefix = self.__tokenizationCachePrefix(path, tokenization)
+        if(cache_prefix is None and stream):
+            raise Exception('The tokenized text can not be streamed without a writable tokenization cache folder (see tokenization_cache_path).')
+        
+        if(cache_prefix is not None and os.path.isfile(cache_prefix+'.txt') and os.path.isfile(cache_prefix+'_counts.pkl')):
+            if(not self.silence):
+                logging.info('Reusing tokenized text stored in '+cache_prefix+'.txt')
+            counter = Counter()
+            for word, count in pk.load(open(cache_prefix+'_counts.pkl', 'rb')):
+                counter[word] = count
+        else:
+            def chunks():
+                chunk = []
+                with open(path, 'r') as list_:
+                    for line in list_:
+                        chunk.append(line.rstrip('\n'))
+                        if(len(chunk) == chunk_size):
+                            yield chunk
+                            chunk = []
+                if(chunk):
+                    yield chunk
+            
+            sentences = []
+            counter = Counter()
+            words = [] # in order of first appearance
+            if(cache_prefix is not None):
+                tokenized_file = open(cache_prefix+'.txt.tmp', 'wb')
+            for [tokenized, chunk_counter, chunk_words] in self.__tokenizeChunks(chunks(), tokenization):
+                for word in chunk_words:
+                    if word not in counter:
+                        words.append(word)
+                    counter[word] += chunk_counter[word]
+                if(cache_prefix is not None):
+                    tokenized_file.write(''.join([sentence+'\n' for sentence in tokenized]))
+                if(not stream):
+                    sentences += tokenized
+            if(cache_prefix is not None):
+                tokenized_file.close()
+                pk.dump([(word, counter[word]) for word in words], open(cache_prefix+'_counts.pkl', 'wb'),
+                        protocol=pk.HIGHEST_PROTOCOL)
+                os.rename(cache_prefix+'.txt.tmp', cache_prefix+'.txt')
+            if(not stream):
+                return [sentences, counter]
+        
+        if(stream):
+            return [self.streamLines(cache_prefix+'.txt', id, set_name), counter]
+        sentences = []
+        with open(cache_prefix+'.txt', 'r') as list_:
+            for line in list_:
+                sentences.append(line.rstrip('\n'))
+        return [sentences, counter]
+    
+    
+    def __tokenizeChunks(self, chunks, tokenization):
+        """
+            Yields the result of tokenizeSentences() for each chunk of sentences, in order. When there is
+            more than one chunk they are tokenized in parallel by self.tokenization_workers processes.
+        """
+        tasks = ((tokenization, chunk) for chunk in chunks)
+        return self.__parallelMap(tokenizeSentences, tasks, self.tokenization_workers)
+    
+    
+    def __parallelMap(self, function, tasks, n_workers=None):
+        """
+            Yields function(*task, dataset=self) for each task of the iterator 'tasks', in order. When there is
+            more than one task they are run in parallel by n_workers processes (None for one per CPU core),
+            each one with a copy of the Dataset (see ProcessDataLoader).
+            
+            :param function: module-level function with a 'dataset' argument (the copy of the worker if None)
+        """
+        tasks = iter(tasks)
+        first = next(tasks, None)
+        second = next(tasks, None)
+        if(n_workers is None):
+            n_workers = multiprocessing.cpu_count()
+        if(second is None or n_workers <= 1):
+            for task in itertools.chain([first, second], tasks):
+                if(task is not None):
+                    yield function(*task, dataset=self)
+            return
+        
+        loader = ProcessDataLoader(self, n_workers)
+        try:
+            for result in loader.imap(itertools.chain([first, second], tasks), function):
+                yield result
+        finally:
+            loader.close()
+    
+    
+    def __tokenizationCachePrefix(self, path, tokenization):
+        """
+            Prefix of the files storing the tokenization of the file 'path' (None if they can not be created).
+        """
+        cache_path = self.tokenization_cache_path
+        if(cache_path is None):
+            cache_path = self.path+'/tokenized'
+        try:
+            create_dir_if_not_exists(cache_path)
+        except OSError:
+            return None
+        if(not os.access(cache_path, os.W_OK)):
+            return None
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024*1024), ''):
+                md5.update(block)
+        return cache_path+'/'+md5.hexdigest()+'_'+tokenization
+    
+    
     def loadText(self, X, vocabularies, max_len, offset, fill, pad_on_batch):
         """
             Text encoder. Transforms samples from a text representation into a numerical one.
@@ -1014,28 +1957,217 @@ class Dataset(object):
             X_out = (X_out, X_mask)
 
         return X_out
-
     
-    # ------------------------------------------------------- #
-    #       Tokenization functions
-    # ------------------------------------------------------- #
-
-    def tokenize_basic(self, caption, lowercase=True):
+    
+    def encodeText(self, id, set_name):
         """
-            Basic tokenizer for the input/output data of type 'text':
-                Splits punctuation
+            Encodes the 'text' samples with identifier 'id' from the set 'set_name' using their vocabulary.
+            The result is stored in self.text_encoded[id][set_name] as a ragged array: the indices of the words
+            of all the samples concatenated ('tokens', int32), the position of the first word of each sample
+            ('starts') and its number of words ('lengths'). The batches are built from it by loadEncodedText().
+        """
+        samples = self.__textSamples(id, set_name)
+        vocab = self.vocabulary[id]['words2idx']
+        unk = vocab['<unk>']
+        n_samples = len(samples)
+        
+        whole_sentence = self.max_text_len[id][set_name] == 0
+        if(whole_sentence): # use whole sentence as class
+            tokens = np.array([vocab.get(x, unk) for x in samples], dtype=np.int32)
+            lengths = np.ones(n_samples, dtype=np.int32)
+            split_lengths = lengths
+        else:
+            tokens = []
+            lengths = np.zeros(n_samples, dtype=np.int32)
+            split_lengths = np.zeros(n_samples, dtype=np.int32) # lengths used by pad_on_batch
+            for i, x in enumerate(samples):
+                words = x.strip().split(' ')
+                tokens.extend([vocab.get(w, unk) for w in words])
+                lengths[i] = len(words)
+                split_lengths[i] = len(x.split(' '))
+            tokens = np.array(tokens, dtype=np.int32)
+        starts = np.zeros(n_samples, dtype=np.int64)
+        np.cumsum(lengths[:-1], out=starts[1:])
+        
+        if(id not in self.text_encoded):
+            self.text_encoded[id] = dict()
+        self.text_encoded[id][set_name] = {'tokens': tokens, 'starts': starts, 'lengths': lengths,
+                                           'split_lengths': split_lengths, 'whole_sentence': whole_sentence,
+                                           'vocabulary_len': len(vocab)}
+        
+        if(not self.silence):
+            logging.info('Encoded '+ str(n_samples) +' "'+ set_name +'" samples of type "text" with id "'+ id +'" ('+ str(len(tokens)) +' words).')
+    
+    
+    def __textSamples(self, id, set_name):
+        if(id in self.ids_inputs):
+            return self.splits[set_name].X[id]
+        return self.splits[set_name].Y[id]
+    
+    
+    def __getEncodedText(self, id, set_name):
+        """
+            Returns self.text_encoded[id][set_name], encoding the samples again if they are missing or outdated
+            (e.g. words have been appended to the vocabulary after encoding them).
+        """
+        encoded = self.text_encoded.get(id, {}).get(set_name)
+        if(encoded is None or
+           encoded['vocabulary_len'] != len(self.vocabulary[id]['words2idx']) or
+           encoded['whole_sentence'] != (self.max_text_len[id][set_name] == 0)):
+            self.encodeText(id, set_name)
+            encoded = self.text_encoded[id][set_name]
+        return encoded
+    
+    
+    def loadEncodedText(self, indices, id, set_name, max_len, offset, fill, pad_on_batch, buffers=None):
+        """
+            Vectorized version of loadText(). Builds the batch formed by the samples in positions 'indices'
+            of the set 'set_name' from the words encoded by encodeText().
+            If fill=='start' the resulting vector will be filled with 0s at the beginning, 
+            if fill=='end' it will be filled with 0s at the end.
+            If 'buffers' (a BatchBuffers, see PrefetchDataLoader) is given, the batch is built in its arrays.
+        """
+        if(set_name not in self.text_encoded.get(id, {})):
+            samples = self.__textSamples(id, set_name)
+            if(isinstance(samples, LineFile)): # streamed texts are encoded when read
+                return self.loadText([samples[i] for i in indices], self.vocabulary[id], max_len, offset, fill, pad_on_batch)
+        encoded = self.__getEncodedText(id, set_name)
+        vocab = self.vocabulary[id]['words2idx']
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = encoded['starts'][indices]
+        if(max_len == 0): # use whole sentence as class
+            return encoded['tokens'][starts]
+        
+        # process text as a sequence of words
+        n_batch = len(indices)
+        lengths = encoded['lengths'][indices].astype(np.int64)
+        if pad_on_batch:
+            max_len_batch = min(int(encoded['split_lengths'][indices].max()) + 1, max_len)
+        else:
+            max_len_batch = max_len
+        X_out = batchArray(buffers, ('text', id), (n_batch, max_len_batch), 'int32', self.extra_words['<pad>'])
+        X_mask = batchArray(buffers, ('text_mask', id), (n_batch, max_len_batch), 'int8', 0)
+        if max_len_batch == max_len:
+            max_len_batch -= 1 # always leave space for <eos> symbol
+        # position of the first word of each sample and number of words kept (w.r.t. max_len)
+        if(fill == 'start'):
+            offsets_j = max_len_batch - lengths
+            lengths_j = lengths + np.minimum(offsets_j, 0)
+            offsets_j = np.maximum(offsets_j, 0)
+        else:
+            offsets_j = np.zeros(n_batch, dtype=np.int64)
+            lengths_j = np.minimum(lengths, max_len_batch)
+        
+        # Move the text to the right 'offset' positions (the words moved beyond the end are dropped)
+        offsets_j += offset
+        if offset > 0: # null symbol in the first positions
+            X_out[:, :offset] = vocab['<null>']
+        
+        # gather the words of all the samples at once
+        words = np.arange(X_out.shape[1])[np.newaxis, :] - offsets_j[:, np.newaxis]
+        filled = (words >= 0) & (words < lengths_j[:, np.newaxis])
+        X_out[filled] = encoded['tokens'][(starts[:, np.newaxis] + words)[filled]]
+        X_mask[filled] = 1  # fill mask
+        eos = lengths_j + offsets_j
+        with_eos = eos < X_out.shape[1]
+        X_mask[np.nonzero(with_eos)[0], eos[with_eos]] = 1  # add additional 1 for the <eos> symbol
+        
+        return (X_out, X_mask)
+    
+    
+    def getTextLengths(self, id, set_name):
+        """
+            Returns the length of each 'text' sample with identifier 'id' in the set 'set_name' (in the stored order),
+            measured as the number of positions with mask 1 (words and <eos>) when encoded with max_text_len positions.
+            It is computed from the number of words stored by encodeText(), without building the samples.
+            The samples streamed from disk (storage='stream') are not encoded: their words are counted reading
+            the file by chunks of lines.
+        """
+        max_len = self.max_text_len[id][set_name]
+        if(max_len == 0):
+            raise Exception('The lengths can only be computed for "text" samples processed as sequences of words (max_text_len > 0).')
+        samples = self.__textSamples(id, set_name)
+        if(set_name not in self.text_encoded.get(id, {}) and isinstance(samples, LineFile)):
+            lengths = self.__countWords(samples)
+        else:
+            lengths = self.__getEncodedText(id, set_name)['lengths'].astype(np.int64)
+        max_len_batch = max_len - 1 # space for <eos> symbol
+        # positions [first, eos) filled with words and <eos> in position eos
+        if(self.fill_text[id] == 'start'):
+            first = np.maximum(max_len_batch - lengths, 0)
+            eos = np.empty_like(lengths)
+            eos.fill(max_len_batch)
+        else:
+            first = np.zeros_like(lengths)
+            eos = np.minimum(lengths, max_len_batch)
+        # positions moved beyond max_len by the offset are dropped
+        limit = max_len - self.text_offset[id]
+        return np.maximum(np.minimum(eos, limit) - first, 0) + (eos < limit)
+    
+    
+    def __countWords(self, lines, chunk_size=100000):
+        """
+            Returns the number of words of each line of the LineFile 'lines' (as counted by encodeText()), reading
+            'chunk_size' lines at a time.
+        """
+        lengths = np.zeros(len(lines), dtype=np.int64)
+        for first in range(0, len(lines), chunk_size):
+            chunk = lines[first:first+chunk_size]
+            lengths[first:first+len(chunk)] = [len(x.strip().split(' ')) for x in chunk]
+        return lengths
+    
+    
+    def __loadTextOutput(self, indices, id, set_name, buffers=None):
+        """
+            Builds the targets of the 'text' output 'id' for the samples in positions 'indices' of the set 'set_name':
+            one-hot vectors, or the indices of the words (with an additional axis of length 1) if the output
+            was loaded with sparse_targets=True. When sample_weights is True they are returned with the mask.
+        """
+        y = self.loadEncodedText(indices, id, set_name,
+                                 self.max_text_len[id][set_name], self.text_offset[id],
+                                 fill=self.fill_text[id], pad_on_batch=self.pad_on_batch[id], buffers=buffers)
+        sparse = self.sparse_targets.get(id, False)
+        # Use whole sentence as class (classifier model)
+        if self.max_text_len[id][set_name] == 0:
+            if sparse:
+                return y[:, np.newaxis]
+            return self.__oneHot(y, self.n_classes_text[id], ('text_one_hot', id), buffers)
+        
+        # Use words separately (generator model)
+        if sparse:
+            y_aux = y[0][:, :, np.newaxis]
+        else:
+            y_aux = self.__oneHot(y[0], self.n_classes_text[id], ('text_one_hot', id), buffers)
+        if self.sample_weights[id][set_name]:
+            y_aux = (y_aux, y[1]) # join data and mask
+        return y_aux
+
+    
+    def __oneHot(self, labels, n_classes, key, buffers=None):
+        """
+            Returns the uint8 one-hot vectors (along a new last axis of length n_classes) of the class indices
+            'labels', built in the array 'key' of 'buffers' if given (see PrefetchDataLoader).
+        """
+        labels = np.asarray(labels, dtype=np.int64)
+        y = batchArray(buffers, key, labels.shape + (n_classes,), np.uint8, 0)
+        y.reshape(-1, n_classes)[np.arange(labels.size), labels.ravel()] = 1
+        return y
+    
+    
+    # ------------------------------------------------------- #
+    #       Tokenization functions
+    # ------------------------------------------------------- #
+
+    def tokenize_basic(self, caption, lowercase=True):
+        """
+            Basic tokenizer for the input/output data of type 'text':
+                Splits punctuation
                 Lowercase
         """
-        punct = ['.', ';', r"/", '[', ']', '"', '{', '}', '(', ')', '=', '+', '\\', '_', '-', '>', '<', '@', '`', ',', '?', '!']
-        def processPunctuation(inText):
-            outText = inText
-            for p in punct:
-                outText = outText.replace(p, ' ' + p + ' ')
-            return outText
         resAns = caption.lower() if lowercase else caption
-        resAns = resAns.replace('\n', ' ')
-        resAns = resAns.replace('\t', ' ')
-        resAns = processPunctuation(resAns)
+        resAns = resAns.replace('\n', ' ').replace('\t', ' ')
+        # joining the pieces around each symbol with spaces surrounds it with spaces
+        resAns = ' '.join(_BASIC_PUNCT.split(resAns))
         resAns = resAns.replace('  ', ' ')
         return resAns
 
@@ -1046,17 +2178,11 @@ class Dataset(object):
                 Removes punctuation
                 Lowercase
         """
-        punct = ['.', ';', r"/", '[', ']', '"', '{', '}', '(', ')',
-                 '=', '+', '\\', '_', '-', '>', '<', '@', '`', ',', '?', '!',
-                 '¿', '¡', '\n', '\t', '\r']
-        def processPunctuation(inText):
-            outText = inText
-            for p in punct:
-                outText = outText.replace(p, '')
-            return outText
         resAns = caption.lower() if lowercase else caption
-        resAns = processPunctuation(resAns)
-        resAns = re.sub('[  ]+', ' ', resAns)
+        resAns = _AGGRESSIVE_PUNCT.sub('', resAns)
+        resAns = resAns.replace('¿', '').replace('¡', '')
+        resAns = _AGGRESSIVE_BREAKS.sub('', resAns)
+        resAns = _SPACES.sub(' ', resAns)
         resAns = resAns.strip()
         return resAns
 
@@ -1066,11 +2192,7 @@ class Dataset(object):
                 Removes some punctuation
                 Lowercase
         """
-        tokenized = re.sub('[.,"\n\t]+', '', caption)
-        tokenized = re.sub('[  ]+', ' ', tokenized)
-        tokenized = map(lambda x: x.lower(), tokenized.split())
-        tokenized = " ".join(tokenized)
-        return tokenized
+        return " ".join(_ICANN_PUNCT.sub('', caption).lower().split())
 
 
     def tokenize_montreal(self, caption, lowercase=True):
@@ -1079,12 +2201,9 @@ class Dataset(object):
                 Removes some punctuation
                 Lowercase
         """
-        tokenized = re.sub('[.,"\n\t]+', '', caption.strip())
-        tokenized = re.sub('[\']+', " '", tokenized)
-        tokenized = re.sub('[  ]+', ' ', tokenized)
-        tokenized = map(lambda x: x.lower(), tokenized.split())
-        tokenized = " ".join(tokenized)
-        return tokenized
+        tokenized = _ICANN_PUNCT.sub('', caption.strip())
+        tokenized = _MONTREAL_APOSTROPHES.sub(" '", tokenized)
+        return " ".join(tokenized.lower().split())
 
     def tokenize_soft(self, caption, lowercase=True):
         """
@@ -1092,89 +2211,33 @@ class Dataset(object):
                 Removes very little punctuation
                 Lowercase
         """
-        tokenized = re.sub('[\n\t]+', '', caption.strip())
-        tokenized = re.sub('[\.]+', ' . ', tokenized)
-        tokenized = re.sub('[,]+', ' , ', tokenized)
-        tokenized = re.sub('[!]+', ' ! ', tokenized)
-        tokenized = re.sub('[?]+', ' ? ', tokenized)
-        tokenized = re.sub('[\{]+', ' { ', tokenized)
-        tokenized = re.sub('[\}]+', ' } ', tokenized)
-        tokenized = re.sub('[\(]+', ' ( ', tokenized)
-        tokenized = re.sub('[\)]+', ' ) ', tokenized)
-        tokenized = re.sub('[\[]+', ' [ ', tokenized)
-        tokenized = re.sub('[\]]+', ' ] ', tokenized)
-        tokenized = re.sub('["]+', ' " ', tokenized)
-        tokenized = re.sub('[\']+', " ' ", tokenized)
-        tokenized = re.sub('[  ]+', ' ', tokenized)
-        tokenized = map(lambda x: x.lower(), tokenized.split())
-        tokenized = " ".join(tokenized)
-        return tokenized
+        tokenized = _SOFT_NEWLINES.sub('', caption.strip())
+        # each run of a punctuation symbol is replaced by a single symbol surrounded by spaces
+        tokenized = ' '.join(_SOFT_PUNCT.split(tokenized))
+        return " ".join(tokenized.lower().split())
 
 
     def tokenize_questions(self, caption):
         """
             Basic tokenizer for VQA questions
         """
-        contractions = {"aint": "ain't", "arent": "aren't", "cant": "can't", "couldve": "could've", "couldnt": "couldn't",
-                "couldn'tve": "couldn’t’ve", "couldnt’ve": "couldn’t’ve", "didnt": "didn’t", "doesnt": "doesn’t",
-                "dont": "don’t", "hadnt": "hadn’t", "hadnt’ve": "hadn’t’ve", "hadn'tve": "hadn’t’ve",
-                "hasnt": "hasn’t", "havent": "haven’t", "hed": "he’d", "hed’ve": "he’d’ve", "he’dve": "he’d’ve",
-                "hes": "he’s", "howd": "how’d", "howll": "how’ll", "hows": "how’s", "Id’ve": "I’d’ve",
-                "I’dve": "I’d’ve", "Im": "I’m", "Ive": "I’ve", "isnt": "isn’t", "itd": "it’d", "itd’ve": "it’d’ve",
-                "it’dve": "it’d’ve", "itll": "it’ll", "let’s": "let’s", "maam": "ma’am", "mightnt": "mightn’t",
-                "mightnt’ve": "mightn’t’ve", "mightn’tve": "mightn’t’ve", "mightve": "might’ve", "mustnt": "mustn’t",
-                "mustve": "must’ve", "neednt": "needn’t", "notve": "not’ve", "oclock": "o’clock", "oughtnt": "oughtn’t",
-                "ow’s’at": "’ow’s’at", "’ows’at": "’ow’s’at", "’ow’sat": "’ow’s’at", "shant": "shan’t",
-                "shed’ve": "she’d’ve", "she’dve": "she’d’ve", "she’s": "she’s", "shouldve": "should’ve",
-                "shouldnt": "shouldn’t", "shouldnt’ve": "shouldn’t’ve", "shouldn’tve": "shouldn’t’ve",
-                "somebody’d": "somebodyd", "somebodyd’ve": "somebody’d’ve", "somebody’dve": "somebody’d’ve",
-                "somebodyll": "somebody’ll", "somebodys": "somebody’s", "someoned": "someone’d",
-                "someoned’ve": "someone’d’ve", "someone’dve": "someone’d’ve", "someonell": "someone’ll",
-                "someones": "someone’s", "somethingd": "something’d", "somethingd’ve": "something’d’ve",
-                "something’dve": "something’d’ve", "somethingll": "something’ll", "thats": "that’s",
-                "thered": "there’d", "thered’ve": "there’d’ve", "there’dve": "there’d’ve", "therere": "there’re",
-                "theres": "there’s", "theyd": "they’d", "theyd’ve": "they’d’ve", "they’dve": "they’d’ve",
-                "theyll": "they’ll", "theyre": "they’re", "theyve": "they’ve", "twas": "’twas", "wasnt": "wasn’t",
-                "wed’ve": "we’d’ve", "we’dve": "we’d’ve", "weve": "we've", "werent": "weren’t", "whatll": "what’ll",
-                "whatre": "what’re", "whats": "what’s", "whatve": "what’ve", "whens": "when’s", "whered":
-                    "where’d", "wheres": "where's", "whereve": "where’ve", "whod": "who’d", "whod’ve": "who’d’ve",
-                "who’dve": "who’d’ve", "wholl": "who’ll", "whos": "who’s", "whove": "who've", "whyll": "why’ll",
-                "whyre": "why’re", "whys": "why’s", "wont": "won’t", "wouldve": "would’ve", "wouldnt": "wouldn’t",
-                "wouldnt’ve": "wouldn’t’ve", "wouldn’tve": "wouldn’t’ve", "yall": "y’all", "yall’ll": "y’all’ll",
-                "y’allll": "y’all’ll", "yall’d’ve": "y’all’d’ve", "y’alld’ve": "y’all’d’ve", "y’all’dve": "y’all’d’ve",
-                "youd": "you’d", "youd’ve": "you’d’ve", "you’dve": "you’d’ve", "youll": "you’ll",
-                "youre": "you’re", "youve": "you’ve"}
-        punct = [';', r"/", '[', ']', '"', '{', '}', '(', ')', '=', '+', '\\', '_', '-', '>', '<', '@', '`', ',', '?', '!']
-        commaStrip = re.compile("(\d)(\,)(\d)")
-        periodStrip = re.compile("(?!<=\d)(\.)(?!\d)")
-        manualMap = {'none': '0', 'zero': '0', 'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5', 'six': '6',
-             'seven': '7', 'eight': '8', 'nine': '9', 'ten': '10'}
-        articles = ['a', 'an', 'the']
-
         def processPunctuation(inText):
-            outText = inText
-            for p in punct:
-                if (p + ' ' in inText or ' ' + p in inText) or (re.search(commaStrip, inText) != None):
-                    outText = outText.replace(p, '')
-                else:
-                    outText = outText.replace(p, ' ')
-            outText = periodStrip.sub("", outText, re.UNICODE)
+            if(_QUESTIONS_COMMA_STRIP.search(inText) is not None):
+                outText = inText.translate(None, _QUESTIONS_PUNCT_CHARS)
+            else:
+                # symbols next to a space are removed, the rest are replaced by a space
+                removed = ''.join([p for p in _QUESTIONS_PUNCT if p + ' ' in inText or ' ' + p in inText])
+                outText = inText.translate(_QUESTIONS_PUNCT_TO_SPACE, removed)
+            outText = _QUESTIONS_PERIOD_STRIP.sub("", outText, re.UNICODE)
             return outText
 
         def processDigitArticle(inText):
             outText = []
-            tempText = inText.lower().split()
-            for word in tempText:
-                word = manualMap.setdefault(word, word)
-                if word not in articles:
-                    outText.append(word)
-                else:
-                    pass
-            for wordId, word in enumerate(outText):
-                if word in contractions:
-                    outText[wordId] = contractions[word]
-            outText = ' '.join(outText)
-            return outText
+            for word in inText.lower().split():
+                word = _QUESTIONS_MANUAL_MAP.get(word, word)
+                if word not in _QUESTIONS_ARTICLES:
+                    outText.append(_QUESTIONS_CONTRACTIONS.get(word, word))
+            return ' '.join(outText)
 
         resAns = caption.lower()
         resAns = resAns.replace('\n', ' ')
@@ -1207,6 +2270,7 @@ class Dataset(object):
             if(id not in self.paths_frames):
                 self.paths_frames[id] = dict()
             self.paths_frames[id][set_name] = data
+            self.__setFirstFrames(counts_frames, id, set_name)
             self.max_video_len[id] = max_video_len
             self.img_size[id] = img_size
             self.img_size_crop[id] = img_size_crop
@@ -1240,6 +2304,7 @@ class Dataset(object):
             
             self.paths_frames[id][set_name] = paths_frames
             self.counts_frames[id][set_name] = counts_frames
+            self.__setFirstFrames(counts_frames, id, set_name)
             self.max_video_len[id] = max_video_len
             self.img_size[id] = img_size
             self.img_size_crop[id] = img_size_crop
@@ -1252,149 +2317,119 @@ class Dataset(object):
         return video_indices
     
     
+    def __setFirstFrames(self, counts_frames, id, set_name):
+        """
+            Stores the position in paths_frames of the first frame of each video given its number of frames.
+        """
+        first_frames = np.zeros(len(counts_frames), dtype=np.int64)
+        np.cumsum(counts_frames[:-1], out=first_frames[1:])
+        if(id not in self.first_frames):
+            self.first_frames[id] = dict()
+        self.first_frames[id][set_name] = first_frames
+    
+    
+    def getFirstFrames(self, id, set_name):
+        """
+            Returns the positions in self.paths_frames[id][set_name] of the first frame of each video.
+            They are indexed by sample for the type 'video' and by video index for the type 'video-features'.
+        """
+        if(set_name not in self.first_frames.get(id, {})):
+            # Datasets stored before the first frames were precomputed
+            if(id in self.counts_frames and set_name in self.counts_frames[id]):
+                self.__setFirstFrames(np.asarray(self.counts_frames[id][set_name], dtype=np.int64), id, set_name)
+            else:
+                self.__setFirstFrames(np.asarray(self.splits[set_name].X[id], dtype=np.int64), id, set_name)
+        return self.first_frames[id][set_name]
+    
+    
     def loadVideos(self, n_frames, id, last, set_name, max_len, normalization_type, normalization, meanSubstraction, dataAugmentation):
-        n_videos = len(n_frames)
-        V = np.zeros((n_videos, max_len*3, self.img_size_crop[id][0], self.img_size_crop[id][1]))
-        
-        idx = [0 for i in range(n_videos)]
-        # recover all indices from image's paths of all videos
-        for v in range(n_videos):
-            this_last = last+v                
-            if this_last >= n_videos:
-                v = this_last%n_videos
-                this_last = v
-            idx[v] = int(sum(eval('self.X_'+set_name+'[id][:this_last]')))
-        
-        # load images from each video
-        for enum, (n, i) in enumerate(zip(n_frames, idx)):
-            paths = self.paths_frames[id][set_name][i:i+n]
-            # returns numpy array with dimensions (batch, channels, height, width)
-            images = self.loadImages(paths, id, normalization_type, normalization, meanSubstraction, dataAugmentation)
-            # fills video matrix with each frame (fills with 0s or removes remaining frames w.r.t. max_len)
-            len_j = images.shape[0]
-            offset_j = max_len - len_j
-            if offset_j < 0:
-                len_j = len_j + offset_j
-                offset_j = 0
-            for j in range(len_j):
-                V[enum, (j+offset_j)*3:(j+offset_j+1)*3] = images[j]
-        
-        return V
+        """
+            Loads the videos in the consecutive positions starting at 'last' of the set 'set_name' (see loadVideosByIndex()).
+        """
+        indices = (last + np.arange(len(n_frames))) % self.splits[set_name].len
+        return self.loadVideosByIndex(n_frames, id, indices, set_name, max_len, normalization_type, normalization,
+                                      meanSubstraction, dataAugmentation)
     
     
-    def loadVideoFeatures(self, idx_videos, id, set_name, max_len, normalization_type, normalization, feat_len, external=False, data_augmentation=True):
+    def loadVideoFeatures(self, idx_videos, id, set_name, max_len, normalization_type, normalization, feat_len, external=False, data_augmentation=True,
+                          buffers=None):
         
         n_videos = len(idx_videos)
-        features = np.zeros((n_videos, max_len, feat_len))
-        
-        n_frames = [self.counts_frames[id][set_name][i_idx_vid] for i_idx_vid in idx_videos]
+        idx_videos = np.asarray(idx_videos, dtype=np.int64)
+        n_frames = np.asarray(self.counts_frames[id][set_name], dtype=np.int64)[idx_videos]
         
-        idx = [0 for i_nvid in range(n_videos)]
         # recover all initial indices from image's paths of all videos
-        for v in range(n_videos):
-            last_idx = idx_videos[v]
-            idx[v] = int(sum(self.counts_frames[id][set_name][:last_idx]))
-
+        idx = self.getFirstFrames(id, set_name)[idx_videos]
 
         # select subset of max_len from n_frames[i]
-        selected_frames = [0 for i_nvid in range(n_videos)]
+        positions = []
+        videos = []
+        slots = []
         for enum, (n, i) in enumerate(zip(n_frames, idx)):
-            paths = self.paths_frames[id][set_name][i:i + n]
-
             if(data_augmentation): # apply random frames selection
                 selected_idx = sorted(random.sample(range(n), min(max_len, n)))
             else: # apply equidistant frames selection
                 selected_idx = np.round(np.linspace(0, n-1, min(max_len, n)))
                 #splits = np.array_split(range(n), min(max_len, n))
                 #selected_idx = [s[0] for s in splits]
+            positions += [i + int(s) for s in selected_idx]
+            videos += [enum] * len(selected_idx)
+            slots += range(len(selected_idx))
 
-            selected_paths = [paths[int(idx)] for idx in selected_idx]
-            selected_frames[enum] = selected_paths
-
-
-        # load features from selected paths
-        for i, vid_paths in enumerate(selected_frames):
-            for j, feat in enumerate(vid_paths):
-                if (not external):
-                    feat = self.path + '/' + feat
-
-                # Check if the filename includes the extension
-                feat = np.load(feat)
-
-                if (data_augmentation):
-                    noise_mean = 0.0
-                    noise_dev = 0.01
-                    noise = np.random.normal(noise_mean, noise_dev, feat.shape)
-                    feat += noise
-
-                if (normalization):
-                    if normalization_type == 'L2':
-                        feat = feat / np.linalg.norm(feat, ord=2)
-
-                features[i, j] = feat
-
-        '''
-        # load images from each video
-        for enum, (n, i) in enumerate(zip(n_frames, idx)):
-            paths = self.paths_frames[id][set_name][i:i+n]
-        
-            for j, feat in enumerate(paths):
-                if(not external):
-                    feat = self.path +'/'+ feat
-
-                # Check if the filename includes the extension
-                feat = np.load(feat)
-
-                if(data_augmentation):
-                    noise_mean = 0.0
-                    noise_dev = 0.01
-                    noise = np.random.normal(noise_mean, noise_dev, feat.shape)
-                    feat += noise
-
-                if(normalization):
-                    if normalization_type == 'L2':
-                        feat = feat / np.linalg.norm(feat,ord=2)
-
-                features[enum,j] = feat
-        '''
+        # load features from selected paths of all the videos at once
+        features = batchArray(buffers, ('video-features', id), (n_videos, max_len, feat_len), np.float32, 0)
+        if(len(positions) > 0):
+            selected = self.loadFeatures(takeSamples(self.paths_frames[id][set_name], positions), feat_len,
+                                         normalization_type, normalization, external=external,
+                                         data_augmentation=data_augmentation, id=id, set_name=set_name,
+                                         buffers=buffers)
+            features[videos, slots] = selected
 
-        return np.array(features)
+        return features
 
     
-    def loadVideosByIndex(self, n_frames, id, indices, set_name, max_len, normalization_type, normalization, meanSubstraction, dataAugmentation):
+    def loadVideosByIndex(self, n_frames, id, indices, set_name, max_len, normalization_type, normalization, meanSubstraction, dataAugmentation,
+                          buffers=None):
+        """
+            Loads the videos stored in positions 'indices' of the set 'set_name', with n_frames[v] frames each.
+            The frames of all the videos are loaded at once and each video is filled with 0s at the beginning
+            (or its remaining frames are removed) w.r.t. max_len.
+        """
         n_videos = len(indices)
-        V = np.zeros((n_videos, max_len*3, self.img_size_crop[id][0], self.img_size_crop[id][1]))
-
-        idx = [0 for i in range(n_videos)]
-        # recover all indices from image's paths of all videos
-        for v in range(n_videos):
-            idx[v] = int(sum(eval('self.X_'+set_name+'[id][indices[v]]')))
-
-        # load images from each video
-        for enum, (n, i) in enumerate(zip(n_frames, idx)):
-            paths = self.paths_frames[id][set_name][i:i+n]
-            # returns numpy array with dimensions (batch, channels, height, width)
-            images = self.loadImages(paths, id, normalization_type, normalization, meanSubstraction, dataAugmentation)
-            # fills video matrix with each frame (fills with 0s or removes remaining frames w.r.t. max_len)
-            len_j = images.shape[0]
-            offset_j = max_len - len_j
-            if offset_j < 0:
-                len_j = len_j + offset_j
-                offset_j = 0
-            for j in range(len_j):
-                V[enum, (j+offset_j)*3:(j+offset_j+1)*3] = images[j]
-
-        return V
+        first_frames = self.getFirstFrames(id, set_name)[np.asarray(indices, dtype=np.int64)]
+        # only the first max_len frames of each video are used
+        n_used = np.minimum(np.asarray(n_frames, dtype=np.int64), max_len)
+        ends = np.cumsum(n_used)
+        n_total = int(ends[-1]) if n_videos > 0 else 0
+        # position in paths_frames of each frame loaded
+        positions = np.repeat(first_frames - (ends - n_used), n_used) + np.arange(n_total)
+        
+        V = batchArray(buffers, ('video', id), (n_videos, max_len*3, self.img_size_crop[id][0], self.img_size_crop[id][1]),
+                       np.float64, 0)
+        if(n_total == 0):
+            return V
+        # returns numpy array with dimensions (frames, channels, height, width)
+        images = self.loadImages(takeSamples(self.paths_frames[id][set_name], positions), id,
+                                 normalization_type, normalization, meanSubstraction, dataAugmentation, buffers=buffers)
+        # fills video matrix with each frame
+        videos = np.repeat(np.arange(n_videos), n_used)
+        slots = np.arange(n_total) - np.repeat(ends - n_used, n_used) + np.repeat(max_len - n_used, n_used)
+        V = V.reshape((n_videos, max_len) + images.shape[1:])
+        V[videos, slots] = images
+        
+        return V.reshape((n_videos, max_len*images.shape[1]) + images.shape[2:])
 
         
     # ------------------------------------------------------- #
     #       TYPE 'id' SPECIFIC FUNCTIONS
     # ------------------------------------------------------- #
     
-    def preprocessIDs(self, path_list, id, set_name):
+    def preprocessIDs(self, path_list, id, set_name, stream=False):
         
         logging.info('WARNING: inputs or outputs with type "id" will not be treated in any way by the dataset.')
-        if(isinstance(path_list, str) and os.path.isfile(path_list)): # path to list of IDs
+        if(isinstance(path_list, str) and os.path.isfile(path_list) and stream):
+            data = self.streamLines(path_list, id, set_name)
+        elif(isinstance(path_list, str) and os.path.isfile(path_list)): # path to list of IDs
             data = []
             with open(path_list, 'r') as list_:
                 for line in list_:
@@ -1410,9 +2445,11 @@ class Dataset(object):
     #       TYPE 'image' SPECIFIC FUNCTIONS
     # ------------------------------------------------------- #
     
-    def preprocessImages(self, path_list, id, set_name, img_size, img_size_crop):
+    def preprocessImages(self, path_list, id, set_name, img_size, img_size_crop, stream=False):
         
-        if(isinstance(path_list, str) and os.path.isfile(path_list)): # path to list of images' paths
+        if(isinstance(path_list, str) and os.path.isfile(path_list) and stream):
+            data = self.streamLines(path_list, id, set_name)
+        elif(isinstance(path_list, str) and os.path.isfile(path_list)): # path to list of images' paths
             data = []
             with open(path_list, 'r') as list_:
                 for line in list_:
@@ -1421,17 +2458,24 @@ class Dataset(object):
             data = path_list
         else:
             raise Exception('Wrong type for "path_list". It must be a path to a text file with an image path in each line or an instance of the class list with an image path in each position.')
+        
+        # The extension of the paths given without it is looked up once here (streamed paths are resolved when read)
+        if(not stream):
+            data = [self.__resolveImagePath(im) for im in data]
             
         self.img_size[id] = img_size
         self.img_size_crop[id] = img_size_crop
             
         # Tries to load a train_mean file from the dataset folder if exists
-        mean_file_path = self.path+'/train_mean'
-        for s in range(len(self.img_size[id])):
-            mean_file_path += '_'+str(self.img_size[id][s])
-        mean_file_path += '_'+id+'_.jpg'
-        if(os.path.isfile(mean_file_path)):
-            self.setTrainMean(mean_file_path, id)
+        # (stored by calculateTrainMean() as .npy, or as .jpg by older versions)
+        for extension in ['.npy', '.jpg']:
+            mean_file_path = self.__imageStatisticsPath('train_mean', id, extension)
+            if(os.path.isfile(mean_file_path)):
+                self.setTrainMean(mean_file_path, id)
+                break
+        std_file_path = self.__imageStatisticsPath('train_std', id, '.npy')
+        if(os.path.isfile(std_file_path)):
+            self.train_std[id] = np.load(std_file_path)
             
         return data
        
@@ -1442,14 +2486,17 @@ class Dataset(object):
             
             - numpy.array (complete image)
             - list with a value per channel
-            - string with the path to the stored image.
+            - string with the path to the stored image (.npy file or image file).
             
             :param id: identifier of the type of input whose train mean is being introduced.
         """
         if(isinstance(mean_image, str)):
             if(not self.silence):
                 logging.info("Loading train mean image from file.")
-            mean_image = misc.imread(mean_image)
+            if(mean_image.endswith('.npy')):
+                mean_image = np.load(mean_image)
+            else:
+                mean_image = misc.imread(mean_image)
         elif(isinstance(mean_image, list)):
             mean_image = np.array(mean_image)
         self.train_mean[id] = mean_image.astype(np.float32)
@@ -1468,12 +2515,21 @@ class Dataset(object):
             else:
                 logging.warning("The loaded training mean size does not match the desired images size.\nChange the images size with setImageSize(size) or recalculate the training mean with calculateTrainMean().")
     
-    def calculateTrainMean(self, id):
+    def calculateTrainMean(self, id, n_samples=None, n_workers=None, batch_size=200, seed=None):
         """
-            Calculates the mean of the data belonging to the training set split in each channel.
+            Calculates the mean image of the training images of the input 'id' and the standard deviation of each
+            channel of their pixels (stored in self.train_std[id]). The images are read in parallel by n_workers
+            processes and both results are stored as .npy files in the dataset folder, which are loaded
+            by preprocessImages().
+            
+            :param n_samples: if not None, the statistics are estimated from a random subsample of n_samples training images
+                              (the error bound of the estimated mean is reported)
+            :param n_workers: number of processes reading the images (None for one per CPU core)
+            :param batch_size: number of images read by each task
+            :param seed: seed used for selecting the subsample
         """
         calculate = False
-        if(not isinstance(self.train_mean[id], np.ndarray)):
+        if(not isinstance(self.train_mean.get(id), np.ndarray)):
             calculate = True
         elif(self.train_mean[id].shape != tuple(self.img_size[id])):
             calculate = True
@@ -1484,45 +2540,385 @@ class Dataset(object):
             if(not self.silence):
                 logging.info("Start training set mean calculation...")
             
-            I_sum = np.zeros(self.img_size[id], dtype=np.longlong)
-            
-            # Load images in batches and sum all of them
-            init = 0
-            batch = 200
-            for final in range(batch, self.len_train, batch):
-                I = self.getX('train', init, final, resizeImage=True, meanSubstraction=False)
-                for im in I:
-                    I_sum += im
+            if(n_samples is None or n_samples >= self.len_train):
+                positions = np.arange(self.len_train)
+            else:
+                random_state = np.random if seed is None else np.random.RandomState(seed)
+                positions = np.sort(random_state.choice(self.len_train, n_samples, replace=False))
+            n_images = len(positions)
+            
+            # Sum the images (and their squares) read by batches in parallel
+            I_sum = np.zeros(self.img_size[id], dtype=np.float64)
+            I_sum_sq = np.zeros(self.img_size[id], dtype=np.float64)
+            n_processed = 0
+            tasks = ((id, positions[init:init+batch_size]) for init in range(0, n_images, batch_size))
+            for [n, batch_sum, batch_sum_sq] in self.__parallelMap(sumImages, tasks, n_workers):
+                I_sum += batch_sum
+                I_sum_sq += batch_sum_sq
+                n_processed += n
                 if(not self.silence):
-                    logging.info("\tProcessed "+str(final)+'/'+str(self.len_train)+' images...')
-                init = final
-            I = self.getX('train', init, self.len_train, resizeImage=True, meanSubstraction=False)
-            for im in I:
-                I_sum += im
-            if(not self.silence):
-                logging.info("\tProcessed "+str(final)+'/'+str(self.len_train)+' images...')
-            
-            # Mean calculation
-            self.train_mean[id] = I_sum/self.len_train
-            
-            # Store the calculated mean
-            mean_name = self.path+'/train_mean'
-            for s in range(len(self.img_size[id])):
-                mean_name += '_'+str(self.img_size[id][s])
-            mean_name += '_'+id+'_.jpg'
-            store_path = self.path+'/'+mean_name
-            misc.imsave(store_path, self.train_mean[id])
-            
-            self.train_mean[id] = self.train_mean[id].astype(np.float32)/255.0
+                    logging.info("\tProcessed "+str(n_processed)+'/'+str(n_images)+' images...')
+            
+            # Mean image and standard deviation of each channel
+            mean_image = I_sum/n_images
+            pixel_var = np.maximum(I_sum_sq/n_images - mean_image**2, 0)
+            channel_axes = tuple(range(len(self.img_size[id])-1)) if len(self.img_size[id]) == 3 else None
+            channel_mean = mean_image.mean(axis=channel_axes)
+            channel_var = np.maximum(I_sum_sq.mean(axis=channel_axes)/n_images - channel_mean**2, 0)
+            self.train_std[id] = np.sqrt(channel_var).astype(np.float32)
+            
+            if(not self.silence and n_images < self.len_train):
+                # standard error of each mean pixel (with finite population correction)
+                std_error = np.sqrt(pixel_var/n_images * (self.len_train-n_images)/float(self.len_train-1))
+                logging.info("Mean estimated from "+str(n_images)+'/'+str(self.len_train)+' images: the error of each mean '
+                             'pixel value is below %.3f with 95%% confidence (maximum standard error %.3f).' % (1.96*std_error.max(), std_error.max()))
+            
+            # Store the calculated statistics
+            mean_path = self.__imageStatisticsPath('train_mean', id, '.npy')
+            np.save(mean_path, mean_image.astype(np.float32))
+            np.save(self.__imageStatisticsPath('train_std', id, '.npy'), self.train_std[id])
+            self.setTrainMean(mean_image, id)
             
             if(not self.silence):
-                logging.info("Image mean stored in "+ store_path)
+                logging.info("Image mean stored in "+ mean_path)
             
         # Return the mean
         return self.train_mean[id]
     
+    
+    def __imageStatisticsPath(self, name, id, extension):
+        """
+            Path of the file where the statistic 'name' ('train_mean' or 'train_std') of the input 'id' is stored.
+        """
+        return self.path+'/'+name+''.join(['_'+str(s) for s in self.img_size[id]])+'_'+id+'_'+extension
+    
+    
+    def buildImageCache(self, id, set_name, fill=True, cache_path=None, external=False):
+        """
+            Creates (or reopens) a persistent on-disk cache with the images of the input 'id' in the 'set_name' split
+            already decoded and resized to self.img_size[id]. The cache is stored as a memory-mapped uint8 array
+            with a row for each different image path. Once an image is cached, loadImages() only needs to read its row.
+            
+            :param id: identifier of the input of type 'image'
+            :param set_name: 'train', 'val' or 'test' set
+            :param fill: if True all the images are cached now, otherwise they will be cached the first time they are loaded
+            :param cache_path: folder where the cache files are stored (self.path+'/image_cache' by default)
+            :param external: if True the paths of the images are absolute (see loadImages())
+        """
+        self.__checkSetName(set_name)
+        if(id not in self.ids_inputs or self.types_inputs[self.ids_inputs.index(id)] != 'image'):
+            raise Exception('The image cache can only be built for inputs of type "image".')
+        
+        # Each different path is only stored once
+        paths = []
+        index = dict()
+        for im in self.splits[set_name].X[id]:
+            if im not in index:
+                index[im] = len(paths)
+                paths.append(im)
+        
+        if(cache_path is None):
+            cache_path = self.path+'/image_cache'
+        create_dir_if_not_exists(cache_path)
+        file_prefix = cache_path+'/'+self.name+'_'+id+'_'+set_name
+        for s in range(len(self.img_size[id])):
+            file_prefix += '_'+str(self.img_size[id][s])
+        shape = tuple([len(paths)] + self.img_size[id])
+        
+        # Reuse the stored cache if it was built for the same list of images
+        reuse = False
+        if(os.path.isfile(file_prefix+'_paths.pkl') and os.path.isfile(file_prefix+'.npy')):
+            reuse = pk.load(open(file_prefix+'_paths.pkl', 'rb')) == paths and \
+                    np.load(file_prefix+'.npy', mmap_mode='r').shape == shape
+        if(not reuse):
+            np.lib.format.open_memmap(file_prefix+'.npy', mode='w+', dtype=np.uint8, shape=shape)
+            np.lib.format.open_memmap(file_prefix+'_filled.npy', mode='w+', dtype=np.uint8, shape=(len(paths),))
+            pk.dump(paths, open(file_prefix+'_paths.pkl', 'wb'), protocol=pk.HIGHEST_PROTOCOL)
+        
+        if(id not in self.image_cache):
+            self.image_cache[id] = dict()
+        self.image_cache[id][set_name] = {'file_prefix': file_prefix, 'index': index, 'img_size': list(self.img_size[id])}
+        self.__image_cache_files.pop((id, set_name), None)
+        
+        if(not self.silence):
+            if(reuse):
+                logging.info('Reusing image cache for "'+set_name+'" set inputs with id "'+id+'" stored in '+file_prefix+'.npy')
+            else:
+                logging.info('Created image cache for "'+set_name+'" set inputs with id "'+id+'" in '+file_prefix+'.npy')
+        
+        if(fill):
+            batch = 200
+            for init in range(0, len(paths), batch):
+                self.__loadCachedImages(paths[init:init+batch], id, set_name, external)
+                if(not self.silence):
+                    logging.info("\tCached "+str(min(init+batch, len(paths)))+'/'+str(len(paths))+' images...')
+    
+    
+    def packImages(self, id, set_name, pack_path=None, shard_size=2**30, external=False):
+        """
+            Creates (or reopens) packed record files with the encoded images (the bytes of the image files) of the
+            input 'id' in the 'set_name' split, so loadImages() reads them from a few large files instead of opening
+            each image. The images are stored in shard files of about shard_size bytes, in the stored order of the
+            split and only once for each different path, with an index of the shard, offset and length of each one.
+            The images of each batch close to each other in a shard are read together, so the batches that follow
+            the stored order (or a chunked shuffling, see shuffleTraining()) are read sequentially.
+            
+            :param id: identifier of the input of type 'image'
+            :param set_name: 'train', 'val' or 'test' set
+            :param pack_path: folder where the record files are stored (self.path+'/image_records' by default)
+            :param shard_size: maximum size (in bytes) of each shard file (unless it holds a single bigger image)
+            :param external: if True the paths of the images are absolute (see loadImages())
+        """
+        self.__checkSetName(set_name)
+        if(id not in self.ids_inputs or self.types_inputs[self.ids_inputs.index(id)] != 'image'):
+            raise Exception('The images can only be packed for inputs of type "image".')
+        
+        # Each different path is only stored once
+        paths = []
+        index = dict()
+        for im in self.splits[set_name].X[id]:
+            if im not in index:
+                index[im] = len(paths)
+                paths.append(im)
+        
+        if(pack_path is None):
+            pack_path = self.path+'/image_records'
+        create_dir_if_not_exists(pack_path)
+        file_prefix = pack_path+'/'+self.name+'_'+id+'_'+set_name
+        
+        # Reuse the stored records if they were packed for the same list of images
+        reuse = False
+        if(os.path.isfile(file_prefix+'_paths.pkl') and os.path.isfile(file_prefix+'_records.npy')):
+            reuse = pk.load(open(file_prefix+'_paths.pkl', 'rb')) == paths
+        if(not reuse):
+            # [shard, offset, length] of each image (length 0 for the images that can not be read)
+            records = np.zeros((len(paths), 3), dtype=np.int64)
+            shard = 0
+            out = open(file_prefix+'_'+str(shard)+'.bin', 'wb')
+            offset = 0
+            for row, im in enumerate(paths):
+                try:
+                    full_path = im if external else self.path+'/'+im
+                    data = open(self.__resolveImagePath(full_path, external=True), 'rb').read()
+                except:
+                    logging.warning("WARNING!")
+                    logging.warning("Can't pack image "+im)
+                    data = ''
+                if(offset > 0 and offset + len(data) > shard_size):
+                    out.close()
+                    shard += 1
+                    out = open(file_prefix+'_'+str(shard)+'.bin', 'wb')
+                    offset = 0
+                out.write(data)
+                records[row] = [shard, offset, len(data)]
+                offset += len(data)
+                if(not self.silence and (row+1) % 10000 == 0):
+                    logging.info("\tPacked "+str(row+1)+'/'+str(len(paths))+' images...')
+            out.close()
+            np.save(file_prefix+'_records.npy', records)
+            pk.dump(paths, open(file_prefix+'_paths.pkl', 'wb'), protocol=pk.HIGHEST_PROTOCOL)
+        
+        if(id not in self.image_records):
+            self.image_records[id] = dict()
+        self.image_records[id][set_name] = {'file_prefix': file_prefix, 'index': index, 'external': external}
+        self.__record_files.pop((id, set_name), None)
+        
+        if(not self.silence):
+            if(reuse):
+                logging.info('Reusing packed images for "'+set_name+'" set inputs with id "'+id+'" stored in '+file_prefix+'_*.bin')
+            else:
+                logging.info('Packed '+str(len(paths))+' images for "'+set_name+'" set inputs with id "'+id+'" in '+file_prefix+'_*.bin')
+    
+    
+    def __getImageRecords(self, id, set_name):
+        """
+            Returns [records, shards] for the packed images of (id, set_name): the memory-mapped index of records and
+            a dictionary with the memory-mapped shard files opened so far. Returns None if they were not packed.
+        """
+        if(set_name is None or id not in self.image_records or set_name not in self.image_records[id]):
+            return None
+        if((id, set_name) not in self.__record_files):
+            file_prefix = self.image_records[id][set_name]['file_prefix']
+            self.__record_files[(id, set_name)] = [np.load(file_prefix+'_records.npy', mmap_mode='r'), dict()]
+        return self.__record_files[(id, set_name)]
+    
+    
+    def __readRecords(self, images, id, set_name, max_gap=2**20):
+        """
+            Returns the encoded images 'images' (list of paths) from the packed records of (id, set_name)
+            (None for the ones that could not be packed). The images of the same shard separated by less than
+            max_gap bytes are read together with a single sequential read.
+        """
+        [records, shards] = self.__getImageRecords(id, set_name)
+        info = self.image_records[id][set_name]
+        rows = np.array([info['index'][im] for im in images], dtype=np.int64)
+        image_records = records[rows]
+        
+        encoded = [None] * len(images)
+        # Sort the images by their position in the shards and read the spans of close images at once
+        positions = np.lexsort((image_records[:, 1], image_records[:, 0]))
+        init = 0
+        while init < len(positions):
+            [shard, start, length] = image_records[positions[init]]
+            end = start + length
+            final = init + 1
+            while(final < len(positions) and image_records[positions[final], 0] == shard and
+                  image_records[positions[final], 1] - end <= max_gap):
+                end = max(end, image_records[positions[final], 1] + image_records[positions[final], 2])
+                final += 1
+            
+            if(end > start):
+                if(shard not in shards):
+                    with open(info['file_prefix']+'_'+str(shard)+'.bin', 'rb') as f:
+                        shards[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                span = shards[shard][start:end]
+                for i in positions[init:final]:
+                    [_, offset, length] = image_records[i]
+                    if(length > 0):
+                        encoded[i] = span[offset-start:offset-start+length]
+            init = final
+        return encoded
+    
+    
+    def __getImageCache(self, id, set_name):
+        """
+            Returns the opened [images, filled] memory-mapped arrays of the image cache of (id, set_name)
+            or None if no valid cache exists.
+        """
+        if(set_name is None or id not in self.image_cache or set_name not in self.image_cache[id]):
+            return None
+        cache = self.image_cache[id][set_name]
+        if(cache['img_size'] != list(self.img_size[id])): # built for another image size
+            return None
+        if((id, set_name) not in self.__image_cache_files):
+            self.__image_cache_files[(id, set_name)] = [np.load(cache['file_prefix']+'.npy', mmap_mode='r+'),
+                                                        np.load(cache['file_prefix']+'_filled.npy', mmap_mode='r+')]
+        return self.__image_cache_files[(id, set_name)]
+    
+    
+    def __loadCachedImages(self, images, id, set_name, external):
+        """
+            Returns the resized images (uint8) from the image cache, decoding and storing the ones not cached yet.
+        """
+        [data, filled] = self.__getImageCache(id, set_name)
+        index = self.image_cache[id][set_name]['index']
+        rows = np.array([index[im] for im in images], dtype=np.int64)
+        for i in np.where(filled[rows] == 0)[0]:
+            if(filled[rows[i]]): # repeated image already stored in this batch
+                continue
+            im = self.__readImage(images[i], id, external)
+            if(im is not None):
+                data[rows[i]] = im
+                filled[rows[i]] = 1
+        
+        I = data[rows]
+        # Images that could not be read are not cached
+        for i in np.where(filled[rows] == 0)[0]:
+            I[i] = 0
+        return I
+    
+    
+    def __readImage(self, im, id, external, encoded=None):
+        """
+            Reads an image from disk and resizes it to self.img_size[id] (converting grayscale images into
+            self.img_size[id][2] channels). Returns None if the image can not be read.
+            
+            :param encoded: if not None, the bytes of the image file, which are decoded instead of reading it
+        """
+        if(not external):
+            im = self.path +'/'+ im
+        
+        # Check if the filename includes the extension
+        [path, filename] = ntpath.split(im)
+        [filename, ext] = os.path.splitext(filename)
+        
+        # If it doesn't then we find it
+        if(not ext and encoded is None):
+            im = self.__resolveImagePath(im, external=True)
+        
+        # Read image
+        source = im if encoded is None else StringIO(encoded)
+        try:
+            if(self.draft_decoding.get(id, False)):
+                im = self.__readDraftImage(source, id)
+            else:
+                im = misc.imread(source)
+        except:
+            logging.warning("WARNING!")
+            logging.warning("Can't load image "+im)
+            return None
         
-    def loadImages(self, images, id, normalization_type='0-1', normalization=False, meanSubstraction=True, dataAugmentation=True, external=False, loaded=False):
+        return self.__resizeImage(im, id)
+    
+    
+    def __resolveImagePath(self, im, external=False):
+        """
+            Returns the image path 'im' completed with its file extension if it has none, looking up the first file
+            of its folder whose name is 'im' plus an extension (or, if there is none, starts with 'im').
+            The files of each folder are only listed once. Raises an exception if the image does not exist.
+            
+            :param external : if False, 'im' is relative to self.path
+        """
+        [path, filename] = ntpath.split(im)
+        [filename, ext] = os.path.splitext(filename)
+        if(ext):
+            return im
+        
+        folder = path if external else self.path+'/'+path
+        if(folder not in self.__folder_listings):
+            files = os.listdir(folder)
+            index = dict()
+            for f in files:
+                index.setdefault(os.path.splitext(f)[0], f)
+            self.__folder_listings[folder] = (files, index)
+        [files, index] = self.__folder_listings[folder]
+        
+        found = index.get(filename)
+        if(found is None):
+            found = fnmatch.filter(files, filename+'*')
+            if(not found):
+                raise Exception('Non existent image '+ im)
+            found = found[0]
+        return os.path.join(path, found)
+    
+    
+    def __readDraftImage(self, im, id):
+        """
+            Reads an image, decoding the JPEG images at the smallest DCT scale (1/2, 1/4 or 1/8) whose size is
+            still at or above self.img_size[id]. The other formats are decoded at full resolution.
+        """
+        im = Image.open(im)
+        if(im.format == 'JPEG'):
+            im.draft(im.mode, (self.img_size[id][1], self.img_size[id][0]))
+        return misc.fromimage(im)
+    
+    
+    def setDraftDecoding(self, id, draft_decoding=True):
+        """
+            Enables or disables the reduced-resolution decoding of the JPEG images of the input 'id'. When enabled,
+            the images are decoded straight to the nearest DCT scale at or above self.img_size[id] before being resized,
+            which is much faster for photos much larger than the target size.
+            The image caches already filled (see buildImageCache()) are not rebuilt.
+        """
+        self.draft_decoding[id] = draft_decoding
+    
+    
+    def __resizeImage(self, im, id):
+        """
+            Resizes an image to self.img_size[id] and converts it to RGB (if in greyscale).
+        """
+        im = misc.imresize(im, tuple(self.img_size[id]))
+        if(len(self.img_size[id]) == 3 and len(im.shape) < 3): # convert grayscale into RGB (or any other channel#)
+            nCh = self.img_size[id][2]
+            rgb_im = np.empty((im.shape[0], im.shape[1], nCh), dtype=im.dtype)
+            for c in range(nCh):
+                rgb_im[:,:,c] = im
+            im = rgb_im
+        return im
+    
+        
+    def loadImages(self, images, id, normalization_type='0-1', normalization=False, meanSubstraction=True, dataAugmentation=True, external=False, loaded=False, set_name=None,
+                   buffers=None):
         """
             Loads a set of images from disk.
             
@@ -1533,6 +2929,8 @@ class Dataset(object):
             :param dataAugmentation : whether we are applying dataAugmentatino (random cropping and horizontal flip)
             :param external : if True the images will be loaded from an external database, in this case the list of images must be absolute paths
             :param loaded : set this option to True if images is a list of matricies instead of a list of strings
+            :param set_name : split the images belong to. If an image cache was built for it (see buildImageCache()) the images are read from the cache
+            :param buffers : BatchBuffers where the images are decoded and returned (see PrefetchDataLoader)
         """
         # Check if the chosen normalization type exists
         if(normalization and normalization_type not in self.__available_norm_im_vid):
@@ -1540,118 +2938,166 @@ class Dataset(object):
         
         # Prepare the training mean image
         if(meanSubstraction): # remove mean
-            
-            if(id not in self.train_mean):
-                raise Exception('Training mean is not loaded or calculated yet for the input with id "'+id+'".')
-            train_mean = copy.copy(self.train_mean[id])
-            
-            # Take central part
-            left = np.round(np.divide([self.img_size[id][0]-self.img_size_crop[id][0], self.img_size[id][1]-self.img_size_crop[id][1]], 2.0))
-            right = left + self.img_size_crop[id][0:2]
-            train_mean = train_mean[left[0]:right[0], left[1]:right[1], :]
-            
-            # Transpose dimensions
-            if(len(self.img_size[id]) == 3): # if it is a 3D image
-                # Convert RGB to BGR
-                if(self.img_size[id][2] == 3): # if has 3 channels
-                    aux = copy.copy(train_mean)
-                    train_mean[:,:,0] = aux[:,:,2]
-                    train_mean[:,:,2] = aux[:,:,0]
-                train_mean = np.transpose(train_mean, (2, 0, 1))
+            train_mean = self.__getPreparedMean(id)
             
         prob_flip_horizontal = 0.5
         prob_flip_vertical = 0.0
         nImages = len(images)
+        img_size = self.img_size[id]
+        img_size_crop = self.img_size_crop[id]
         
-        type_imgs = np.float32
-        if(len(self.img_size[id]) == 3):
-            I = np.zeros([nImages]+[self.img_size_crop[id][2]]+self.img_size_crop[id][0:2], dtype=type_imgs)
+        # Decode and resize all the images into a single uint8 buffer
+        # (or read them from the cache if available)
+        if(not loaded):
+            buffer = self.readImages(images, id, external, set_name, buffers)
         else:
-            I = np.zeros([nImages]+self.img_size_crop[id], dtype=type_imgs)
-            
-        ''' Process each image separately '''
-        for i in range(nImages):
-            im = images[i]
-            
-            if(not loaded):
-                if(not external):
-                    im = self.path +'/'+ im
-                
-                # Check if the filename includes the extension
-                [path, filename] = ntpath.split(im)
-                [filename, ext] = os.path.splitext(filename)
-                
-                # If it doesn't then we find it
-                if(not ext):
-                    filename = fnmatch.filter(os.listdir(path), filename+'*')
-                    if(not filename):
-                        raise Exception('Non existent image '+ im)
-                    else:
-                        im = path+'/'+filename[0]
-                
-                # Read image
-                try:
-                    im = misc.imread(im)
-                except:
-                    logging.warning("WARNING!")
-                    logging.warning("Can't load image "+im)
-                    im = np.zeros(tuple(self.img_size[id]))
-            
-            # Resize and convert to RGB (if in greyscale)
-            im = misc.imresize(im, tuple(self.img_size[id])).astype(type_imgs)
-            if(len(self.img_size[id]) == 3 and len(im.shape) < 3): # convert grayscale into RGB (or any other channel#)
-                nCh = self.img_size[id][2]
-                rgb_im = np.empty((im.shape[0], im.shape[1], nCh), dtype=np.float32)
-                for c in range(nCh):
-                    rgb_im[:,:,c] = im
-                im = rgb_im
-                
-            # Normalize
-            if(normalization):
-                if(normalization_type == '0-1'):
-                    im = im/255.0
-                
-            # Data augmentation
-            if(not dataAugmentation):
-                # Take central image
-                left = np.round(np.divide([self.img_size[id][0]-self.img_size_crop[id][0], self.img_size[id][1]-self.img_size_crop[id][1]], 2))
-                right = left + self.img_size_crop[id][0:2]
-                im = im[left[0]:right[0], left[1]:right[1], :]
-            else:
-                # Take random crop
-                margin = [self.img_size[id][0]-self.img_size_crop[id][0], self.img_size[id][1]-self.img_size_crop[id][1]]
-                left = random.sample([k_ for k_ in range(margin[0])], 1) + random.sample([k for k in range(margin[1])], 1)
-                right = np.add(left, self.img_size_crop[id][0:2])
-                im = im[left[0]:right[0], left[1]:right[1], :]
-                
-                # Randomly flip (with a certain probability)
-                flip = random.random()
-                if(flip < prob_flip_horizontal): # horizontal flip
-                    im = np.fliplr(im)
-                flip = random.random()
-                if(flip < prob_flip_vertical): # vertical flip
-                    im = np.flipud(im)
-            
-            # Permute dimensions
-            if(len(self.img_size[id]) == 3):
-                # Convert RGB to BGR
-                if(self.img_size[id][2] == 3): # if has 3 channels
-                    aux = copy.copy(im)
-                    im[:,:,0] = aux[:,:,2]
-                    im[:,:,2] = aux[:,:,0]
-                im = np.transpose(im, (2, 0, 1))
-            else:
-                pass
-            
-            # Substract training images mean
-            if(meanSubstraction): # remove mean
-                im = im - train_mean
-            
-            I[i] = im
-
+            buffer = batchArray(buffers, ('decoded', id), [nImages]+img_size, np.uint8, 0)
+            for i in range(nImages):
+                buffer[i] = self.__resizeImage(images[i], id)
+        
+        # Crop all the images at once
+        margin = [img_size[0]-img_size_crop[0], img_size[1]-img_size_crop[1]]
+        if(not dataAugmentation):
+            # Take central image
+            left = [margin[0]//2, margin[1]//2]
+            crops = buffer[:, left[0]:left[0]+img_size_crop[0], left[1]:left[1]+img_size_crop[1]]
+        else:
+            # Take random crops and randomly flip them (with a certain probability),
+            # both applied by gathering the pixels of each image with a different offset and order
+            top = np.random.randint(0, max(margin[0], 1), nImages)
+            left = np.random.randint(0, max(margin[1], 1), nImages)
+            rows = np.arange(img_size_crop[0])
+            cols = np.arange(img_size_crop[1])
+            rows = np.where((np.random.rand(nImages) < prob_flip_vertical)[:, None], rows[::-1], rows) + top[:, None]
+            cols = np.where((np.random.rand(nImages) < prob_flip_horizontal)[:, None], cols[::-1], cols) + left[:, None]
+            crops = buffer[np.arange(nImages)[:, None, None], rows[:, :, None], cols[:, None, :]]
+        
+        # Permute dimensions
+        if(len(img_size) == 3):
+            # Convert RGB to BGR
+            if(img_size[2] == 3): # if has 3 channels
+                crops = crops[:, :, :, ::-1]
+            crops = np.transpose(crops, (0, 3, 1, 2))
+        
+        I = batchArray(buffers, ('image', id), crops.shape, np.float32)
+        I[...] = crops
+        
+        # Normalize
+        if(normalization):
+            if(normalization_type == '0-1'):
+                I /= 255.0
+        
+        # Substract training images mean
+        if(meanSubstraction): # remove mean
+            I -= train_mean
+        
         return I
     
     
+    def readImages(self, images, id, external=False, set_name=None, buffers=None):
+        """
+            Reads the images 'images' (list of paths) of the input 'id' decoded and resized to self.img_size[id],
+            from the image cache of the split 'set_name' if it was built (see buildImageCache()).
+            Returns them in a uint8 array (the images that can not be read are filled with 0s).
+        """
+        if(self.__getImageCache(id, set_name) is not None):
+            return self.__loadCachedImages(images, id, set_name, external)
+        buffer = batchArray(buffers, ('decoded', id), [len(images)]+self.img_size[id], np.uint8, 0)
+        first = dict() # position in the batch of the first reference to each image, which is only decoded once
+        for i in range(len(images)):
+            if(images[i] not in first):
+                first[images[i]] = i
+        # encoded images read from the packed records if available (see packImages())
+        encoded = None
+        if(self.__getImageRecords(id, set_name) is not None):
+            info = self.image_records[id][set_name]
+            distinct = first.keys()
+            if(info['external'] == external and all([im in info['index'] for im in distinct])):
+                encoded = dict(zip(distinct, self.__readRecords(distinct, id, set_name)))
+        
+        for i in range(len(images)):
+            if(first[images[i]] != i):
+                buffer[i] = buffer[first[images[i]]]
+                continue
+            if(encoded is None):
+                im = self.__decodeImage(images[i], id, external)
+            elif(encoded[images[i]] is None): # it could not be packed
+                im = None
+            else:
+                im = self.__decodeImage(images[i], id, external, encoded[images[i]])
+            if(im is not None):
+                buffer[i] = im
+        return buffer
+    
+    
+    def __decodeImage(self, im, id, external, encoded=None):
+        """
+            Returns the image 'im' decoded and resized (see __readImage()), from the images decoded recently
+            if it is one of the last self.decode_cache_size[id] ones. The images are identified by their path,
+            the target size and the decoding mode, so changing the latter ones does not return stale images.
+        """
+        cache_size = self.decode_cache_size.get(id, 0)
+        if(cache_size == 0):
+            return self.__readImage(im, id, external, encoded)
+        
+        key = (im, external, tuple(self.img_size[id]), bool(self.draft_decoding.get(id, False)))
+        with self.__lock_decoded:
+            decoded = self.__decoded_images.setdefault(id, OrderedDict())
+            image = decoded.pop(key, None)
+            if(image is not None):
+                decoded[key] = image # most recently used
+                return image
+        
+        image = self.__readImage(im, id, external, encoded)
+        if(image is not None):
+            with self.__lock_decoded:
+                decoded[key] = image
+                while(len(decoded) > cache_size):
+                    decoded.popitem(last=False)
+        return image
+    
+    
+    def setDecodeCache(self, id, n_images):
+        """
+            Keeps in memory the last 'n_images' images of the input 'id' decoded and resized, so the images referenced
+            again in later batches (e.g. inputs loaded with repeat_set > 1) are not decoded again and only differ in
+            their data augmentation. The repeated images of each batch are always decoded once. 0 disables it.
+        """
+        self.decode_cache_size[id] = n_images
+        with self.__lock_decoded:
+            self.__decoded_images.pop(id, None)
+    
+    
+    def __getPreparedMean(self, id):
+        """
+            Returns the training mean of the input 'id' cropped to its central part of size self.img_size_crop[id]
+            and with the same channel order and dimensions of the images returned by loadImages().
+            It is only recalculated when the training mean or the crop size change.
+        """
+        if(id not in self.train_mean):
+            raise Exception('Training mean is not loaded or calculated yet for the input with id "'+id+'".')
+        
+        key = (id, tuple(self.img_size[id]), tuple(self.img_size_crop[id]))
+        if(key in self.__prepared_mean and self.__prepared_mean[key][0] is self.train_mean[id]):
+            return self.__prepared_mean[key][1]
+        
+        # Take central part
+        left = np.round(np.divide([self.img_size[id][0]-self.img_size_crop[id][0], self.img_size[id][1]-self.img_size_crop[id][1]], 2.0)).astype(int)
+        right = left + self.img_size_crop[id][0:2]
+        train_mean = self.train_mean[id][left[0]:right[0], left[1]:right[1]]
+        
+        # Transpose dimensions
+        if(len(self.img_size[id]) == 3): # if it is a 3D image
+            # Convert RGB to BGR
+            if(self.img_size[id][2] == 3): # if has 3 channels
+                train_mean = train_mean[:, :, ::-1]
+            train_mean = np.transpose(train_mean, (2, 0, 1))
+        train_mean = np.ascontiguousarray(train_mean, dtype=np.float32)
+        
+        self.__prepared_mean[key] = (self.train_mean[id], train_mean)
+        return train_mean
+    
+    
     def getClassID(self, class_name, id):
         """
             Returns the class id (int) for a given class string.
@@ -1665,7 +3111,7 @@ class Dataset(object):
     # ------------------------------------------------------- #
         
     def getX(self, set_name, init, final, normalization_type='0-1', normalization=False,
-             meanSubstraction=True, dataAugmentation=True, debug=False):
+             meanSubstraction=True, dataAugmentation=True, debug=False, buffers=None):
         """
             Gets all the data samples stored between the positions init to final
             
@@ -1689,11 +3135,13 @@ class Dataset(object):
             
             :param meanSubstraction: indicates if we want to substract the training mean from the returned images (only applicable if normalization=True)
             :param dataAugmentation: indicates if we want to apply data augmentation to the loaded images (random flip and cropping)
+            
+            :param buffers: BatchBuffers where the arrays of the batch are built (see PrefetchDataLoader), new arrays are returned if None
         """
         self.__checkSetName(set_name)
         self.__isLoaded(set_name, 0)
         
-        if(final > eval('self.len_'+set_name)):
+        if(final > self.splits[set_name].len):
             raise Exception('"final" index must be smaller than the number of samples in the set.')
         if(init < 0):
             raise Exception('"init" index must be equal or greater than 0.')
@@ -1703,38 +3151,45 @@ class Dataset(object):
         X = []
         for id_in, type_in in zip(self.ids_inputs, self.types_inputs):
             ghost_x = False
-            if id_in in self.optional_inputs:
+            if(type_in == 'text' and not debug and id_in not in self.optional_inputs):
+                x = None # read from the encoded texts
+            elif id_in in self.optional_inputs:
                 try:
-                    x = eval('self.X_'+set_name+'[id_in][init:final]')
+                    x = self.__rangeSamples(self.splits[set_name].X[id_in], set_name, init, final)
                     assert len(x) == (final - init)
                 except:
                     x = [[]] * (final - init)
                     ghost_x = True
             else:
-                x = eval('self.X_'+set_name+'[id_in][init:final]')
+                x = self.__rangeSamples(self.splits[set_name].X[id_in], set_name, init, final)
 
             if not debug and not ghost_x:
                 if(type_in == 'image'):
-                    x = self.loadImages(x, id_in, normalization_type, normalization, meanSubstraction, dataAugmentation)
+                    x = self.loadImages(x, id_in, normalization_type, normalization, meanSubstraction, dataAugmentation,
+                                        set_name=set_name, buffers=buffers)
                 elif(type_in == 'video'):
-                    x = self.loadVideos(x, id_in, final, set_name, self.max_video_len[id_in],
-                                        normalization_type, normalization, meanSubstraction, dataAugmentation)
+                    x = self.loadVideosByIndex(x, id_in, self.__rangeIndices(set_name, init, final), set_name,
+                                               self.max_video_len[id_in], normalization_type, normalization,
+                                               meanSubstraction, dataAugmentation, buffers=buffers)
                 elif(type_in == 'text'):
-                    x = self.loadText(x, self.vocabulary[id_in], 
-                                      self.max_text_len[id_in][set_name], self.text_offset[id_in],
-                                      fill=self.fill_text[id_in], pad_on_batch=self.pad_on_batch[id_in])[0]
+                    x = self.loadEncodedText(self.__rangeIndices(set_name, init, final), id_in, set_name,
+                                             self.max_text_len[id_in][set_name], self.text_offset[id_in],
+                                             fill=self.fill_text[id_in], pad_on_batch=self.pad_on_batch[id_in],
+                                             buffers=buffers)[0]
                 elif(type_in == 'image-features'):
-                    x = self.loadFeatures(x, self.features_lengths[id_in], normalization_type, normalization, data_augmentation=dataAugmentation)
+                    x = self.loadFeatures(x, self.features_lengths[id_in], normalization_type, normalization, data_augmentation=dataAugmentation,
+                                          id=id_in, set_name=set_name, buffers=buffers)
                 elif(type_in == 'video-features'):
                     x = self.loadVideoFeatures(x, id_in, set_name, self.max_video_len[id_in],
-                                          normalization_type, normalization, self.features_lengths[id_in], data_augmentation=dataAugmentation)
+                                          normalization_type, normalization, self.features_lengths[id_in], data_augmentation=dataAugmentation,
+                                          buffers=buffers)
             X.append(x)
         
         return X
         
         
     def getXY(self, set_name, k, normalization_type='0-1', normalization=False, meanSubstraction=True,
-              dataAugmentation=True, debug=False):
+              dataAugmentation=True, debug=False, buffers=None):
         """
             Gets the [X,Y] pairs for the next 'k' samples in the desired set.
             
@@ -1758,29 +3213,28 @@ class Dataset(object):
             
             :param meanSubstraction: indicates if we want to substract the training mean from the returned images (only applicable if normalization=True)
             :param dataAugmentation: indicates if we want to apply data augmentation to the loaded images (random flip and cropping)
+            
+            :param buffers: BatchBuffers where the arrays of the batch are built (see PrefetchDataLoader), new arrays are returned if None
         """
         self.__checkSetName(set_name)
         self.__isLoaded(set_name, 0)
         self.__isLoaded(set_name, 1)
         
-        [new_last, last, surpassed] = self.__getNextSamples(k, set_name)
+        [new_last, last, surpassed, indices] = self.__getNextSamples(k, set_name)
+        positions = self.__nextIndices(set_name, new_last, last, surpassed, indices)
         
         # Recover input samples
         X = []
         for id_in, type_in in zip(self.ids_inputs, self.types_inputs):
 
-            if id_in in self.optional_inputs:
+            if(type_in == 'text' and not debug and id_in not in self.optional_inputs):
+                x = None # read from the encoded texts
+            elif id_in in self.optional_inputs:
                 try:
-                    if(surpassed):
-                        x = eval('self.X_'+set_name+'[id_in][last:]') + eval('self.X_'+set_name+'[id_in][0:new_last]')
-                    else:
-                        x = eval('self.X_'+set_name+'[id_in][last:new_last]')
+                    x = self.__nextSamples(self.splits[set_name].X[id_in], new_last, last, surpassed, indices)
                 except: x = []
             else:
-                if(surpassed):
-                    x = eval('self.X_'+set_name+'[id_in][last:]') + eval('self.X_'+set_name+'[id_in][0:new_last]')
-                else:
-                    x = eval('self.X_'+set_name+'[id_in][last:new_last]')
+                x = self.__nextSamples(self.splits[set_name].X[id_in], new_last, last, surpassed, indices)
                 
             #if(set_name=='val'):
             #    logging.info(x)
@@ -1788,52 +3242,42 @@ class Dataset(object):
             # Pre-process inputs
             if(not debug):
                 if(type_in == 'image'):
-                    x = self.loadImages(x, id_in, normalization_type, normalization, meanSubstraction, dataAugmentation)
+                    x = self.loadImages(x, id_in, normalization_type, normalization, meanSubstraction, dataAugmentation,
+                                        set_name=set_name, buffers=buffers)
                 elif(type_in == 'video'):
-                    x = self.loadVideos(x, id_in, last, set_name, self.max_video_len[id_in], 
-                                        normalization_type, normalization, meanSubstraction, dataAugmentation)
+                    x = self.loadVideosByIndex(x, id_in, positions, set_name, self.max_video_len[id_in],
+                                               normalization_type, normalization, meanSubstraction, dataAugmentation,
+                                               buffers=buffers)
                 elif(type_in == 'text'):
-                    x = self.loadText(x, self.vocabulary[id_in],
-                                      self.max_text_len[id_in][set_name], self.text_offset[id_in],
-                                      fill=self.fill_text[id_in], pad_on_batch=self.pad_on_batch[id_in])[0]
+                    x = self.loadEncodedText(positions, id_in, set_name,
+                                             self.max_text_len[id_in][set_name], self.text_offset[id_in],
+                                             fill=self.fill_text[id_in], pad_on_batch=self.pad_on_batch[id_in],
+                                             buffers=buffers)[0]
                 elif(type_in == 'image-features'):
-                    x = self.loadFeatures(x, self.features_lengths[id_in], normalization_type, normalization, data_augmentation=dataAugmentation)
+                    x = self.loadFeatures(x, self.features_lengths[id_in], normalization_type, normalization, data_augmentation=dataAugmentation,
+                                          id=id_in, set_name=set_name, buffers=buffers)
                 elif(type_in == 'video-features'):
                     x = self.loadVideoFeatures(x, id_in, set_name, self.max_video_len[id_in], 
-                                          normalization_type, normalization, self.features_lengths[id_in], data_augmentation=dataAugmentation)
+                                          normalization_type, normalization, self.features_lengths[id_in], data_augmentation=dataAugmentation,
+                                          buffers=buffers)
             X.append(x)
             
         # Recover output samples
         Y = []
         for id_out, type_out in zip(self.ids_outputs, self.types_outputs):
-            if(surpassed):
-                y = eval('self.Y_'+set_name+'[id_out][last:]') + eval('self.Y_'+set_name+'[id_out][0:new_last]')
+            if(type_out == 'text' and not debug):
+                y = None # read from the encoded texts
             else:
-                y = eval('self.Y_'+set_name+'[id_out][last:new_last]')
+                y = self.__nextSamples(self.splits[set_name].Y[id_out], new_last, last, surpassed, indices)
             
             # Pre-process outputs
             if(not debug):
                 if(type_out == 'categorical'):
-                    nClasses = len(self.classes[id_out])
-                    y = np_utils.to_categorical(y, nClasses).astype(np.uint8)
+                    y = self.__oneHot(y, len(self.classes[id_out]), ('categorical', id_out), buffers)
                 elif(type_out == 'binary'):
                     y = np.array(y).astype(np.uint8)
                 elif(type_out == 'text'):
-                    y = self.loadText(y, self.vocabulary[id_out], 
-                                      self.max_text_len[id_out][set_name], self.text_offset[id_out],
-                                      fill=self.fill_text[id_out], pad_on_batch=self.pad_on_batch[id_out])
-                    # Use whole sentence as class (classifier model)
-                    if self.max_text_len[id_out][set_name] == 0:
-                        y_aux = np_utils.to_categorical(y, self.n_classes_text[id_out]).astype(np.uint8)
-
-                    # Use words separately (generator model)
-                    else:
-                        y_aux = np.zeros(list(y[0].shape) + [self.n_classes_text[id_out]]).astype(np.uint8)
-                        for idx in range(y[0].shape[0]):
-                            y_aux[idx] = np_utils.to_categorical(y[0][idx], self.n_classes_text[id_out]).astype(np.uint8)
-                        if self.sample_weights[id_out][set_name]:
-                            y_aux = (y_aux, y[1]) # join data and mask
-                    y = y_aux
+                    y = self.__loadTextOutput(positions, id_out, set_name, buffers)
             Y.append(y)
         
         if debug:
@@ -1843,7 +3287,7 @@ class Dataset(object):
         
     
     def getXY_FromIndices(self, set_name, k, normalization_type='0-1', normalization=False, meanSubstraction=True,
-              dataAugmentation=True, debug=False):
+              dataAugmentation=True, debug=False, buffers=None, stored_order=False):
         """
             Gets the [X,Y] pairs for the samples in positions 'k' in the desired set.
 
@@ -1867,49 +3311,70 @@ class Dataset(object):
 
             :param meanSubstraction: indicates if we want to substract the training mean from the returned images (only applicable if normalization=True)
             :param dataAugmentation: indicates if we want to apply data augmentation to the loaded images (random flip and cropping)
+            
+            :param buffers: BatchBuffers where the arrays of the batch are built (see PrefetchDataLoader), new arrays are returned if None
+            :param stored_order: if True, 'k' are positions in the stored order of the samples instead of in the order
+                                 set by shuffleTraining() (e.g. the batches of the generators that shuffle the samples themselves)
         """
         
         self.__checkSetName(set_name)
         self.__isLoaded(set_name, 0)
         self.__isLoaded(set_name, 1)
+        
+        split = self.splits[set_name]
+        k = np.asarray(k, dtype=np.int64)
+        # Positions of the samples in the stored order
+        if(split.order is not None and not stored_order):
+            k = split.order[k]
 
         # Recover input samples
         X = []
         for id_in, type_in in zip(self.ids_inputs, self.types_inputs):
             ghost_x = False
-            if id_in in self.optional_inputs:
+            if(type_in == 'text' and not debug and id_in not in self.optional_inputs):
+                x = None # read from the encoded texts
+            elif id_in in self.optional_inputs:
                 try:
-                    x = [eval('self.X_'+set_name+'[id_in][index]') for index in k]
+                    x = takeSamples(split.X[id_in], k)
+                    assert len(x) == len(k)
                 except:
                     x = [[]] * len(k)
                     ghost_x = True
             else:
-                x = [eval('self.X_'+set_name+'[id_in][index]') for index in k]
+                x = takeSamples(split.X[id_in], k)
             #if(set_name=='val'):
             #    logging.info(x)
 
             # Pre-process inputs
             if not debug and not ghost_x:
                 if(type_in == 'image'):
-                    x = self.loadImages(x, id_in, normalization_type, normalization, meanSubstraction, dataAugmentation)
+                    x = self.loadImages(x, id_in, normalization_type, normalization, meanSubstraction, dataAugmentation,
+                                        set_name=set_name, buffers=buffers)
                 elif(type_in == 'video'):
                     x = self.loadVideosByIndex(x, id_in, k, set_name, self.max_video_len[id_in],
-                                        normalization_type, normalization, meanSubstraction, dataAugmentation)
+                                        normalization_type, normalization, meanSubstraction, dataAugmentation,
+                                        buffers=buffers)
                 elif(type_in == 'text'):
-                    x = self.loadText(x, self.vocabulary[id_in],
-                                      self.max_text_len[id_in][set_name], self.text_offset[id_in],
-                                      fill=self.fill_text[id_in], pad_on_batch=self.pad_on_batch[id_in])[0]
+                    x = self.loadEncodedText(k, id_in, set_name,
+                                             self.max_text_len[id_in][set_name], self.text_offset[id_in],
+                                             fill=self.fill_text[id_in], pad_on_batch=self.pad_on_batch[id_in],
+                                             buffers=buffers)[0]
                 elif(type_in == 'image-features'):
-                    x = self.loadFeatures(x, self.features_lengths[id_in], normalization_type, normalization, data_augmentation=dataAugmentation)
+                    x = self.loadFeatures(x, self.features_lengths[id_in], normalization_type, normalization, data_augmentation=dataAugmentation,
+                                          id=id_in, set_name=set_name, buffers=buffers)
                 elif(type_in == 'video-features'):
                     x = self.loadVideoFeatures(x, id_in, set_name, self.max_video_len[id_in], 
-                                          normalization_type, normalization, self.features_lengths[id_in], data_augmentation=dataAugmentation)
+                                          normalization_type, normalization, self.features_lengths[id_in], data_augmentation=dataAugmentation,
+                                          buffers=buffers)
             X.append(x)
 
         # Recover output samples
         Y = []
         for id_out, type_out in zip(self.ids_outputs, self.types_outputs):
-            y = [eval('self.Y_'+set_name+'[id_out][index]') for index in k]
+            if(type_out == 'text' and not debug):
+                y = None # read from the encoded texts
+            else:
+                y = takeSamples(split.Y[id_out], k)
 
             #if(set_name=='val'):
             #    logging.info(y)
@@ -1917,33 +3382,69 @@ class Dataset(object):
             # Pre-process outputs
             if(not debug):
                 if(type_out == 'categorical'):
-                    nClasses = len(self.classes[id_out])
-                    y = np_utils.to_categorical(y, nClasses).astype(np.uint8)
+                    y = self.__oneHot(y, len(self.classes[id_out]), ('categorical', id_out), buffers)
                 elif(type_out == 'binary'):
                     y = np.array(y).astype(np.uint8)
                 elif(type_out == 'text'):
-                    y = self.loadText(y, self.vocabulary[id_out],
-                                      self.max_text_len[id_out][set_name], self.text_offset[id_out],
-                                      fill=self.fill_text[id_out], pad_on_batch=self.pad_on_batch[id_out])
-
-                    # Use whole sentence as class (classifier model)
-                    if self.max_text_len[id_out][set_name] == 0:
-                        y_aux = np_utils.to_categorical(y, self.n_classes_text[id_out]).astype(np.uint8)
-                    # Use words separately (generator model)
-                    else:
-                        y_aux = np.zeros(list(y[0].shape) + [self.n_classes_text[id_out]]).astype(np.uint8)
-                        for idx in range(y[0].shape[0]):
-                            y_aux[idx] = np_utils.to_categorical(y[0][idx], self.n_classes_text[id_out]).astype(
-                                np.uint8)
-                        if self.sample_weights[id_out][set_name]:
-                            y_aux = (y_aux, y[1]) # join data and mask
-                    y = y_aux
+                    y = self.__loadTextOutput(k, id_out, set_name, buffers)
             Y.append(y)
 
         if debug:
             return [X, Y, [k]]
 
         return [X,Y]
+    
+    
+    def getXY_Cached(self, set_name, k, normalization_type='0-1', normalization=False, meanSubstraction=True):
+        """
+            Same as getXY(set_name, k, dataAugmentation=False), but the batches are read from the batch cache of the
+            split if it is enabled (see setBatchCache()), and stored in it the first time they are built.
+            The returned arrays must not be modified.
+        """
+        cache = self.__batch_caches.get(set_name)
+        if(cache is None):
+            return self.getXY(set_name, k, normalization_type, normalization, meanSubstraction, dataAugmentation=False)
+        
+        self.__checkSetName(set_name)
+        cache.validate(self.__batchCacheSettings(set_name, normalization_type, normalization, meanSubstraction))
+        [new_last, last, surpassed, indices] = self.__getNextSamples(k, set_name)
+        key = ('XY', last, k)
+        batch = cache.get(key)
+        if(batch is None):
+            # positions in the reading order of the next k samples
+            positions = (last + np.arange(k)) % self.splits[set_name].len
+            batch = self.getXY_FromIndices(set_name, positions, normalization_type, normalization, meanSubstraction,
+                                           dataAugmentation=False)
+            cache.put(key, batch)
+        return batch
+    
+    
+    def getX_Cached(self, set_name, init, final, normalization_type='0-1', normalization=False, meanSubstraction=True):
+        """
+            Same as getX(set_name, init, final, dataAugmentation=False), but the batches are read from the batch cache
+            of the split if it is enabled (see getXY_Cached()).
+        """
+        cache = self.__batch_caches.get(set_name)
+        if(cache is None):
+            return self.getX(set_name, init, final, normalization_type, normalization, meanSubstraction, dataAugmentation=False)
+        
+        self.__checkSetName(set_name)
+        cache.validate(self.__batchCacheSettings(set_name, normalization_type, normalization, meanSubstraction))
+        key = ('X', init, final)
+        batch = cache.get(key)
+        if(batch is None):
+            batch = self.getX(set_name, init, final, normalization_type, normalization, meanSubstraction, dataAugmentation=False)
+            cache.put(key, batch)
+        return batch
+    
+    
+    def __batchCacheSettings(self, set_name, normalization_type, normalization, meanSubstraction):
+        """
+            Returns everything the cached batches of the split 'set_name' depend on (see BatchCache.validate()).
+        """
+        split = self.splits[set_name]
+        inputs = [(id, self.img_size.get(id), self.img_size_crop.get(id), self.train_mean.get(id)) for id in self.ids_inputs]
+        return [normalization_type, normalization, meanSubstraction, split.len, split.order, inputs, list(self.ids_outputs)]
 
     def getY(self, set_name, init, final, normalization_type='0-1', normalization=False, meanSubstraction=True,
               dataAugmentation=True, debug=False):
@@ -1972,7 +3473,7 @@ class Dataset(object):
         self.__checkSetName(set_name)
         self.__isLoaded(set_name, 1)
 
-        if(final > eval('self.len_'+set_name)):
+        if(final > self.splits[set_name].len):
             raise Exception('"final" index must be smaller than the number of samples in the set.')
         if(init < 0):
             raise Exception('"init" index must be equal or greater than 0.')
@@ -1982,33 +3483,19 @@ class Dataset(object):
         # Recover output samples
         Y = []
         for id_out, type_out in zip(self.ids_outputs, self.types_outputs):
-            y = eval('self.Y_'+set_name+'[id_out][init:final]')
+            if(type_out == 'text' and not debug):
+                y = None # read from the encoded texts
+            else:
+                y = self.__rangeSamples(self.splits[set_name].Y[id_out], set_name, init, final)
 
             # Pre-process outputs
             if(not debug):
                 if(type_out == 'categorical'):
-                    nClasses = len(self.classes[id_out])
-                    y = np_utils.to_categorical(y, nClasses).astype(np.uint8)
+                    y = self.__oneHot(y, len(self.classes[id_out]), ('categorical', id_out))
                 elif(type_out == 'binary'):
                     y = np.array(y).astype(np.uint8)
                 elif(type_out == 'text'):
-                    y = self.loadText(y, self.vocabulary[id_out],
-                                      self.max_text_len[id_out][set_name], self.text_offset[id_out],
-                                      fill=self.fill_text[id_out], pad_on_batch=self.pad_on_batch[id_out])
-
-                    # Use whole sentence as class (classifier model)
-                    if self.max_text_len[id_out][set_name] == 0:
-                        y_aux = np_utils.to_categorical(y, self.n_classes_text[id_out]).astype(np.uint8)
-                    # Use words separately (generator model)
-                    else:
-                        y_aux = np.zeros(list(y[0].shape) + [self.n_classes_text[id_out]]).astype(np.uint8)
-                        for idx in range(y[0].shape[0]):
-                            y_aux[idx] = np_utils.to_categorical(y[0][idx], self.n_classes_text[id_out]).astype(
-                                np.uint8)
-                        if self.sample_weights[id_out][set_name]:
-                            y_aux = (y_aux, y[1]) # join data and mask
-
-                    y = y_aux
+                    y = self.__loadTextOutput(self.__rangeIndices(set_name, init, final), id_out, set_name)
             Y.append(y)
 
         return Y
@@ -2020,7 +3507,7 @@ class Dataset(object):
     # ------------------------------------------------------- #
         
     def __isLoaded(self, set_name, pos):
-        if(eval('not self.loaded_'+set_name+'[pos]')):
+        if(not self.splits[set_name].loaded[pos]):
             if(pos==0):
                 raise Exception('Set '+set_name+' samples are not loaded yet.')
             elif(pos==1):
@@ -2035,36 +3522,99 @@ class Dataset(object):
         
     
     def __checkLengthSet(self, set_name):
-        if(eval('self.loaded_'+set_name+'[0] and self.loaded_'+set_name+'[1]')):
+        split = self.splits[set_name]
+        if(split.loaded[0] and split.loaded[1]):
             lengths = []
             for id_in in self.ids_inputs:
                 if id_in not in self.optional_inputs:
-                    exec('lengths.append(len(self.X_'+ set_name +'[id_in]))')
+                    lengths.append(len(split.X[id_in]))
             for id_out in self.ids_outputs:
-                exec('lengths.append(len(self.Y_'+ set_name +'[id_out]))')
+                lengths.append(len(split.Y[id_out]))
             if(lengths[1:] != lengths[:-1]):
                 raise Exception('Inputs and outputs size ('+str(lengths)+') for "' +set_name+ '" set do not match.')
             
                 
+    def __joinSamples(self, first, second):
+        """
+            Concatenates two slices of a data column (lists or numpy arrays).
+        """
+        if(isinstance(first, np.ndarray)):
+            return np.concatenate([first, second])
+        return first + second
+    
+    
+    def __nextSamples(self, column, new_last, last, surpassed, indices):
+        """
+            Returns the samples of 'column' selected by __getNextSamples().
+        """
+        if(indices is not None):
+            return takeSamples(column, indices)
+        if(surpassed):
+            return self.__joinSamples(column[last:], column[0:new_last])
+        return column[last:new_last]
+    
+    
+    def __rangeSamples(self, column, set_name, init, final):
+        """
+            Returns the samples of 'column' in the positions init to final of the reading order of 'set_name'.
+        """
+        order = self.splits[set_name].order
+        if(order is None):
+            return column[init:final]
+        return takeSamples(column, order[init:final])
+    
+    
+    def __rangeIndices(self, set_name, init, final):
+        """
+            Returns the positions in the stored order of the samples init to final of the reading order of 'set_name'.
+        """
+        order = self.splits[set_name].order
+        if(order is None):
+            return np.arange(init, final)
+        return order[init:final]
+    
+    
+    def __nextIndices(self, set_name, new_last, last, surpassed, indices):
+        """
+            Returns the positions in the stored order of the samples selected by __getNextSamples().
+        """
+        if(indices is not None):
+            return indices
+        if(surpassed):
+            return np.concatenate([np.arange(last, self.splits[set_name].len), np.arange(0, new_last)])
+        return np.arange(last, new_last)
+    
+    
     def __getNextSamples(self, k, set_name):
         """
             Gets the indices to the next K samples we are going to read.
+            Returns [new_last, last, surpassed, indices], where 'indices' are the positions of the samples in the
+            stored order if the split has been shuffled (see shuffleTraining()) or None otherwise.
         """
         self.__lock_read.acquire() # LOCK (for avoiding reading the same samples by different threads)
         
-        new_last = eval('self.last_'+set_name+'+k')
-        last = eval('self.last_'+set_name)
-        length = eval('self.len_'+set_name)
+        split = self.splits[set_name]
+        new_last = split.last+k
+        last = split.last
+        length = split.len
         if(new_last > length):
             new_last = new_last - length
             surpassed = True
         else:
             surpassed = False
-        exec('self.last_'+set_name+ '= new_last')
+        split.last = new_last
+        
+        order = split.order
+        if(order is None):
+            indices = None
+        elif(surpassed):
+            indices = np.concatenate([order[last:], order[0:new_last]])
+        else:
+            indices = order[last:new_last]
         
         self.__lock_read.release() # UNLOCK
         
-        return [new_last, last, surpassed]
+        return [new_last, last, surpassed, indices]
 
     def __getstate__(self):
         """
@@ -2072,6 +3622,18 @@ class Dataset(object):
         """ 
         obj_dict = self.__dict__.copy()
         del obj_dict['_Dataset__lock_read']
+        obj_dict.pop('_Dataset__image_cache_files', None)
+        obj_dict.pop('_Dataset__record_files', None)
+        obj_dict.pop('_Dataset__prepared_mean', None)
+        obj_dict.pop('_Dataset__features_files', None)
+        obj_dict.pop('_Dataset__folder_listings', None)
+        obj_dict.pop('_Dataset__batch_caches', None)
+        obj_dict.pop('_Dataset__decoded_images', None)
+        obj_dict.pop('_Dataset__lock_decoded', None)
+        # The splits are stored with the attribute names used before the split registry
+        for set_name, split in obj_dict.pop('splits').items():
+            for prefix, attribute in _SPLIT_ATTRIBUTES:
+                obj_dict[prefix+set_name] = getattr(split, attribute)
         return obj_dict
         
     
@@ -2080,7 +3642,40 @@ class Dataset(object):
             Behavour applied when unpickling a Dataset instance.
         """
         dict['_Dataset__lock_read'] = threading.Lock()
+        dict['_Dataset__image_cache_files'] = {}
+        dict['_Dataset__record_files'] = {}
+        dict['_Dataset__prepared_mean'] = {}
+        dict['_Dataset__features_files'] = {}
+        dict['_Dataset__folder_listings'] = {}
+        dict['_Dataset__batch_caches'] = {}
+        dict['_Dataset__decoded_images'] = {}
+        dict['_Dataset__lock_decoded'] = threading.Lock()
+        dict.setdefault('image_cache', {})
+        dict.setdefault('image_records', {})
+        dict.setdefault('draft_decoding', {})
+        dict.setdefault('decode_cache_size', {})
+        dict.setdefault('text_encoded', {})
+        dict.setdefault('sparse_targets', {})
+        dict.setdefault('first_frames', {})
+        dict.setdefault('consolidated_features', {})
+        dict['splits'] = {}
+        for set_name in ['train', 'val', 'test']:
+            split = DataSplit()
+            for prefix, attribute in _SPLIT_ATTRIBUTES:
+                if(prefix+set_name in dict):
+                    setattr(split, attribute, dict.pop(prefix+set_name))
+            dict['splits'][set_name] = split
+        dict.setdefault('shuffle_chunk_size', None)
+        dict.setdefault('tokenization_workers', None)
+        dict.setdefault('tokenization_cache', False)
+        dict.setdefault('tokenization_cache_path', None)
+        dict.setdefault('train_std', {})
         self.__dict__ = dict
 
                 
                 
+
+
+for _set_name in ['train', 'val', 'test']:
+    for _prefix, _attribute in _SPLIT_ATTRIBUTES:
+        setattr(Dataset, _prefix+_set_name, _splitProperty(_set_name, _attribute))
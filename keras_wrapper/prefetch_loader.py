@@ -0,0 +1,118 @@
+from collections import deque
+import Queue
+import sys
+import threading
+
+import numpy as np
+
+
+class BatchBuffers(object):
+    """
+        Output arrays of the batches built in one slot of a PrefetchDataLoader, reused from batch to batch.
+        Each array is identified by a key (e.g. ('image', id)) and is backed by a byte buffer that only grows
+        when a batch needs more space than the previous ones, so in steady state no array data is allocated.
+    """
+
+    def __init__(self):
+        self.__storage = dict()
+        self.__dicts = dict()
+
+    def array(self, key, shape, dtype):
+        """
+            Returns an uninitialized C-contiguous array with the given shape and dtype backed by the buffer 'key'.
+        """
+        dtype = np.dtype(dtype)
+        shape = tuple(int(s) for s in shape)
+        n_bytes = int(np.prod(shape)) * dtype.itemsize
+        storage = self.__storage.get(key)
+        if(storage is None or len(storage) < n_bytes):
+            storage = np.empty(n_bytes, dtype=np.uint8)
+            self.__storage[key] = storage
+        return storage[:n_bytes].view(dtype).reshape(shape)
+
+    def dict(self, key):
+        """
+            Returns the (emptied) dictionary 'key'.
+        """
+        d = self.__dicts.setdefault(key, dict())
+        d.clear()
+        return d
+
+
+def batchArray(buffers, key, shape, dtype, fill_value=None):
+    """
+        Returns an array for the data of a batch: backed by the buffer 'key' of 'buffers' (a BatchBuffers)
+        or a new one if buffers is None. If fill_value is not None, all its positions are set to it.
+    """
+    if(buffers is None):
+        array = np.empty(shape, dtype=dtype)
+    else:
+        array = buffers.array(key, shape, dtype)
+    if(fill_value is not None):
+        array.fill(fill_value)
+    return array
+
+
+class PrefetchDataLoader(object):
+    """
+        Builds batches in a background thread ahead of their consumption. Each batch is built in the BatchBuffers
+        of a free slot, and there are only n_slots of them, so at most n_slots batches are built or waiting.
+        The consumer hands back the slot of each batch with release() when it is done with it
+        (e.g. after train_on_batch), and its buffers are reused for building a new batch.
+    """
+
+    def __init__(self, batches, n_slots):
+        """
+            :param batches: generator function batches(acquire) yielding the batches in order. Before building
+                            each batch it must call acquire(), which returns the BatchBuffers for building it
+                            (waiting until a slot is released if none is free)
+            :param n_slots: number of slots (batches built or being built ahead of their release)
+        """
+        self.n_slots = n_slots
+        self.__free = Queue.Queue()
+        for i in range(n_slots):
+            self.__free.put(BatchBuffers())
+        self.__acquired = deque() # slots of the batches not released yet, in order
+        self.__ready = Queue.Queue()
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.__produce, args=(batches,))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __acquire(self):
+        buffers = self.__free.get()
+        if(buffers is None): # closed
+            raise StopIteration
+        self.__acquired.append(buffers)
+        return buffers
+
+    def __produce(self, batches):
+        try:
+            for batch in batches(self.__acquire):
+                self.__ready.put((True, batch))
+        except Exception:
+            if(not self.__closed):
+                self.__ready.put((False, sys.exc_info()))
+
+    def __iter__(self):
+        while 1:
+            [ok, batch] = self.__ready.get()
+            if(not ok):
+                exc_type, exc_obj, exc_trace = batch
+                raise exc_type, exc_obj, exc_trace
+            yield batch
+
+    def release(self):
+        """
+            Hands back the slot of the oldest batch not released yet.
+        """
+        self.__free.put(self.__acquired.popleft())
+
+    def close(self):
+        """
+            Stops building batches. It waits until the batch being built (which is discarded) is finished,
+            so the dataset is not accessed by the loader afterwards.
+        """
+        self.__closed = True
+        self.__free.put(None)
+        self.__thread.join()
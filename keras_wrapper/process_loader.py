@@ -0,0 +1,115 @@
+from collections import deque, Counter
+import multiprocessing
+import random
+import logging
+
+import numpy as np
+
+from keras_wrapper.data_columns import takeSamples
+
+# Dataset instance owned by each worker process (read-only copy received at fork time)
+_worker_dataset = None
+
+
+def initWorker(dataset):
+    """
+        Initializes a worker process of a ProcessDataLoader pool.
+    """
+    global _worker_dataset
+    _worker_dataset = dataset
+    _worker_dataset.silence = True
+    # Forked workers inherit the random state of the parent, re-seed them
+    # so that each one applies different data augmentations
+    random.seed()
+    np.random.seed()
+
+
+def retrieveBatch(set_name, indices, init, final, normalization, meanSubstraction, dataAugmentation, predict):
+    """
+        Builds a whole batch in a worker process. Returns X if predict == True, [X, Y] otherwise.
+        The 'indices' are positions in the stored order of the samples (see Data_Batch_Generator).
+    """
+    if(predict):
+        return _worker_dataset.getX(set_name, init, final, normalization=normalization,
+                                    meanSubstraction=meanSubstraction, dataAugmentation=False)
+    return _worker_dataset.getXY_FromIndices(set_name, indices, normalization=normalization,
+                                             meanSubstraction=meanSubstraction, dataAugmentation=dataAugmentation,
+                                             stored_order=True)
+
+
+def tokenizeSentences(tokenization, sentences, dataset=None):
+    """
+        Tokenizes a chunk of sentences with the tokenization method 'tokenization' of the Dataset (the one owned by
+        the worker process if dataset is None).
+        Returns [tokenized sentences, Counter of their words, list of the words in order of first appearance].
+    """
+    if(dataset is None):
+        dataset = _worker_dataset
+    tokfun = getattr(dataset, tokenization)
+    tokenized = [tokfun(sentence) for sentence in sentences]
+    counter = Counter()
+    words = []
+    for sentence in tokenized:
+        for word in sentence.strip().split(' '):
+            if word not in counter:
+                words.append(word)
+            counter[word] += 1
+    return [tokenized, counter, words]
+
+
+def sumImages(id, positions, dataset=None):
+    """
+        Reads the training images of the input 'id' stored in 'positions' (see Dataset.calculateTrainMean()).
+        Returns [number of images, sum of the images, sum of their squares], with float64 sums of the image size.
+    """
+    if(dataset is None):
+        dataset = _worker_dataset
+    images = dataset.readImages(takeSamples(dataset.X_train[id], positions), id, set_name='train')
+    I_sum = images.sum(axis=0, dtype=np.float64)
+    I_sum_sq = np.zeros(images.shape[1:], dtype=np.float64)
+    for im in images:
+        im = im.astype(np.float64)
+        I_sum_sq += im*im
+    return [len(images), I_sum, I_sum_sq]
+
+
+class ProcessDataLoader(object):
+    """
+        Data loader based on processes (parallel execution without sharing the GIL).
+        Each worker holds a copy of the Dataset and builds complete batches, which are returned in
+        the same order as they were requested. The same loader can be shared by several generators of the
+        Dataset (e.g. the training and validation ones). It must be created before starting any other thread,
+        since the forked workers would inherit the locks held by them (e.g. the ones of the Dataset or logging).
+    """
+    def __init__(self, dataset, n_workers=None, max_pending=None):
+        if(n_workers is None):
+            n_workers = multiprocessing.cpu_count()
+        if(max_pending is None):
+            max_pending = 2*n_workers
+        self.n_workers = n_workers
+        self.max_pending = max_pending
+        self.pool = multiprocessing.Pool(n_workers, initializer=initWorker, initargs=(dataset,))
+        if(not dataset.silence):
+            logging.info("Started "+ str(n_workers) +" data loading processes.")
+
+    def imap(self, tasks, function=retrieveBatch):
+        """
+            Submits the batch arguments yielded by 'tasks' to the pool (keeping at most self.max_pending
+            batches in flight) and yields the built batches in order.
+            
+            :param function: module-level function applied to each task in the workers
+        """
+        pending = deque()
+        for args in tasks:
+            pending.append(self.pool.apply_async(function, args))
+            if(len(pending) >= self.max_pending):
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        """
+            Stops the workers once the batches already submitted are finished.
+        """
+        self.pool.close()
+        self.pool.join()
@@ -27,7 +27,10 @@ def retrieveXY(dataset, set_name, batchSize, normalization, meanSubstraction, da
         Retrieves a set of samples from the given dataset and the given set name
     """
     try:
-        X_batch, Y_batch = dataset.getXY(set_name, batchSize, normalization=normalization, meanSubstraction=meanSubstraction, dataAugmentation=dataAugmentation)
+        if(dataAugmentation):
+            X_batch, Y_batch = dataset.getXY(set_name, batchSize, normalization=normalization, meanSubstraction=meanSubstraction, dataAugmentation=dataAugmentation)
+        else: # deterministic batches, read from the batch cache of the split if enabled
+            X_batch, Y_batch = dataset.getXY_Cached(set_name, batchSize, normalization=normalization, meanSubstraction=meanSubstraction)
         return [True, '', X_batch, Y_batch]
     except:
         return [False, sys.exc_info(), None, None]
@@ -0,0 +1,33 @@
+# coding=utf-8
+"""
+    Micro-benchmark of the tokenizers of Dataset against the implementations they replaced
+    (see test_tokenizers.py). Reports the sentences tokenized per second by each one.
+
+        python tests/benchmark_tokenizers.py [n_calls]
+"""
+import sys
+import timeit
+
+from keras_wrapper.dataset import Dataset
+from test_tokenizers import _OldTokenizers
+
+CAPTION = 'A man, wearing a "red" hat (and boots), walks his dog; it\'s 2.5 km to the park-gate!\tDon\'t stop?'
+TOKENIZERS = ['tokenize_basic', 'tokenize_aggressive', 'tokenize_icann', 'tokenize_montreal', 'tokenize_soft',
+              'tokenize_questions']
+
+
+def main(n_calls=20000):
+    new = Dataset.__new__(Dataset)
+    old = _OldTokenizers()
+    print('%-22s %12s %12s' % ('sentences/s', 'old', 'new'))
+    for name in TOKENIZERS:
+        speeds = []
+        for tokenizers in [old, new]:
+            tokenize = getattr(tokenizers, name)
+            seconds = min(timeit.repeat(lambda: tokenize(CAPTION), number=n_calls, repeat=3))
+            speeds.append(n_calls/seconds)
+        print('%-22s %12.0f %12.0f' % (name, speeds[0], speeds[1]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
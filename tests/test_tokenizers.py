@@ -0,0 +1,243 @@
+# coding=utf-8
+"""
+    Checks that the precompiled tokenizers of Dataset return the same output as the implementations they replaced
+    (copied below), including byte strings that are not valid UTF-8.
+"""
+import random
+import re
+import unittest
+
+from keras_wrapper.dataset import Dataset
+
+
+class _OldTokenizers(object):
+    """
+        Tokenizers of Dataset before they were precompiled.
+    """
+
+    def tokenize_basic(self, caption, lowercase=True):
+        """
+            Basic tokenizer for the input/output data of type 'text':
+                Splits punctuation
+                Lowercase
+        """
+        punct = ['.', ';', r"/", '[', ']', '"', '{', '}', '(', ')', '=', '+', '\\', '_', '-', '>', '<', '@', '`', ',', '?', '!']
+        def processPunctuation(inText):
+            outText = inText
+            for p in punct:
+                outText = outText.replace(p, ' ' + p + ' ')
+            return outText
+        resAns = caption.lower() if lowercase else caption
+        resAns = resAns.replace('\n', ' ')
+        resAns = resAns.replace('\t', ' ')
+        resAns = processPunctuation(resAns)
+        resAns = resAns.replace('  ', ' ')
+        return resAns
+
+
+    def tokenize_aggressive(self, caption, lowercase=True):
+        """
+            Aggressive tokenizer for the input/output data of type 'text':
+                Removes punctuation
+                Lowercase
+        """
+        punct = ['.', ';', r"/", '[', ']', '"', '{', '}', '(', ')',
+                 '=', '+', '\\', '_', '-', '>', '<', '@', '`', ',', '?', '!',
+                 '¿', '¡', '\n', '\t', '\r']
+        def processPunctuation(inText):
+            outText = inText
+            for p in punct:
+                outText = outText.replace(p, '')
+            return outText
+        resAns = caption.lower() if lowercase else caption
+        resAns = processPunctuation(resAns)
+        resAns = re.sub('[  ]+', ' ', resAns)
+        resAns = resAns.strip()
+        return resAns
+
+    def tokenize_icann(self, caption, lowercase=True):
+        """
+            Tokenization used for the icann paper:
+                Removes some punctuation
+                Lowercase
+        """
+        tokenized = re.sub('[.,"\n\t]+', '', caption)
+        tokenized = re.sub('[  ]+', ' ', tokenized)
+        tokenized = map(lambda x: x.lower(), tokenized.split())
+        tokenized = " ".join(tokenized)
+        return tokenized
+
+
+    def tokenize_montreal(self, caption, lowercase=True):
+        """
+            Tokenization used for the icann paper:
+                Removes some punctuation
+                Lowercase
+        """
+        tokenized = re.sub('[.,"\n\t]+', '', caption.strip())
+        tokenized = re.sub('[\']+', " '", tokenized)
+        tokenized = re.sub('[  ]+', ' ', tokenized)
+        tokenized = map(lambda x: x.lower(), tokenized.split())
+        tokenized = " ".join(tokenized)
+        return tokenized
+
+    def tokenize_soft(self, caption, lowercase=True):
+        """
+            Tokenization used for the icann paper:
+                Removes very little punctuation
+                Lowercase
+        """
+        tokenized = re.sub('[\n\t]+', '', caption.strip())
+        tokenized = re.sub('[\.]+', ' . ', tokenized)
+        tokenized = re.sub('[,]+', ' , ', tokenized)
+        tokenized = re.sub('[!]+', ' ! ', tokenized)
+        tokenized = re.sub('[?]+', ' ? ', tokenized)
+        tokenized = re.sub('[\{]+', ' { ', tokenized)
+        tokenized = re.sub('[\}]+', ' } ', tokenized)
+        tokenized = re.sub('[\(]+', ' ( ', tokenized)
+        tokenized = re.sub('[\)]+', ' ) ', tokenized)
+        tokenized = re.sub('[\[]+', ' [ ', tokenized)
+        tokenized = re.sub('[\]]+', ' ] ', tokenized)
+        tokenized = re.sub('["]+', ' " ', tokenized)
+        tokenized = re.sub('[\']+', " ' ", tokenized)
+        tokenized = re.sub('[  ]+', ' ', tokenized)
+        tokenized = map(lambda x: x.lower(), tokenized.split())
+        tokenized = " ".join(tokenized)
+        return tokenized
+
+
+    def tokenize_questions(self, caption):
+        """
+            Basic tokenizer for VQA questions
+        """
+        contractions = {"aint": "ain't", "arent": "aren't", "cant": "can't", "couldve": "could've", "couldnt": "couldn't",
+                "couldn'tve": "couldn’t’ve", "couldnt’ve": "couldn’t’ve", "didnt": "didn’t", "doesnt": "doesn’t",
+                "dont": "don’t", "hadnt": "hadn’t", "hadnt’ve": "hadn’t’ve", "hadn'tve": "hadn’t’ve",
+                "hasnt": "hasn’t", "havent": "haven’t", "hed": "he’d", "hed’ve": "he’d’ve", "he’dve": "he’d’ve",
+                "hes": "he’s", "howd": "how’d", "howll": "how’ll", "hows": "how’s", "Id’ve": "I’d’ve",
+                "I’dve": "I’d’ve", "Im": "I’m", "Ive": "I’ve", "isnt": "isn’t", "itd": "it’d", "itd’ve": "it’d’ve",
+                "it’dve": "it’d’ve", "itll": "it’ll", "let’s": "let’s", "maam": "ma’am", "mightnt": "mightn’t",
+                "mightnt’ve": "mightn’t’ve", "mightn’tve": "mightn’t’ve", "mightve": "might’ve", "mustnt": "mustn’t",
+                "mustve": "must’ve", "neednt": "needn’t", "notve": "not’ve", "oclock": "o’clock", "oughtnt": "oughtn’t",
+                "ow’s’at": "’ow’s’at", "’ows’at": "’ow’s’at", "’ow’sat": "’ow’s’at", "shant": "shan’t",
+                "shed’ve": "she’d’ve", "she’dve": "she’d’ve", "she’s": "she’s", "shouldve": "should’ve",
+                "shouldnt": "shouldn’t", "shouldnt’ve": "shouldn’t’ve", "shouldn’tve": "shouldn’t’ve",
+                "somebody’d": "somebodyd", "somebodyd’ve": "somebody’d’ve", "somebody’dve": "somebody’d’ve",
+                "somebodyll": "somebody’ll", "somebodys": "somebody’s", "someoned": "someone’d",
+                "someoned’ve": "someone’d’ve", "someone’dve": "someone’d’ve", "someonell": "someone’ll",
+                "someones": "someone’s", "somethingd": "something’d", "somethingd’ve": "something’d’ve",
+                "something’dve": "something’d’ve", "somethingll": "something’ll", "thats": "that’s",
+                "thered": "there’d", "thered’ve": "there’d’ve", "there’dve": "there’d’ve", "therere": "there’re",
+                "theres": "there’s", "theyd": "they’d", "theyd’ve": "they’d’ve", "they’dve": "they’d’ve",
+                "theyll": "they’ll", "theyre": "they’re", "theyve": "they’ve", "twas": "’twas", "wasnt": "wasn’t",
+                "wed’ve": "we’d’ve", "we’dve": "we’d’ve", "weve": "we've", "werent": "weren’t", "whatll": "what’ll",
+                "whatre": "what’re", "whats": "what’s", "whatve": "what’ve", "whens": "when’s", "whered":
+                    "where’d", "wheres": "where's", "whereve": "where’ve", "whod": "who’d", "whod’ve": "who’d’ve",
+                "who’dve": "who’d’ve", "wholl": "who’ll", "whos": "who’s", "whove": "who've", "whyll": "why’ll",
+                "whyre": "why’re", "whys": "why’s", "wont": "won’t", "wouldve": "would’ve", "wouldnt": "wouldn’t",
+                "wouldnt’ve": "wouldn’t’ve", "wouldn’tve": "wouldn’t’ve", "yall": "y’all", "yall’ll": "y’all’ll",
+                "y’allll": "y’all’ll", "yall’d’ve": "y’all’d’ve", "y’alld’ve": "y’all’d’ve", "y’all’dve": "y’all’d’ve",
+                "youd": "you’d", "youd’ve": "you’d’ve", "you’dve": "you’d’ve", "youll": "you’ll",
+                "youre": "you’re", "youve": "you’ve"}
+        punct = [';', r"/", '[', ']', '"', '{', '}', '(', ')', '=', '+', '\\', '_', '-', '>', '<', '@', '`', ',', '?', '!']
+        commaStrip = re.compile("(\d)(\,)(\d)")
+        periodStrip = re.compile("(?!<=\d)(\.)(?!\d)")
+        manualMap = {'none': '0', 'zero': '0', 'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5', 'six': '6',
+             'seven': '7', 'eight': '8', 'nine': '9', 'ten': '10'}
+        articles = ['a', 'an', 'the']
+
+        def processPunctuation(inText):
+            outText = inText
+            for p in punct:
+                if (p + ' ' in inText or ' ' + p in inText) or (re.search(commaStrip, inText) != None):
+                    outText = outText.replace(p, '')
+                else:
+                    outText = outText.replace(p, ' ')
+            outText = periodStrip.sub("", outText, re.UNICODE)
+            return outText
+
+        def processDigitArticle(inText):
+            outText = []
+            tempText = inText.lower().split()
+            for word in tempText:
+                word = manualMap.setdefault(word, word)
+                if word not in articles:
+                    outText.append(word)
+                else:
+                    pass
+            for wordId, word in enumerate(outText):
+                if word in contractions:
+                    outText[wordId] = contractions[word]
+            outText = ' '.join(outText)
+            return outText
+
+        resAns = caption.lower()
+        resAns = resAns.replace('\n', ' ')
+        resAns = resAns.replace('\t', ' ')
+        resAns = resAns.strip()
+        resAns = processPunctuation(resAns.decode("utf-8").encode("utf-8"))
+        resAns = processDigitArticle(resAns)
+
+        return resAns
+
+
+
+
+_SYMBOLS = list('.;/[]"{}()=+\\_-><@`,?!\'\n\t\r  ') + ['¿', '¡', '\xc2', '\xbf', '\xa1', '\xe2\x80\x99']
+_WORDS = ['a', 'the', 'An', 'dog', 'Two', 'none', 'dont', 'isnt', 'youre', '3', '1,000', '2.5', 'caf\xc3\xa9', 'WHAT']
+
+
+def _randomCaptions(n_captions, seed=0):
+    random_state = random.Random(seed)
+    captions = []
+    for i in range(n_captions):
+        pieces = [random_state.choice(_WORDS + _SYMBOLS) for j in range(random_state.randint(0, 20))]
+        captions.append(''.join([p if random_state.random() < 0.5 else p+' ' for p in pieces]))
+    return captions
+
+
+class TestTokenizers(unittest.TestCase):
+
+    # Byte strings whose invalid UTF-8 bytes become adjacent when the symbols between them are removed
+    edge_cases = ['', ' ', '\xc2>[\xbf', '\xc2\xc2\xbf\xa1', '\xc2\n\xbf', '\xc2\xbf\xa1', '¿Qué?', '¡hola!',
+                  '..,,!!??', '((a))', 'a.b', ' .a. ', '\t\n\r', 'I dont know, 1,000 dogs.', "it's 'quoted'"]
+
+    def setUp(self):
+        self.new = Dataset.__new__(Dataset)
+        self.old = _OldTokenizers()
+        self.captions = self.edge_cases + _randomCaptions(5000)
+
+    def checkEquivalent(self, name, valid_utf8=False, **kwargs):
+        for caption in self.captions:
+            if(valid_utf8):
+                try:
+                    caption.decode('utf-8')
+                except UnicodeDecodeError:
+                    continue
+            self.assertEqual(getattr(self.old, name)(caption, **kwargs), getattr(self.new, name)(caption, **kwargs),
+                             msg=name+' differs for '+repr(caption))
+
+    def test_basic(self):
+        self.checkEquivalent('tokenize_basic')
+        self.checkEquivalent('tokenize_basic', lowercase=False)
+
+    def test_aggressive(self):
+        self.checkEquivalent('tokenize_aggressive')
+        self.checkEquivalent('tokenize_aggressive', lowercase=False)
+
+    def test_icann(self):
+        self.checkEquivalent('tokenize_icann')
+
+    def test_montreal(self):
+        self.checkEquivalent('tokenize_montreal')
+
+    def test_soft(self):
+        self.checkEquivalent('tokenize_soft')
+
+    def test_questions(self):
+        # both implementations require valid UTF-8 (they decode the caption)
+        self.checkEquivalent('tokenize_questions', valid_utf8=True)
+
+
+if __name__ == '__main__':
+    unittest.main()